@@ -17,7 +17,9 @@
 
 import os
 import sys
+import errno
 import logging
+import multiprocessing
 import tempfile
 import signal
 import datetime
@@ -59,7 +61,7 @@ log = logging.getLogger(__name__)
 the_daemon = None
 #Application daemon/http server implementation
 class AppDaemon(Daemon):
-	def __init__(self, yaml, app_path, server_key, port, master_addr, master_port):
+	def __init__(self, yaml, app_path, server_key, port, master_addr, master_port, processes=1):
 		#check instance
 		global the_daemon
 		if the_daemon:
@@ -71,6 +73,13 @@ class AppDaemon(Daemon):
 		self.port = int(port)
 		self.master_addr = master_addr
 		self.master_port = master_port
+		# number of pre-forked worker processes; 0 means one per core
+		self.processes = int(processes)
+		if self.processes <= 0:
+			self.processes = multiprocessing.cpu_count()
+		self.is_worker = False
+		self.workers = {}
+		self.stopping = False
 
 		self.logfile = os.path.join(self.app_path, 'logfile')
 		self.pidfile = os.path.join(self.app_path, 'pidfile')
@@ -95,11 +104,78 @@ class AppDaemon(Daemon):
 		log.info('stopping Tornado ioloop')
 		tornado.ioloop.IOLoop.instance().add_timeout(time() + 2, tornado.ioloop.IOLoop.instance().stop)
 		log.info('http server stoped gracefully')
+		if not self.is_worker:
+			try:
+				self.delpid()
+			except OSError:
+				pass
+		sys.exit(0)
+
+	def spawn_worker(self):
+		"""Forks a worker process serving the already bound socket.
+		Returns True in the worker and False in the parent.
+		"""
+		pid = os.fork()
+		if pid == 0:
+			self.is_worker = True
+			self.workers = {}
+			return True
+		self.workers[pid] = time()
+		log.info('started worker process %d', pid)
+		return False
+
+	def stop_workers(self, signum, frame):
+		"""SIGTERM handler of the parent: stops every worker process
+		"""
+		self.stopping = True
+		for pid in self.workers.keys():
+			try:
+				os.kill(pid, signal.SIGTERM)
+			except OSError:
+				pass
+
+	def run_workers(self):
+		"""Forks self.processes workers sharing the listening socket and
+		restarts any that exit until the parent receives SIGTERM.
+
+		The app configuration and stubs are loaded before this is called, so
+		the workers share the imported modules copy-on-write. Returns True in
+		a worker, and False in the parent once every worker has stopped.
+		"""
+		signal.signal(signal.SIGTERM, self.stop_workers)
+		log.info('pre-forking %d worker processes', self.processes)
+		for i in range(self.processes):
+			if self.spawn_worker():
+				return True
+		while self.workers:
+			try:
+				pid, status = os.wait()
+			except KeyboardInterrupt:
+				self.stop_workers(signal.SIGINT, None)
+				continue
+			except OSError, e:
+				if e.errno == errno.EINTR:
+					continue
+				raise
+			started = self.workers.pop(pid, None)
+			if started is None:
+				continue
+			if self.stopping:
+				log.info('worker process %d stopped', pid)
+				continue
+			log.error('worker process %d exited with status %d, restarting',
+					pid, status)
+			# do not spin when a worker dies at startup
+			if time() - started < 1:
+				sleep(1)
+			if self.spawn_worker():
+				return True
+		log.info('all worker processes stopped')
 		try:
 			self.delpid()
 		except OSError:
 			pass
-		sys.exit(0)
+		return False
 
 	def run_application(self):
 		log.debug('pidfile: %s' % self.pidfile)
@@ -145,6 +221,7 @@ class AppDaemon(Daemon):
 			cpu_monitor_interval = int(option_dict.get('cpu_monitor_interval', 1000))
 
 			option_dict['root_path'] = os.path.realpath(self.app_path)
+			option_dict['require_indexes'] = require_indexes
 			option_dict['login_url'] = login_url
 			option_dict['datastore_path'] = os.path.join(tempfile.gettempdir(),
 														'dev_appserver.datastore')
@@ -190,8 +267,6 @@ class AppDaemon(Daemon):
 				"""
 				self.stop_application()
 
-			signal.signal(signal.SIGTERM, stop_gracefully)
-
 			log.info('Running application %s on port %d: http://%s:%d',
 					config.application, self.port, serve_address, self.port)
 
@@ -202,7 +277,14 @@ class AppDaemon(Daemon):
 			cpu_monitor = functools.partial(monitor_cpu_mcycles, self.master_addr, self.master_port, yaml.application, mcycles_limit, cpu_monitor_interval)
 
 			try:
-				self.http_server.listen(self.port)
+				self.http_server.bind(self.port)
+				if self.processes > 1:
+					if tornado.ioloop.IOLoop.initialized():
+						log.error('IOLoop already initialized, cannot pre-fork workers')
+					elif not self.run_workers():
+						return
+				signal.signal(signal.SIGTERM, stop_gracefully)
+				self.http_server.start(1)
 				io_loop = tornado.ioloop.IOLoop.instance()
 				# set periodic callbacks for api and log reporter.
 				self.log_callback = tornado.ioloop.PeriodicCallback(log_reporter, 5000)
@@ -292,6 +374,8 @@ if __name__ == '__main__':
 	parser.add_option("-r", "--revision",  help="Application revision")
 	parser.add_option("-p", "--port",  help="Listen port number")
 	parser.add_option("-k", "--key",  help="Server key")
+	parser.add_option("--processes", type="int", default=1,
+						help="Worker processes sharing the port, 0 for one per core. Default: 1")
 
 	parser.add_option("-s", "--start", action="store_true", default=False,
 						help="Sends START command")
@@ -383,7 +467,7 @@ if __name__ == '__main__':
 			os.makedirs(app_path)
 
 		if options.start:
-			daemon = AppDaemon(yaml, app_path, options.key, options.port, yaml.master_address, yaml.master_port)
+			daemon = AppDaemon(yaml, app_path, options.key, options.port, yaml.master_address, yaml.master_port, options.processes)
 			if not options.key:
 				print 'Error: Required argument --key is missing'
 				parser.print_help()
@@ -418,7 +502,7 @@ if __name__ == '__main__':
 			print 'Debugging Production App Server:	 Application %s rev.%s on port %s' % (options.name,
 														options.revision,
 														options.port)
-			daemon = AppDaemon(yaml, app_path, options.key, options.port, yaml.master_address, yaml.master_port)
+			daemon = AppDaemon(yaml, app_path, options.key, options.port, yaml.master_address, yaml.master_port, options.processes)
 			daemon.run_application()
 
 		elif options.log:
@@ -304,6 +304,30 @@ def get_pid(app_root):
         return 0
 
 
+def appserver_config():
+    """Returns the appserver.yaml configuration."""
+    appserver_yaml = os.path.join(os.path.dirname(
+                                    os.path.abspath(appserver.__file__)),
+                                  'appserver.yaml')
+    return ApplicationConfiguration(appserver_yaml)
+
+
+def backfill_indexes(app_dir):
+    """Writes datastore index rows for the entities an application stored
+    before its indexes existed.
+    """
+    from cyclozzo.apps.datastore import datastore_hypertable_thrift
+    app_yaml = ApplicationConfiguration(os.path.join(app_dir, 'app.yaml'))
+    config = appserver_config()
+    stub = datastore_hypertable_thrift.HypertableStub(
+                        app_yaml.application,
+                        thrift_address=config.thrift_address or '127.0.0.1',
+                        thrift_port=int(config.thrift_port or 38080),
+                        app_root=os.path.abspath(app_dir))
+    count = stub.BackfillIndexes()
+    print '--> Indexed %d entities of %s' % (count, app_yaml.application)
+
+
 def main():
     """Commandline utility for configuring Cyclozzo Nodes.
     """
@@ -340,6 +364,10 @@ def main():
                       'Options: [cluster, application]',
                       choices=['cluster', 'application'])
 
+    parser.add_option('--backfill-indexes', action='store_true', default=False,
+                      help='Build datastore indexes for existing application ' \
+                      'data', dest='backfill_indexes')
+
     parser.add_option('--dir',  help='Application Directory', dest='app_dir')
     parser.add_option('--port', help='Listen port number', type='int')
     parser.add_option('--debug', action='store_true', default=False,
@@ -398,14 +426,7 @@ def main():
         else:
             print 'Starting application from %s on port %d' % \
                             (options.app_dir, options.port)
-            appserver_yaml = os.path.join(
-                                          os.path.dirname(                                                     
-                                                    os.path.abspath(
-                                                    appserver.__file__
-                                                    )
-                                                          ), 
-                                          'appserver.yaml')
-            appserver_yaml = ApplicationConfiguration(appserver_yaml)
+            appserver_yaml = appserver_config()
             if options.debug:
                 appserver_yaml.debug_mode = True
             daemon = AppDaemon(appserver_yaml, 
@@ -446,6 +467,12 @@ def main():
             print 'Application is not running'
     elif options.status == 'cluster':
         print 'Cluster status not available.'
+    elif options.backfill_indexes:
+        if not options.app_dir:
+            print 'Missing arguments: --dir'
+            parser.print_help()
+        else:
+            backfill_indexes(options.app_dir)
     else:
         parser.print_help()
 
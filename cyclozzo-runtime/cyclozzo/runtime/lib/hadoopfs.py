@@ -20,7 +20,7 @@ from cyclozzo.runtime.lib.genhadoopfs.ttypes import FileStatus, Pathname
 from thrift import Thrift
 from thrift.transport import TSocket
 from thrift.transport import TTransport
-from thrift.protocol import TBinaryProtocol
+from cyclozzo.runtime.lib.thriftclient import ProtocolFactory
 
 log = logging.getLogger(__name__)
 
@@ -33,7 +33,7 @@ class HadoopClient(ThriftHadoopFileSystem.Client):
 		socket = TSocket.TSocket(host, port)
 		socket.setTimeout(timeout_ms)
 		self.transport = TTransport.TBufferedTransport(socket)
-		protocol = TBinaryProtocol.TBinaryProtocol(self.transport)
+		protocol = ProtocolFactory().getProtocol(self.transport)
 		ThriftHadoopFileSystem.Client.__init__(self, protocol)
 
 		if do_open:
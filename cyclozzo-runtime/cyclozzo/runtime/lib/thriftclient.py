@@ -12,19 +12,54 @@
 #   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
 #   GNU General Public License for more details.
 #
-from thrift import Thrift
+import os
+import sys
+import time
+import socket
+import logging
+import threading
+
 from thrift.transport import TSocket
 from thrift.transport import TTransport
 from thrift.protocol import TBinaryProtocol
+try:
+  from thrift.protocol import fastbinary
+except ImportError:
+  fastbinary = None
 
 from cyclozzo.hyperthrift.gen2 import HqlService
 
+log = logging.getLogger(__name__)
+
+# errors after which a connection can no longer be trusted; exceptions the
+# broker raises, such as ClientException, leave the connection usable.
+_CONNECTION_ERRORS = (TTransport.TTransportException,
+                      socket.error,
+                      EOFError)
+
+def ProtocolFactory(accelerated=True):
+  """Returns the Thrift protocol factory for new connections.
+
+  With the accelerated binary protocol the generated code hands whole
+  structs to the fastbinary C module instead of reading and writing them
+  field by field in Python. It is only used when fastbinary could be
+  imported, as the pure Python protocol is faster than the accelerated one
+  falling back to it.
+  """
+  if accelerated and fastbinary is not None:
+    return TBinaryProtocol.TBinaryProtocolAcceleratedFactory()
+  return TBinaryProtocol.TBinaryProtocolFactory()
+
+
 class ThriftClient(HqlService.Client):
-  def __init__(self, host, port, timeout_ms = 300000, do_open = 1):
+  def __init__(self, host, port, timeout_ms = 300000, do_open = 1,
+               protocol_factory = None):
     socket = TSocket.TSocket(host, port)
     socket.setTimeout(timeout_ms)
     self.transport = TTransport.TFramedTransport(socket)
-    protocol = TBinaryProtocol.TBinaryProtocol(self.transport)
+    if protocol_factory is None:
+      protocol_factory = ProtocolFactory()
+    protocol = protocol_factory.getProtocol(self.transport)
     HqlService.Client.__init__(self, protocol)
 
     if do_open:
@@ -37,3 +72,238 @@ class ThriftClient(HqlService.Client):
   def close(self):
     if self.do_close:
       self.transport.close()
+
+
+class _PooledClient(object):
+  """Proxy handed out by ThriftClientPool.
+
+  Calls are forwarded to the underlying ThriftClient. A transport level
+  failure marks the connection as broken so that close() drops it instead
+  of handing it back to the pool. If the first call made through the proxy
+  fails that way, the connection most likely went stale while it sat in the
+  pool; as nothing on the broker can be tied to it yet, the call is retried
+  once on a newly dialed connection.
+  """
+  def __init__(self, pool, client):
+    self._pool = pool
+    self._client = client
+    self._retry = True
+    self.broken = False
+
+  def __getattr__(self, name):
+    attr = getattr(self._client, name)
+    if name.startswith('_') or not callable(attr):
+      return attr
+
+    def call(*args, **kwargs):
+      retry, self._retry = self._retry, False
+      try:
+        return getattr(self._client, name)(*args, **kwargs)
+      except _CONNECTION_ERRORS:
+        self.broken = True
+        if not retry:
+          raise
+        log.debug('retrying %s on a new thrift connection' % name,
+                  exc_info=True)
+      stale, self._client = self._client, None
+      self._pool.put(stale, discard=True)
+      self._client = self._pool._Dial()
+      self.broken = False
+      try:
+        return getattr(self._client, name)(*args, **kwargs)
+      except _CONNECTION_ERRORS:
+        self.broken = True
+        raise
+    return call
+
+  def close(self):
+    """Return the connection to the pool it was borrowed from."""
+    if self._client is not None:
+      client, self._client = self._client, None
+      self._pool.put(client, discard=self.broken)
+
+
+class ThriftClientPool(object):
+  """A thread-safe pool of long-lived ThriftClient connections.
+
+  Connections are borrowed with get() and returned by calling close() on the
+  borrowed client. At most `size` idle connections are kept open; callers are
+  never blocked, a fresh connection is dialed when the pool is empty. A
+  process forked from the one that created the pool starts with no idle
+  connections, as the inherited sockets are shared with the parent.
+
+  Args:
+    host: ThriftBroker host
+    port: ThriftBroker port
+    size: maximum number of idle connections kept open
+    timeout_ms: socket timeout for each connection
+    idle_timeout: seconds after which an unused connection is closed
+    check_interval: idle seconds after which a connection is health checked
+      before it is handed out again
+    protocol_factory: Thrift protocol factory of the connections, by default
+      the accelerated binary protocol if fastbinary is available
+  """
+  def __init__(self, host, port, size=8, timeout_ms=300000,
+               idle_timeout=300, check_interval=30, protocol_factory=None):
+    self.host = host
+    self.port = port
+    self.protocol_factory = protocol_factory or ProtocolFactory()
+    self.size = size
+    self.timeout_ms = timeout_ms
+    self.idle_timeout = idle_timeout
+    self.check_interval = check_interval
+    self._idle = []
+    self._pid = os.getpid()
+    self._lock = threading.Lock()
+    self._stats = dict.fromkeys(('hits', 'misses', 'evictions', 'errors'), 0)
+
+  def _Count(self, name, value=1):
+    self._lock.acquire()
+    try:
+      self._stats[name] += value
+    finally:
+      self._lock.release()
+
+  def _Dial(self):
+    return ThriftClient(self.host, self.port, self.timeout_ms,
+                        protocol_factory=self.protocol_factory)
+
+  def _IsHealthy(self, client):
+    try:
+      client.exists_namespace('/')
+      return True
+    except Exception:
+      return False
+
+  def _EvictIdle(self, now):
+    """Remove expired connections from the idle list.
+
+    Must be called with self._lock held. Returns the evicted clients, which
+    should be closed after releasing the lock.
+    """
+    expired = [(c, t) for (c, t) in self._idle
+               if now - t > self.idle_timeout]
+    if expired:
+      self._idle = [(c, t) for (c, t) in self._idle
+                    if now - t <= self.idle_timeout]
+      self._stats['evictions'] += len(expired)
+    return [c for (c, t) in expired]
+
+  def get(self):
+    """Borrow a connection from the pool, dialing a new one on a miss."""
+    while True:
+      now = time.time()
+      self._lock.acquire()
+      try:
+        if self._pid != os.getpid():
+          self._idle = []
+          self._pid = os.getpid()
+        expired = self._EvictIdle(now)
+        if self._idle:
+          client, last_used = self._idle.pop()
+        else:
+          client = None
+      finally:
+        self._lock.release()
+      for c in expired:
+        _Close(c)
+
+      if client is None:
+        self._Count('misses')
+        return _PooledClient(self, self._Dial())
+
+      if now - last_used > self.check_interval and not self._IsHealthy(client):
+        self._Count('errors')
+        _Close(client)
+        continue
+      self._Count('hits')
+      return _PooledClient(self, client)
+
+  def put(self, client, discard=False):
+    """Give a connection back to the pool.
+
+    Args:
+      client: a ThriftClient previously borrowed with get()
+      discard: close the connection instead of keeping it, e.g. after a
+        transport error left it in an unknown state
+    """
+    if not discard:
+      self._lock.acquire()
+      try:
+        if len(self._idle) < self.size and self._pid == os.getpid():
+          self._idle.append((client, time.time()))
+          return
+      finally:
+        self._lock.release()
+    else:
+      self._Count('errors')
+    _Close(client)
+
+  def stats(self):
+    """Returns a dict of pool counters (hits, misses, evictions, errors, idle)."""
+    self._lock.acquire()
+    try:
+      stats = dict(self._stats)
+      stats['idle'] = len(self._idle)
+    finally:
+      self._lock.release()
+    return stats
+
+  def clear(self):
+    """Close every idle connection."""
+    self._lock.acquire()
+    try:
+      idle, self._idle = self._idle, []
+    finally:
+      self._lock.release()
+    for client, last_used in idle:
+      _Close(client)
+
+
+def _Close(client):
+  try:
+    client.close()
+  except Exception:
+    log.debug('error while closing thrift connection', exc_info=True)
+
+
+def BenchmarkDecode(count=100000):
+  """Times decoding a next_cells reply of count Cells with the pure Python
+  and the accelerated binary protocols.
+
+  Returns:
+    list of (protocol name, seconds), without the accelerated protocol if
+    fastbinary is not available.
+  """
+  from cyclozzo.hyperthrift.gen import ClientService
+  from cyclozzo.hyperthrift.gen.ttypes import Cell, Key
+
+  cells = [Cell(Key(row='%016x' % i, column_family='entity',
+                    column_qualifier='', timestamp=1300000000000000000 + i,
+                    revision=1300000000000000000 + i, flag=255),
+                'v' * 100)
+           for i in xrange(count)]
+  buf = TTransport.TMemoryBuffer()
+  ClientService.next_cells_result(success=cells).write(
+      TBinaryProtocol.TBinaryProtocol(buf))
+  data = buf.getvalue()
+
+  factories = [('pure', ProtocolFactory(False))]
+  if fastbinary is not None:
+    factories.append(('accelerated', ProtocolFactory(True)))
+  timings = []
+  for name, factory in factories:
+    result = ClientService.next_cells_result()
+    start = time.time()
+    result.read(factory.getProtocol(TTransport.TMemoryBuffer(data)))
+    timings.append((name, time.time() - start))
+    assert result.success == cells
+  return timings
+
+
+if __name__ == '__main__':
+  count = 100000
+  if len(sys.argv) > 1:
+    count = int(sys.argv[1])
+  for name, seconds in BenchmarkDecode(count):
+    print '%-12s %d cells in %.3fs' % (name, count, seconds)
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+
+import socket
+import unittest
+
+from thrift import Thrift
+from thrift.transport import TTransport
+
+from cyclozzo.runtime.lib import thriftclient
+
+
+class FakeClient(object):
+  """Stands in for a ThriftClient; fails calls while failures is positive."""
+
+  def __init__(self, number):
+    self.number = number
+    self.closed = False
+    self.failures = 0
+    self.error = TTransport.TTransportException
+    self.calls = 0
+
+  def exists_namespace(self, name):
+    self.calls += 1
+    if self.failures:
+      self.failures -= 1
+      raise self.error('fake failure')
+    return True
+
+  def close(self):
+    self.closed = True
+
+
+class FakePool(thriftclient.ThriftClientPool):
+
+  def __init__(self, **kwargs):
+    thriftclient.ThriftClientPool.__init__(self, 'localhost', 38080, **kwargs)
+    self.dialed = []
+
+  def _Dial(self):
+    client = FakeClient(len(self.dialed))
+    self.dialed.append(client)
+    return client
+
+
+class ThriftClientPoolTestCase(unittest.TestCase):
+
+  def test_borrow_and_return(self):
+    pool = FakePool()
+    client = pool.get()
+    self.assertTrue(client.exists_namespace('/'))
+    client.close()
+    client.close()
+    self.assertEqual(pool.stats()['idle'], 1)
+
+    client = pool.get()
+    self.assertTrue(client._client is pool.dialed[0])
+    client.close()
+    self.assertEqual(len(pool.dialed), 1)
+    stats = pool.stats()
+    self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+
+  def test_size_bounds_idle_connections(self):
+    pool = FakePool(size=2)
+    clients = [pool.get() for i in range(3)]
+    for client in clients:
+      client.close()
+    self.assertEqual(pool.stats()['idle'], 2)
+    self.assertTrue(pool.dialed[2].closed)
+
+  def test_idle_timeout(self):
+    pool = FakePool(idle_timeout=-1)
+    pool.get().close()
+    client = pool.get()
+    self.assertTrue(pool.dialed[0].closed)
+    self.assertTrue(client._client is pool.dialed[1])
+    self.assertEqual(pool.stats()['evictions'], 1)
+
+  def test_stale_connection_is_retried_once(self):
+    pool = FakePool()
+    pool.get().close()
+    pool.dialed[0].failures = 1
+    client = pool.get()
+    self.assertTrue(client.exists_namespace('/'))
+    self.assertTrue(pool.dialed[0].closed)
+    self.assertTrue(client._client is pool.dialed[1])
+    client.close()
+    self.assertEqual(pool.stats()['idle'], 1)
+
+  def test_transport_error_after_first_call_discards(self):
+    pool = FakePool()
+    client = pool.get()
+    client.exists_namespace('/')
+    pool.dialed[0].failures = 1
+    self.assertRaises(TTransport.TTransportException,
+                      client.exists_namespace, '/')
+    client.close()
+    self.assertTrue(pool.dialed[0].closed)
+    self.assertEqual(pool.stats()['idle'], 0)
+    self.assertEqual(pool.stats()['errors'], 1)
+
+  def test_retry_failure_discards(self):
+    pool = FakePool()
+    pool.get().close()
+    pool.dialed[0].failures = 1
+    client = pool.get()
+    real_dial = pool._Dial
+
+    def dial_failing():
+      fresh = real_dial()
+      fresh.error = socket.error
+      fresh.failures = 1
+      return fresh
+    pool._Dial = dial_failing
+    self.assertRaises(socket.error, client.exists_namespace, '/')
+    client.close()
+    self.assertTrue(pool.dialed[1].closed)
+    self.assertEqual(pool.stats()['idle'], 0)
+
+  def test_application_errors_keep_connection(self):
+    pool = FakePool()
+    client = pool.get()
+    pool.dialed[0].error = Thrift.TApplicationException
+    pool.dialed[0].failures = 1
+    self.assertRaises(Thrift.TApplicationException,
+                      client.exists_namespace, '/')
+    client.close()
+    self.assertEqual(pool.dialed[0].calls, 1)
+    self.assertFalse(pool.dialed[0].closed)
+    self.assertEqual(pool.stats()['idle'], 1)
+
+  def test_fork_drops_idle_connections(self):
+    pool = FakePool()
+    pool.get().close()
+    pool._pid = -1
+    client = pool.get()
+    self.assertTrue(client._client is pool.dialed[1])
+
+  def test_clear(self):
+    pool = FakePool()
+    pool.get().close()
+    pool.clear()
+    self.assertTrue(pool.dialed[0].closed)
+    self.assertEqual(pool.stats()['idle'], 0)
+
+
+if __name__ == '__main__':
+  test_cases = [ThriftClientPoolTestCase,
+               ]
+  for test_case in test_cases:
+    suite = unittest.TestLoader().loadTestsFromTestCase(test_case)
+    unittest.TextTestRunner(verbosity=2).run(suite)
@@ -19,7 +19,96 @@
 
 
 
+import atexit
+import Queue
 import sys
+import threading
+import time
+
+from cyclozzo.apps.runtime import apiproxy_errors
+
+
+_QUEUED = 'queued'
+_RUNNING = 'running'
+_DONE = 'done'
+
+DEFAULT_THREAD_POOL_SIZE = 8
+
+_finished = threading.Condition()
+
+
+class _ThreadPool(object):
+  """A fixed number of daemon threads running functions off a queue.
+
+  The threads are started on first use.
+  """
+
+  def __init__(self, size):
+    self.size = size
+    self.__queue = Queue.Queue()
+    self.__threads = []
+    self.__lock = threading.Lock()
+
+  def Submit(self, function):
+    """Queues function to be called on one of the threads."""
+    if len(self.__threads) < self.size:
+      self.__lock.acquire()
+      try:
+        while len(self.__threads) < self.size:
+          thread = threading.Thread(target=self.__Work,
+                                    name='apiproxy-rpc-%d' % len(self.__threads))
+          thread.setDaemon(True)
+          thread.start()
+          self.__threads.append(thread)
+      finally:
+        self.__lock.release()
+    self.__queue.put(function)
+
+  def Shutdown(self, timeout=1):
+    """Stops the threads once they have run the queued functions, waiting up
+    to timeout seconds for each."""
+    self.__lock.acquire()
+    try:
+      threads, self.__threads, self.size = self.__threads, [], 0
+    finally:
+      self.__lock.release()
+    for thread in threads:
+      self.__queue.put(None)
+    for thread in threads:
+      thread.join(timeout)
+
+  def __Work(self):
+    while True:
+      function = self.__queue.get()
+      if function is None:
+        return
+      function()
+
+
+def SetThreadPoolSize(size):
+  """Sets how many threads run the calls of thread-safe stubs in the
+  background, DEFAULT_THREAD_POOL_SIZE unless set, or 0 to run every call
+  when it is waited on.
+
+  Meant to be called once, before any calls are made.
+  """
+  global _pool
+  if _pool is not None:
+    _pool.Shutdown()
+  if size > 0:
+    _pool = _ThreadPool(size)
+  else:
+    _pool = None
+
+
+def _Shutdown():
+  if _pool is not None:
+    _pool.Shutdown()
+
+
+_pool = _ThreadPool(DEFAULT_THREAD_POOL_SIZE)
+
+atexit.register(_Shutdown)
 
 
 class RPC(object):
@@ -28,6 +117,10 @@ class RPC(object):
   To implement a RPC to make real asynchronous API call:
     - Extend this class.
     - Override _MakeCallImpl and/or _WaitImpl to do a real asynchronous call.
+
+  Calls to a stub whose THREADSAFE attribute is true are run on the thread
+  pool configured with SetThreadPoolSize, so that several of them overlap;
+  otherwise, and for synchronous calls, the call runs when it is waited on.
   """
 
   IDLE = 0
@@ -50,10 +143,16 @@ class RPC(object):
       deadline: A double specifying the deadline for this call as the number of
                 seconds from the current time. Ignored if non-positive.
       stub: APIProxyStub instance, used in default _WaitImpl to do real call
+
+    Public properties:
+      synchronous: whether the caller waits on the call as soon as it is
+        made, in which case it runs in the caller's thread
     """
     self.__exception = None
     self.__state = RPC.IDLE
     self.__traceback = None
+    self.__job = None
+    self.__expires = None
 
     self.package = package
     self.call = call
@@ -62,6 +161,7 @@ class RPC(object):
     self.callback = callback
     self.deadline = deadline
     self.stub = stub
+    self.synchronous = False
     self.cpu_usage_mcycles = 0
 
   def Clone(self):
@@ -134,6 +234,12 @@ class RPC(object):
   def _MakeCallImpl(self):
     """Override this method to implement a real asynchronous call rpc."""
     self.__state = RPC.RUNNING
+    if self.deadline > 0:
+      self.__expires = time.time() + self.deadline
+    if (_pool is not None and not self.synchronous and
+        getattr(self.stub, 'THREADSAFE', False)):
+      self.__job = _QUEUED
+      _pool.Submit(self.__Run)
 
   def _WaitImpl(self):
     """Override this method to implement a real asynchronous call rpc.
@@ -141,18 +247,138 @@ class RPC(object):
     Returns:
       True if the async call was completed successfully.
     """
+    if self.__job is not None:
+      return self.__WaitForJob()
     try:
+      self.__job = _RUNNING
+      self.__Call()
+    finally:
+      self.__state = RPC.FINISHING
+      self.__Callback()
+
+    return True
+
+  def __WaitForJob(self):
+    """Waits for a call queued on the thread pool, running it in this thread
+    instead if no pool thread has started it yet.
+
+    Raises:
+      Exception of the callback, if any.
+    """
+    try:
+      _finished.acquire()
       try:
-        self.stub.MakeSyncCall(self.package, self.call,
-                               self.request, self.response)
-      except Exception:
-        _, self.__exception, self.__traceback = sys.exc_info()
+        claimed = self.__job == _QUEUED
+        if claimed:
+          self.__job = _RUNNING
+        while not claimed and self.__job != _DONE:
+          if self.__expires is None:
+            _finished.wait()
+            continue
+          remaining = self.__expires - time.time()
+          if remaining > 0:
+            _finished.wait(remaining)
+          else:
+            self.__job = _DONE
+            self.__exception = self.__DeadlineExceeded()
+            self.__traceback = None
+      finally:
+        _finished.release()
+      if claimed:
+        self.__Call()
     finally:
       self.__state = RPC.FINISHING
       self.__Callback()
 
     return True
 
+  def __Run(self):
+    """Runs the call on a pool thread, unless a waiter has claimed it."""
+    _finished.acquire()
+    try:
+      if self.__job != _QUEUED:
+        return
+      self.__job = _RUNNING
+    finally:
+      _finished.release()
+    self.__Call()
+
+  def __Call(self):
+    """Makes the call to the stub and records its outcome, unless the call
+    has passed its deadline in the meantime.
+
+    A call that is only started after its deadline is not made, and one that
+    runs past it fails with DeadlineExceededError, wherever it runs.
+    """
+    exc_info = (None, None, None)
+    if self.__Expired():
+      exc_info = (None, self.__DeadlineExceeded(), None)
+    else:
+      try:
+        self.stub.MakeSyncCall(self.package, self.call,
+                               self.request, self.response)
+      except Exception:
+        exc_info = sys.exc_info()
+      if self.__Expired():
+        exc_info = (None, self.__DeadlineExceeded(), None)
+    _finished.acquire()
+    try:
+      if self.__job != _DONE:
+        self.__job = _DONE
+        _, self.__exception, self.__traceback = exc_info
+      _finished.notifyAll()
+    finally:
+      _finished.release()
+
+  def __Expired(self):
+    return self.__expires is not None and time.time() >= self.__expires
+
+  def __DeadlineExceeded(self):
+    return apiproxy_errors.DeadlineExceededError(
+        'The API call %s.%s() took too long to respond and was '
+        'cancelled.' % (self.package, self.call))
+
+  @staticmethod
+  def WaitAny(rpcs):
+    """Picks an RPC to wait on among several, blocking as long as all of
+    them are running on the thread pool.
+
+    Finished calls are picked first, then calls this thread can run itself:
+    those still queued on the pool and those not run on the pool at all.
+
+    Args:
+      rpcs: list of RPC instances that have been started.
+
+    Returns:
+      an RPC instance, or None if rpcs is empty.
+    """
+    _finished.acquire()
+    try:
+      while rpcs:
+        runnable = None
+        expires = None
+        for rpc in rpcs:
+          if rpc.__state == RPC.FINISHING or rpc.__job == _DONE:
+            return rpc
+          if rpc.__job != _RUNNING:
+            runnable = runnable or rpc
+          elif rpc.__expires is not None:
+            expires = min(expires or rpc.__expires, rpc.__expires)
+        if runnable is not None:
+          return runnable
+        if expires is None:
+          _finished.wait()
+          continue
+        remaining = expires - time.time()
+        if remaining <= 0:
+          for rpc in rpcs:
+            if rpc.__expires == expires:
+              return rpc
+        _finished.wait(remaining)
+      return None
+    finally:
+      _finished.release()
+
   def __Callback(self):
     if self.callback:
       try:
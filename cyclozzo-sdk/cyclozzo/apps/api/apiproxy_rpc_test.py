@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+
+import threading
+import time
+import unittest
+
+from cyclozzo.apps.api import apiproxy_rpc
+from cyclozzo.apps.runtime import apiproxy_errors
+
+
+class FakeStub(object):
+  """Runs calls named 'block' until released, 'sleep' for a while, and any
+  other call at once, recording the thread each call ran in."""
+
+  THREADSAFE = True
+
+  def __init__(self):
+    self.release = threading.Event()
+    self.threads = {}
+
+  def MakeSyncCall(self, service, call, request, response):
+    self.threads[request] = threading.currentThread()
+    if call == 'block':
+      self.release.wait(5)
+    elif call == 'sleep':
+      time.sleep(0.2)
+
+
+class RPCTestCase(unittest.TestCase):
+
+  def setUp(self):
+    apiproxy_rpc.SetThreadPoolSize(1)
+    self.stub = FakeStub()
+
+  def tearDown(self):
+    self.stub.release.set()
+    apiproxy_rpc.SetThreadPoolSize(apiproxy_rpc.DEFAULT_THREAD_POOL_SIZE)
+
+  def Call(self, call, request, deadline=None, synchronous=False):
+    rpc = apiproxy_rpc.RPC(stub=self.stub)
+    rpc.synchronous = synchronous
+    rpc.MakeCall('test', call, request, None, deadline=deadline)
+    return rpc
+
+  def Started(self, call, request, deadline=None):
+    """Makes an asynchronous call and waits for the pool to start it."""
+    rpc = self.Call(call, request, deadline)
+    for i in range(100):
+      if request in self.stub.threads:
+        break
+      time.sleep(0.01)
+    return rpc
+
+  def Finish(self, rpc):
+    rpc.Wait()
+    rpc.CheckSuccess()
+
+  def test_synchronous_calls_run_inline(self):
+    rpc = self.Call('quick', 'sync', synchronous=True)
+    time.sleep(0.05)
+    self.assertFalse('sync' in self.stub.threads)
+    self.Finish(rpc)
+    self.assertTrue(self.stub.threads['sync'] is threading.currentThread())
+
+  def test_asynchronous_calls_run_on_the_pool(self):
+    rpc = self.Started('quick', 'async')
+    self.Finish(rpc)
+    self.assertFalse(self.stub.threads['async'] is threading.currentThread())
+
+  def test_waiter_runs_queued_call(self):
+    blocking = self.Started('block', 'blocking')
+    queued = self.Call('quick', 'queued')
+    self.Finish(queued)
+    self.assertTrue(self.stub.threads['queued'] is threading.currentThread())
+    self.stub.release.set()
+    self.Finish(blocking)
+
+  def test_deadline_while_running_on_the_pool(self):
+    rpc = self.Started('block', 'blocking', deadline=0.1)
+    start = time.time()
+    rpc.Wait()
+    self.assertTrue(time.time() - start < 1)
+    self.assertRaises(apiproxy_errors.DeadlineExceededError, rpc.CheckSuccess)
+    self.stub.release.set()
+
+  def test_deadline_of_call_run_by_its_waiter(self):
+    rpc = self.Call('sleep', 'sleeping', deadline=0.05, synchronous=True)
+    rpc.Wait()
+    self.assertTrue('sleeping' in self.stub.threads)
+    self.assertRaises(apiproxy_errors.DeadlineExceededError, rpc.CheckSuccess)
+
+  def test_expired_queued_call_is_not_made(self):
+    blocking = self.Started('block', 'blocking')
+    queued = self.Call('quick', 'queued', deadline=0.05)
+    time.sleep(0.1)
+    queued.Wait()
+    self.assertRaises(apiproxy_errors.DeadlineExceededError,
+                      queued.CheckSuccess)
+    self.assertFalse('queued' in self.stub.threads)
+    self.stub.release.set()
+    self.Finish(blocking)
+
+  def test_wait_any(self):
+    self.assertEqual(apiproxy_rpc.RPC.WaitAny([]), None)
+
+    # a call queued behind a running one can be run by the waiter
+    blocking = self.Started('block', 'blocking')
+    queued = self.Call('quick', 'queued')
+    self.assertTrue(apiproxy_rpc.RPC.WaitAny([blocking, queued]) is queued)
+    self.Finish(queued)
+
+    # finished calls come first
+    self.assertTrue(apiproxy_rpc.RPC.WaitAny([blocking, queued]) is queued)
+
+    # with every call running, it blocks until one finishes
+    threading.Timer(0.1, self.stub.release.set).start()
+    self.assertTrue(apiproxy_rpc.RPC.WaitAny([blocking]) is blocking)
+    self.Finish(blocking)
+
+  def test_wait_any_returns_expired_call(self):
+    blocking = self.Started('block', 'blocking', deadline=0.1)
+    start = time.time()
+    self.assertTrue(apiproxy_rpc.RPC.WaitAny([blocking]) is blocking)
+    self.assertTrue(time.time() - start < 1)
+    blocking.Wait()
+    self.assertRaises(apiproxy_errors.DeadlineExceededError,
+                      blocking.CheckSuccess)
+
+  def test_without_pool(self):
+    apiproxy_rpc.SetThreadPoolSize(0)
+    rpc = self.Call('quick', 'unpooled')
+    self.assertTrue(apiproxy_rpc.RPC.WaitAny([rpc]) is rpc)
+    self.Finish(rpc)
+    self.assertTrue(self.stub.threads['unpooled'] is threading.currentThread())
+
+
+if __name__ == '__main__':
+  test_cases = [RPCTestCase,
+               ]
+  for test_case in test_cases:
+    suite = unittest.TestLoader().loadTestsFromTestCase(test_case)
+    unittest.TextTestRunner(verbosity=2).run(suite)
@@ -35,8 +35,12 @@ class APIProxyStub(object):
     - Extend this class.
     - Override __init__ to pass in appropriate default service name.
     - Implement service methods as _Dynamic_<method>(request, response).
+    - Set THREADSAFE if the service methods may run concurrently, so that
+      asynchronous calls to the stub overlap on apiproxy_rpc's thread pool.
   """
 
+  THREADSAFE = False
+
   def __init__(self, service_name, max_request_size=MAX_REQUEST_SIZE):
     """Constructor.
 
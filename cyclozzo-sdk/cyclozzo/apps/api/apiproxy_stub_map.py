@@ -278,6 +278,7 @@ class APIProxyStubMap(object):
     assert stub, 'No api proxy found for service "%s"' % service
     if hasattr(stub, 'CreateRPC'):
       rpc = stub.CreateRPC()
+      rpc.synchronous = True
       self.__precall_hooks.Call(service, call, request, response, rpc)
       try:
         rpc.MakeCall(service, call, request, response)
@@ -394,6 +395,16 @@ class UserRPC(object):
     """Return the deadline, if set explicitly (otherwise None)."""
     return self.__rpc.deadline
 
+  def __get_synchronous(self):
+    return self.__rpc.synchronous
+
+  def __set_synchronous(self, synchronous):
+    self.__rpc.synchronous = synchronous
+
+  synchronous = property(__get_synchronous, __set_synchronous, doc=
+      """Whether wait() is called right after make_call(), so that the call
+      runs in the waiting thread rather than on the thread pool.""")
+
   @property
   def request(self):
     """Return the request protocol buffer object."""
@@ -583,6 +594,11 @@ class UserRPC(object):
       return finished
     if running is None:
       return None
+    ready = apiproxy_rpc.RPC.WaitAny([rpc.__rpc for rpc in rpcs])
+    for rpc in rpcs:
+      if rpc.__rpc is ready:
+        running = rpc
+        break
     try:
       cls.__local.may_interrupt_wait = True
       try:
@@ -183,6 +183,7 @@ def _MakeSyncCall(service, call, request, response, rpc=None):
   if not rpc:
     rpc = CreateRPC(service)
 
+  rpc.synchronous = True
   rpc.make_call(call, request, response)
   rpc.wait()
   rpc.check_success()
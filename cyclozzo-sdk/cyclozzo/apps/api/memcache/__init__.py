@@ -68,6 +68,8 @@ STAT_BYTE_HITS = 'byte_hits'
 STAT_ITEMS = 'items'
 STAT_BYTES = 'bytes'
 STAT_OLDEST_ITEM_AGES = 'oldest_item_age'
+STAT_NEAR_CACHE_HIT_RATIO = 'near_cache_hit_ratio'
+STAT_REMOTE_HIT_RATIO = 'remote_hit_ratio'
 
 FLAG_TYPE_MASK = 7
 FLAG_COMPRESSED = 1 << 3
@@ -356,6 +358,12 @@ class Client(object):
           item will survive in the cache without being accessed. This is
           _not_ the amount of time that has elapsed since the item was
           created.
+        near_cache_hit_ratio: Fraction of get lookups served from the
+          per-process near cache. Only present when the memcache stub has
+          one.
+        remote_hit_ratio: Fraction of the get lookups that missed the near
+          cache which memcached served. Only present when the memcache stub
+          has a near cache.
 
       On error, returns None.
     """
@@ -377,7 +385,7 @@ class Client(object):
       }
 
     stats = response.stats()
-    return {
+    result = {
       STAT_HITS: stats.hits(),
       STAT_MISSES: stats.misses(),
       STAT_BYTE_HITS: stats.byte_hits(),
@@ -385,6 +393,11 @@ class Client(object):
       STAT_BYTES: stats.bytes(),
       STAT_OLDEST_ITEM_AGES: stats.oldest_item_age(),
     }
+    if stats.has_near_cache_hit_ratio():
+      result[STAT_NEAR_CACHE_HIT_RATIO] = stats.near_cache_hit_ratio()
+    if stats.has_remote_hit_ratio():
+      result[STAT_REMOTE_HIT_RATIO] = stats.remote_hit_ratio()
+    return result
 
   def flush_all(self):
     """Deletes everything in memcache.
@@ -19,18 +19,25 @@
 # uses the python-memcached library to interface with memcached
 # tested with python-memcached 1.40, from apt-get
 
+import collections
 import memcache
+import socket
+import threading
 import time
 import os
 
 from cyclozzo.apps.api import apiproxy_stub
+from cyclozzo.apps.api.memcache import memcache_ring
 from cyclozzo.apps.api.memcache import memcache_service_pb
 
 MemcacheSetResponse = memcache_service_pb.MemcacheSetResponse
 MemcacheSetRequest = memcache_service_pb.MemcacheSetRequest
 MemcacheIncrementRequest = memcache_service_pb.MemcacheIncrementRequest
+MemcacheIncrementResponse = memcache_service_pb.MemcacheIncrementResponse
 MemcacheDeleteResponse = memcache_service_pb.MemcacheDeleteResponse
 
+DEFAULT_PORT = 11211
+
 class CacheEntry(object):
   """An entry in the cache."""
 
@@ -90,25 +97,271 @@ class CacheEntry(object):
     return self.locked and not self.CheckExpired()
 
 
+class NearCache(object):
+  """A per-process LRU of memcache values in front of memcached.
+
+  Entries live for at most ttl seconds, which bounds how stale a value can
+  be after another process changes it in memcached; changes made through
+  this process update the near cache as they go out. The least recently
+  used entries are dropped once the keys and values together take more
+  than max_bytes.
+  """
+
+  def __init__(self, max_bytes, ttl=5, namespaces=None, gettime=time.time):
+    """Initializer.
+
+    Args:
+      max_bytes: Size budget of the cached keys and values.
+      ttl: Whole seconds an entry may be served from the near cache.
+      namespaces: The app namespaces to cache, or None for all of them.
+      gettime: time.time()-like function used for testing.
+    """
+    assert isinstance(ttl, (int, long)) and ttl > 0
+    self._gettime = gettime
+    self._max_bytes = max_bytes
+    self._ttl = ttl
+    if namespaces is not None:
+      namespaces = frozenset(namespaces)
+    self._namespaces = namespaces
+    # internal key -> CacheEntry, least recently used first.
+    self._entries = collections.OrderedDict()
+    self._bytes = 0
+    self._lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+    self.byte_hits = 0
+    self.evictions = 0
+
+  def Caches(self, namespace):
+    """Returns True if keys of the namespace go through the near cache."""
+    return self._namespaces is None or namespace in self._namespaces
+
+  def Get(self, key):
+    """Returns the value of an internal key, or None if not cached."""
+    self._lock.acquire()
+    try:
+      entry = self._entries.pop(key, None)
+      if entry is None or entry.CheckExpired():
+        if entry is not None:
+          self._bytes -= len(key) + len(entry.value)
+        self.misses += 1
+        return None
+      self._entries[key] = entry
+      self.hits += 1
+      self.byte_hits += len(entry.value)
+      return entry.value
+    finally:
+      self._lock.release()
+
+  def Put(self, key, value, expiration=0):
+    """Caches the value of an internal key.
+
+    Args:
+      key: The internal key.
+      value: String stored in memcached under the key.
+      expiration: The expiration the value was stored with, 0 for none.
+    """
+    if not isinstance(value, basestring):
+      return
+    size = len(key) + len(value)
+    if size > self._max_bytes:
+      self.Discard(key)
+      return
+    entry = CacheEntry(value, self._ttl, 0, self._gettime)
+    if expiration:
+      if expiration <= 86400 * 30:
+        expiration += self._gettime()
+      entry.expiration_time = min(entry.expiration_time, expiration)
+
+    self._lock.acquire()
+    try:
+      old = self._entries.pop(key, None)
+      if old is not None:
+        self._bytes -= len(key) + len(old.value)
+      self._entries[key] = entry
+      self._bytes += size
+      while self._bytes > self._max_bytes:
+        old_key, old = self._entries.popitem(last=False)
+        self._bytes -= len(old_key) + len(old.value)
+        self.evictions += 1
+    finally:
+      self._lock.release()
+
+  def Discard(self, key):
+    """Drops an internal key from the near cache."""
+    self._lock.acquire()
+    try:
+      entry = self._entries.pop(key, None)
+      if entry is not None:
+        self._bytes -= len(key) + len(entry.value)
+    finally:
+      self._lock.release()
+
+  def Clear(self):
+    """Drops every entry."""
+    self._lock.acquire()
+    try:
+      self._entries.clear()
+      self._bytes = 0
+    finally:
+      self._lock.release()
+
+  def Stats(self):
+    """Returns the number of entries, their size, hits, misses and
+    evictions so far."""
+    self._lock.acquire()
+    try:
+      return {'items': len(self._entries),
+              'bytes': self._bytes,
+              'hits': self.hits,
+              'misses': self.misses,
+              'evictions': self.evictions}
+    finally:
+      self._lock.release()
+
+
+def ServerSpec(server, default_port=DEFAULT_PORT):
+  """Returns a python-memcached server spec for a memcached_servers entry.
+
+  Args:
+    server: 'host', 'host:port', or a (host[:port], weight) pair.
+    default_port: Port of entries without one.
+
+  Returns:
+    'host:port' or ('host:port', weight), or None for an empty entry.
+  """
+  weight = None
+  if isinstance(server, (list, tuple)):
+    server, weight = server
+  server = server.strip()
+  if not server:
+    return None
+  if ':' not in server:
+    server = '%s:%d' % (server, default_port)
+  if weight is None:
+    return server
+  return (server, int(weight))
+
+
+class RingClient(memcache.Client):
+  """A memcache.Client that places keys on a consistent-hash ring.
+
+  Keys may be given as (replica, key), which goes to the replica'th live
+  server after the one owning the key. Servers that fail to connect are
+  skipped for dead_retry seconds, and their keys go to the next server on
+  the ring meanwhile.
+  """
+
+  def __init__(self, servers, dead_retry=30, **kwargs):
+    self._dead_retry = dead_retry
+    self._dead_until = {}
+    memcache.Client.__init__(self, servers, **kwargs)
+
+  def _init_buckets(self):
+    memcache.Client._init_buckets(self)
+    self._ring = memcache_ring.HashRing(
+        [('%s:%d' % (server.ip, server.port), server, server.weight)
+         for server in self.servers])
+
+  def _get_server(self, key):
+    replica = 0
+    if isinstance(key, tuple):
+      replica, key = key
+    now = time.time()
+    for server in self._ring.Walk(key):
+      if self._dead_until.get(server, 0) > now:
+        continue
+      if not server.connect():
+        self._dead_until[server] = now + self._dead_retry
+        continue
+      if not replica:
+        return server, key
+      replica -= 1
+    return None, None
+
+  def offset_multi(self, offsets):
+    """Increments and decrements many keys, sending all the incr and decr
+    commands for a server in one exchange.
+
+    Args:
+      offsets: list of (key, delta) pairs; a negative delta decrements.
+
+    Returns:
+      list of the new values in the order of offsets, None for keys that
+      are missing, hold no number or whose server is down.
+    """
+    values = [None] * len(offsets)
+    by_server = {}
+    for index, (key, delta) in enumerate(offsets):
+      self.check_key(key)
+      server, server_key = self._get_server(key)
+      if server:
+        by_server.setdefault(server, []).append((index, server_key, delta))
+
+    for server, commands in by_server.iteritems():
+      lines = []
+      for index, server_key, delta in commands:
+        if delta < 0:
+          lines.append('decr %s %d\r\n' % (server_key, -delta))
+        else:
+          lines.append('incr %s %d\r\n' % (server_key, delta))
+      try:
+        server.send_cmds(''.join(lines))
+        for index, server_key, delta in commands:
+          line = server.readline()
+          if line and line.strip().isdigit():
+            values[index] = long(line)
+      except socket.error, msg:
+        if isinstance(msg, tuple):
+          msg = msg[1]
+        server.mark_dead(msg)
+    return values
+
+
 class MemcacheService(apiproxy_stub.APIProxyStub):
   """Python only memcache service.
 
   This service keeps all data in any external servers running memcached.
   """
 
-  def __init__(self, servers, gettime=time.time, service_name='memcache'):
+  THREADSAFE = True
+
+  def __init__(self, servers, gettime=time.time, service_name='memcache',
+               near_cache_bytes=0, near_cache_ttl=5,
+               near_cache_namespaces=None, default_port=DEFAULT_PORT,
+               dead_retry=30, replicas=1, replicated_namespaces=()):
     """Initializer.
 
     Args:
+      servers: memcached_servers entries, see ServerSpec.
       gettime: time.time()-like function used for testing.
       service_name: Service name expected for all calls.
+      near_cache_bytes: Size of the in-process NearCache in front of
+        memcached; 0 disables it.
+      near_cache_ttl: Whole seconds a value may be served from the near cache
+        after another process changed it.
+      near_cache_namespaces: The app namespaces to keep in the near cache, or
+        None for all of them.
+      default_port: Port of servers given without one.
+      dead_retry: Seconds a server that failed is left out of the ring.
+      replicas: How many servers keep each key of replicated_namespaces.
+      replicated_namespaces: App namespaces whose keys are also written to
+        the servers following their own on the ring, so reads fail over to a
+        copy when that server is down.
     """
     super(MemcacheService, self).__init__(service_name)
     self._gettime = gettime
 
-    memcaches = [ip + ":11311" for ip in servers if ip != '']
+    memcaches = [ServerSpec(server, default_port) for server in servers]
+    memcaches = [server for server in memcaches if server]
 
-    self._memcache = memcache.Client(memcaches, debug=0)
+    self._memcache = RingClient(memcaches, dead_retry=dead_retry, debug=0)
+    self._replicas = range(1, replicas)
+    self._replicated_namespaces = frozenset(replicated_namespaces or ())
+    self._near_cache = None
+    if near_cache_bytes:
+      self._near_cache = NearCache(near_cache_bytes, near_cache_ttl,
+                                   near_cache_namespaces, gettime)
     self._ResetStats()
 
     self._the_cache = {}
@@ -120,40 +373,80 @@ class MemcacheService(apiproxy_stub.APIProxyStub):
     self._byte_hits = 0
     self._cache_creation_time = self._gettime()
 
-  def _GetKey(self, namespace, key):
-    """Retrieves a CacheEntry from the cache if it hasn't expired.
+  def _NearCache(self, namespace):
+    """Returns the NearCache if it holds keys of namespace, else None."""
+    if self._near_cache and self._near_cache.Caches(namespace):
+      return self._near_cache
+    return None
 
-    Does not take deletion timeout into account.
+  def NearCacheStats(self):
+    """Returns hit ratios of the near cache (L1) and memcached (L2).
+
+    L2 counts only the lookups that missed the near cache.
+    """
+    stats = {'l2_hits': self._hits, 'l2_misses': self._misses}
+    if self._near_cache:
+      stats.update(('l1_' + name, value) for name, value in
+                   self._near_cache.Stats().iteritems())
+    else:
+      stats.update(l1_hits=0, l1_misses=0)
+    for level in ('l1', 'l2'):
+      lookups = stats[level + '_hits'] + stats[level + '_misses']
+      stats[level + '_hit_ratio'] = (lookups and
+                                     float(stats[level + '_hits']) / lookups)
+    return stats
+
+  def _Replicas(self, namespace, keys):
+    """Returns the (replica, key) keys of the copies of keys kept beyond
+    the server owning them, if the namespace is replicated."""
+    if namespace not in self._replicated_namespaces:
+      return []
+    return [(replica, key) for replica in self._replicas for key in keys]
+
+  def _KeyPrefix(self, namespace):
+    """Returns the prefix of the memcached keys of an app namespace.
 
     Args:
       namespace: The namespace that keys are stored under.
-      key: The key to retrieve from the cache.
-
-    Returns:
-      The corresponding CacheEntry instance, or None if it was not found or
-      has already expired.
     """
-    appname = os.environ['APPLICATION_ID']
-    internal_key = "__" + appname + "__" + namespace + "__" + key
-
-    entry = self._memcache.get(internal_key)
-    if entry is None:
-      return None
-    else:
-      return entry
+    return "__" + os.environ['APPLICATION_ID'] + "__" + namespace + "__"
 
   def _Dynamic_Get(self, request, response):
     """Implementation of MemcacheService::Get().
 
+    Keys not in the near cache are fetched with a single get_multi, which
+    asks each server for its keys in one exchange.
+
     Args:
       request: A MemcacheGetRequest.
       response: A MemcacheGetResponse.
     """
     namespace = request.name_space()
+    prefix = self._KeyPrefix(namespace)
     keys = set(request.key_list())
+    found = {}
+    near_cache = self._NearCache(namespace)
+    if near_cache:
+      for key in keys:
+        value = near_cache.Get(prefix + key)
+        if value is not None:
+          found[key] = value
+
+    missing = [key for key in keys if key not in found]
+    if missing:
+      fetched = self._memcache.get_multi(missing, key_prefix=prefix)
+      self._hits += len(fetched)
+      self._misses += len(missing) - len(fetched)
+      for key, value in fetched.iteritems():
+        if isinstance(value, basestring):
+          self._byte_hits += len(value)
+        if near_cache:
+          near_cache.Put(prefix + key, value)
+      found.update(fetched)
+
     for key in keys:
-      value = self._GetKey(namespace, key)
-      if value is None: 
+      value = found.get(key)
+      if value is None:
         continue
       item = response.add_item()
       item.set_key(key)
@@ -162,53 +455,137 @@ class MemcacheService(apiproxy_stub.APIProxyStub):
   def _Dynamic_Set(self, request, response):
     """Implementation of MemcacheService::Set().
 
+    Plain sets go out as one set_multi per expiration time; ADD and REPLACE
+    use memcached's own add and replace commands, which check for the key
+    atomically on the server.
+
     Args:
       request: A MemcacheSetRequest.
       response: A MemcacheSetResponse.
     """
     namespace = request.name_space()
+    prefix = self._KeyPrefix(namespace)
+    statuses = []
+    batches = {}
     for item in request.item_list():
       key = item.key()
       set_policy = item.set_policy()
-      old_entry = self._GetKey(namespace, key)
-
-      set_status = MemcacheSetResponse.NOT_STORED
-      if ((set_policy == MemcacheSetRequest.SET) or
-          (set_policy == MemcacheSetRequest.ADD and old_entry is None) or
-          (set_policy == MemcacheSetRequest.REPLACE and old_entry is not None)):
-
-        if (old_entry is None or
-            set_policy == MemcacheSetRequest.SET
-            or not old_entry.CheckLocked()):
-          appname = os.environ['APPLICATION_ID']
-          internal_key = "__" + appname + "__" + namespace + "__" + key
-
-          if self._memcache.set(internal_key, item.value(), item.expiration_time()):
-            set_status = MemcacheSetResponse.STORED
+      stored = False
+      if set_policy == MemcacheSetRequest.SET:
+        batches.setdefault(item.expiration_time(), {})[key] = item.value()
+        stored = None
+      elif set_policy == MemcacheSetRequest.ADD:
+        stored = self._memcache.add(prefix + key, item.value(),
+                                    item.expiration_time())
+      elif set_policy == MemcacheSetRequest.REPLACE:
+        stored = self._memcache.replace(prefix + key, item.value(),
+                                        item.expiration_time())
+      statuses.append((item, stored))
+
+    not_stored = set()
+    for expiration_time, mapping in batches.iteritems():
+      not_stored.update(self._memcache.set_multi(mapping, expiration_time,
+                                                 key_prefix=prefix))
+
+    near_cache = self._NearCache(namespace)
+    replicated = {}
+    for item, stored in statuses:
+      if stored is None:
+        stored = item.key() not in not_stored
+      if stored:
+        for replica_key in self._Replicas(namespace, [item.key()]):
+          replicated.setdefault(item.expiration_time(), {})[replica_key] = \
+              item.value()
+      if near_cache:
+        if stored:
+          near_cache.Put(prefix + item.key(), item.value(),
+                         item.expiration_time())
+        else:
+          near_cache.Discard(prefix + item.key())
+      if stored:
+        response.add_set_status(MemcacheSetResponse.STORED)
+      else:
+        response.add_set_status(MemcacheSetResponse.NOT_STORED)
 
-      response.add_set_status(set_status)
+    for expiration_time, mapping in replicated.iteritems():
+      self._memcache.set_multi(mapping, expiration_time, key_prefix=prefix)
 
   def _Dynamic_Delete(self, request, response):
     """Implementation of MemcacheService::Delete().
 
+    Which keys exist is found with one get_multi, and those are deleted with
+    one delete_multi.
+
     Args:
       request: A MemcacheDeleteRequest.
       response: A MemcacheDeleteResponse.
     """
     namespace = request.name_space()
-    for item in request.item_list():
-      key = item.key()
-      entry = self._GetKey(namespace, key)
+    prefix = self._KeyPrefix(namespace)
+    keys = [item.key() for item in request.item_list()]
+    near_cache = self._NearCache(namespace)
+    if near_cache:
+      for key in keys:
+        near_cache.Discard(prefix + key)
+    found = self._memcache.get_multi(list(set(keys)), key_prefix=prefix)
+    if found:
+      self._memcache.delete_multi(
+          found.keys() + self._Replicas(namespace, found.keys()),
+          key_prefix=prefix)
 
-      delete_status = MemcacheDeleteResponse.DELETED
-      if entry is None:
-        delete_status = MemcacheDeleteResponse.NOT_FOUND
+    for key in keys:
+      if key in found:
+        response.add_delete_status(MemcacheDeleteResponse.DELETED)
       else:
-        appname = os.environ['APPLICATION_ID']
-        internal_key = "__" + appname + "__" + namespace + "__" + key
-        self._memcache.delete(internal_key)
+        response.add_delete_status(MemcacheDeleteResponse.NOT_FOUND)
+
+  def _Offset(self, namespace, requests):
+    """Applies MemcacheIncrementRequests with one exchange per server.
+
+    Keys that are missing and have an initial value are first added with
+    it, which only succeeds for one of any concurrent callers, and then
+    offset again; copies of replicated namespaces get the same treatment.
 
-      response.add_delete_status(delete_status)
+    Args:
+      namespace: The namespace of the keys.
+      requests: list of MemcacheIncrementRequest or
+        MemcacheBatchIncrementRequest_Item.
+
+    Returns:
+      list of the new values, None where a key could not be offset.
+    """
+    prefix = self._KeyPrefix(namespace)
+    near_cache = self._NearCache(namespace)
+    offsets = []
+    for index, request in enumerate(requests):
+      key = prefix + request.key()
+      if near_cache:
+        near_cache.Discard(key)
+      delta = request.delta()
+      if request.direction() == MemcacheIncrementRequest.DECREMENT:
+        delta = -delta
+      for offset_key in [key] + self._Replicas(namespace, [key]):
+        offsets.append((index, offset_key, delta))
+
+    values = self._memcache.offset_multi(
+        [offset[1:] for offset in offsets])
+    retry = [position for position, result in enumerate(values)
+             if result is None and
+             requests[offsets[position][0]].has_initial_value()]
+    for position in retry:
+      index, offset_key, delta = offsets[position]
+      self._memcache.add(offset_key, str(requests[index].initial_value()))
+    if retry:
+      retried = self._memcache.offset_multi(
+          [offsets[position][1:] for position in retry])
+      for position, value in zip(retry, retried):
+        values[position] = value
+
+    new_values = [None] * len(requests)
+    for (index, offset_key, delta), value in zip(offsets, values):
+      if not isinstance(offset_key, tuple):
+        new_values[index] = value
+    return new_values
 
   def _Dynamic_Increment(self, request, response):
     """Implementation of MemcacheService::Increment().
@@ -217,25 +594,25 @@ class MemcacheService(apiproxy_stub.APIProxyStub):
       request: A MemcacheIncrementRequest.
       response: A MemcacheIncrementResponse.
     """
-    namespace = request.name_space()
-    key = request.key()
-    delta = request.delta()
+    new_value = self._Offset(request.name_space(), [request])[0]
+    if new_value is not None:
+      response.set_new_value(new_value)
 
-    new_value = 0
-    try:
-      appname = os.environ['APPLICATION_ID']
-      internal_key = "__" + appname + "__" + namespace + "__" + key
+  def _Dynamic_BatchIncrement(self, request, response):
+    """Implementation of MemcacheService::BatchIncrement().
 
-      if request.direction() == MemcacheIncrementRequest.INCREMENT:
-        new_value = self._memcache.incr(internal_key, delta)
-      elif request.direction() == MemcacheIncrementRequest.DECREMENT:
-        new_value = self._memcache.decr(internal_key, delta)
+    Args:
+      request: A MemcacheBatchIncrementRequest.
+      response: A MemcacheBatchIncrementResponse.
+    """
+    new_values = self._Offset(request.name_space(), request.item_list())
+    for new_value in new_values:
+      item = response.add_item()
+      if new_value is None:
+        item.set_increment_status(MemcacheIncrementResponse.NOT_CHANGED)
       else:
-        raise ValueError
-    except ValueError:
-      return
-
-    response.set_new_value(new_value)
+        item.set_increment_status(MemcacheIncrementResponse.OK)
+        item.set_new_value(new_value)
 
   def _Dynamic_FlushAll(self, request, response):
     """Implementation of MemcacheService::FlushAll().
@@ -245,6 +622,8 @@ class MemcacheService(apiproxy_stub.APIProxyStub):
       response: A MemcacheFlushResponse.
     """
     self._memcache.flush_all()
+    if self._near_cache:
+      self._near_cache.Clear()
 
   def _Dynamic_Stats(self, request, response):
     """Implementation of MemcacheService::Stats().
@@ -259,6 +638,10 @@ class MemcacheService(apiproxy_stub.APIProxyStub):
     2) time of oldest item in cache returns the age of the cache, not the
        time of the oldest item. Resolved to just return zero for now.
 
+    Hits served from the near cache are counted with those of memcached;
+    the near cache and memcached hit ratios of NearCacheStats() are
+    reported separately.
+
     Args:
       request: A MemcacheStatsRequest.
       response: A MemcacheStatsResponse.
@@ -279,6 +662,13 @@ class MemcacheService(apiproxy_stub.APIProxyStub):
       bytes += int(memcache_stats['bytes'])
 
     stats = response.mutable_stats()
+    if self._near_cache:
+      hits += self._near_cache.hits
+      bytes_written += self._near_cache.byte_hits
+      near_cache_stats = self.NearCacheStats()
+      stats.set_near_cache_hit_ratio(near_cache_stats['l1_hit_ratio'])
+      stats.set_remote_hit_ratio(near_cache_stats['l2_hit_ratio'])
+
     stats.set_hits(hits)
     stats.set_misses(misses)
     stats.set_byte_hits(bytes_written)
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+#
+#   Copyright (C) 2010-2011 Stackless Recursion
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2, or (at your option)
+#   any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+
+"""Ketama style consistent hashing of memcache keys onto servers.
+
+Each server gets points on a ring of 32 bit hashes in proportion to its
+weight, and a key belongs to the first server clockwise from the hash of the
+key. Adding or removing a server only moves the keys next to its points,
+instead of nearly all of them as with hashing modulo the number of servers.
+
+Run as a script to compare how many keys move when a server is added:
+
+  memcache_ring.py [keys]
+
+places keys (default %(keys)d) on 2 to 16 servers, adds one more and prints
+the percentage that moves with the ring, with modulo hashing and ideally.
+"""
+
+
+import binascii
+import bisect
+import hashlib
+import struct
+import sys
+
+
+# points per unit of weight; each md5 digest gives four.
+POINTS_PER_WEIGHT = 160
+
+DEFAULT_REMAP_KEYS = 100000
+
+
+def KeyHash(key):
+  """Returns the position of a key on the ring."""
+  return struct.unpack('<I', hashlib.md5(key).digest()[:4])[0]
+
+
+class HashRing(object):
+  """A consistent-hash ring of weighted nodes."""
+
+  def __init__(self, nodes, points_per_weight=POINTS_PER_WEIGHT):
+    """Initializer.
+
+    Args:
+      nodes: list of (name, node, weight); the name, usually 'host:port',
+        places the node on the ring, so every client must use the same one.
+      points_per_weight: Points a node gets per unit of weight.
+    """
+    ring = []
+    for name, node, weight in nodes:
+      for i in xrange(max(1, int(points_per_weight * weight) // 4)):
+        digest = hashlib.md5('%s-%d' % (name, i)).digest()
+        for point in struct.unpack('<4I', digest):
+          ring.append((point, name, node))
+    ring.sort(key=lambda entry: entry[:2])
+    self._points = [point for point, name, node in ring]
+    self._nodes = [node for point, name, node in ring]
+    self._distinct = len(set(name for name, node, weight in nodes))
+
+  def __len__(self):
+    return self._distinct
+
+  def GetNode(self, key):
+    """Returns the node a key belongs to, or None if the ring is empty."""
+    for node in self.Walk(key):
+      return node
+    return None
+
+  def Walk(self, key):
+    """Yields each node once, clockwise from the position of key.
+
+    The first node owns the key; the next ones are where it goes when the
+    earlier ones are down, and where replicas of it are kept.
+    """
+    if not self._points:
+      return
+    start = bisect.bisect(self._points, KeyHash(key))
+    seen = set()
+    count = len(self._points)
+    for i in xrange(count):
+      node = self._nodes[(start + i) % count]
+      if id(node) in seen:
+        continue
+      seen.add(id(node))
+      yield node
+      if len(seen) == self._distinct:
+        return
+
+
+def _ModuloNode(nodes, key):
+  """Picks a node the way python-memcached does without the ring."""
+  return nodes[((binascii.crc32(key) & 0xffffffff) >> 16 & 0x7fff) %
+               len(nodes)]
+
+
+def RemapFraction(servers, added, keys=DEFAULT_REMAP_KEYS):
+  """Returns the fraction of keys that move when a server is added, with the
+  ring and with modulo hashing.
+
+  Args:
+    servers: list of 'host:port' strings
+    added: the 'host:port' of the new server
+    keys: how many keys to place
+  """
+  before = HashRing([(server, server, 1) for server in servers])
+  after = HashRing([(server, server, 1) for server in servers + [added]])
+  ring_moved = modulo_moved = 0
+  for i in xrange(keys):
+    key = 'key-%d' % i
+    if before.GetNode(key) != after.GetNode(key):
+      ring_moved += 1
+    if _ModuloNode(servers, key) != _ModuloNode(servers + [added], key):
+      modulo_moved += 1
+  return float(ring_moved) / keys, float(modulo_moved) / keys
+
+
+def main(argv):
+  """Prints the fraction of keys that move as servers are added."""
+  keys = DEFAULT_REMAP_KEYS
+  if len(argv) > 1:
+    try:
+      keys = int(argv[1])
+    except ValueError:
+      print __doc__ % {'keys': DEFAULT_REMAP_KEYS}
+      return 1
+  print 'keys moved when a server is added, of %d keys:' % keys
+  for count in (2, 4, 8, 16):
+    servers = ['10.0.0.%d:11211' % i for i in range(1, count + 1)]
+    ring, modulo = RemapFraction(servers, '10.0.0.%d:11211' % (count + 1),
+                                 keys)
+    print ('%3d -> %2d servers: %5.1f%% with the ring, %5.1f%% with modulo '
+           'hashing, ideally %5.1f%%' %
+           (count, count + 1, ring * 100, modulo * 100, 100.0 / (count + 1)))
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv))
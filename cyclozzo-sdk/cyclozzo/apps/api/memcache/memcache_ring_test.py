@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+
+import unittest
+
+from cyclozzo.apps.api.memcache import memcache_ring
+
+
+_KEYS = ['key-%d' % i for i in xrange(20000)]
+
+
+def Servers(count):
+  return ['10.0.0.%d:11211' % i for i in range(1, count + 1)]
+
+
+def Ring(servers, weights=None):
+  weights = weights or {}
+  return memcache_ring.HashRing([(server, server, weights.get(server, 1))
+                                 for server in servers])
+
+
+class HashRingTestCase(unittest.TestCase):
+
+  def test_empty_ring(self):
+    ring = Ring([])
+    self.assertEqual(ring.GetNode('key'), None)
+    self.assertEqual(list(ring.Walk('key')), [])
+    self.assertEqual(len(ring), 0)
+
+  def test_keys_spread_evenly(self):
+    for count in (2, 5, 10):
+      servers = Servers(count)
+      ring = Ring(servers)
+      placed = dict.fromkeys(servers, 0)
+      for key in _KEYS:
+        placed[ring.GetNode(key)] += 1
+      for server in servers:
+        share = float(placed[server]) / len(_KEYS)
+        self.assertTrue(0.7 / count < share < 1.3 / count,
+                        '%s of %d servers holds %.3f' % (server, count, share))
+
+  def test_weights(self):
+    servers = Servers(2)
+    ring = Ring(servers, {servers[0]: 3})
+    heavy = len([key for key in _KEYS if ring.GetNode(key) == servers[0]])
+    self.assertAlmostEqual(float(heavy) / len(_KEYS), 0.75, delta=0.05)
+
+  def test_walk_yields_each_node_once(self):
+    servers = Servers(6)
+    ring = Ring(servers)
+    for key in _KEYS[:100]:
+      walked = list(ring.Walk(key))
+      self.assertEqual(sorted(walked), servers)
+      self.assertEqual(walked[0], ring.GetNode(key))
+
+  def test_adding_a_server_remaps_its_share(self):
+    for count in (2, 4, 8, 16):
+      servers = Servers(count)
+      added = '10.0.0.%d:11211' % (count + 1)
+      before = Ring(servers)
+      after = Ring(servers + [added])
+      moved = [key for key in _KEYS
+               if before.GetNode(key) != after.GetNode(key)]
+      # only the keys the new server takes over move
+      for key in moved:
+        self.assertEqual(after.GetNode(key), added)
+      ideal = 1.0 / (count + 1)
+      self.assertAlmostEqual(float(len(moved)) / len(_KEYS), ideal,
+                             delta=ideal * 0.25)
+
+  def test_remap_fraction(self):
+    ring, modulo = memcache_ring.RemapFraction(Servers(4), '10.0.0.5:11211',
+                                               keys=len(_KEYS))
+    self.assertAlmostEqual(ring, 0.2, delta=0.05)
+    self.assertTrue(modulo > 0.5)
+
+
+if __name__ == '__main__':
+  test_cases = [HashRingTestCase,
+               ]
+  for test_case in test_cases:
+    suite = unittest.TestLoader().loadTestsFromTestCase(test_case)
+    unittest.TextTestRunner(verbosity=2).run(suite)
@@ -2123,6 +2123,10 @@ class MergedNamespaceStats(ProtocolBuffer.ProtocolMessage):
   bytes_ = 0
   has_oldest_item_age_ = 0
   oldest_item_age_ = 0
+  has_near_cache_hit_ratio_ = 0
+  near_cache_hit_ratio_ = 0.0
+  has_remote_hit_ratio_ = 0
+  remote_hit_ratio_ = 0.0
 
   def __init__(self, contents=None):
     if contents is not None: self.MergeFromString(contents)
@@ -2205,6 +2209,32 @@ class MergedNamespaceStats(ProtocolBuffer.ProtocolMessage):
 
   def has_oldest_item_age(self): return self.has_oldest_item_age_
 
+  def near_cache_hit_ratio(self): return self.near_cache_hit_ratio_
+
+  def set_near_cache_hit_ratio(self, x):
+    self.has_near_cache_hit_ratio_ = 1
+    self.near_cache_hit_ratio_ = x
+
+  def clear_near_cache_hit_ratio(self):
+    if self.has_near_cache_hit_ratio_:
+      self.has_near_cache_hit_ratio_ = 0
+      self.near_cache_hit_ratio_ = 0.0
+
+  def has_near_cache_hit_ratio(self): return self.has_near_cache_hit_ratio_
+
+  def remote_hit_ratio(self): return self.remote_hit_ratio_
+
+  def set_remote_hit_ratio(self, x):
+    self.has_remote_hit_ratio_ = 1
+    self.remote_hit_ratio_ = x
+
+  def clear_remote_hit_ratio(self):
+    if self.has_remote_hit_ratio_:
+      self.has_remote_hit_ratio_ = 0
+      self.remote_hit_ratio_ = 0.0
+
+  def has_remote_hit_ratio(self): return self.has_remote_hit_ratio_
+
 
   def MergeFrom(self, x):
     assert x is not self
@@ -2214,6 +2244,8 @@ class MergedNamespaceStats(ProtocolBuffer.ProtocolMessage):
     if (x.has_items()): self.set_items(x.items())
     if (x.has_bytes()): self.set_bytes(x.bytes())
     if (x.has_oldest_item_age()): self.set_oldest_item_age(x.oldest_item_age())
+    if (x.has_near_cache_hit_ratio()): self.set_near_cache_hit_ratio(x.near_cache_hit_ratio())
+    if (x.has_remote_hit_ratio()): self.set_remote_hit_ratio(x.remote_hit_ratio())
 
   def Equals(self, x):
     if x is self: return 1
@@ -2229,6 +2261,10 @@ class MergedNamespaceStats(ProtocolBuffer.ProtocolMessage):
     if self.has_bytes_ and self.bytes_ != x.bytes_: return 0
     if self.has_oldest_item_age_ != x.has_oldest_item_age_: return 0
     if self.has_oldest_item_age_ and self.oldest_item_age_ != x.oldest_item_age_: return 0
+    if self.has_near_cache_hit_ratio_ != x.has_near_cache_hit_ratio_: return 0
+    if self.has_near_cache_hit_ratio_ and self.near_cache_hit_ratio_ != x.near_cache_hit_ratio_: return 0
+    if self.has_remote_hit_ratio_ != x.has_remote_hit_ratio_: return 0
+    if self.has_remote_hit_ratio_ and self.remote_hit_ratio_ != x.remote_hit_ratio_: return 0
     return 1
 
   def IsInitialized(self, debug_strs=None):
@@ -2266,6 +2302,8 @@ class MergedNamespaceStats(ProtocolBuffer.ProtocolMessage):
     n += self.lengthVarInt64(self.byte_hits_)
     n += self.lengthVarInt64(self.items_)
     n += self.lengthVarInt64(self.bytes_)
+    if (self.has_near_cache_hit_ratio_): n += 9
+    if (self.has_remote_hit_ratio_): n += 9
     return n + 10
 
   def Clear(self):
@@ -2275,6 +2313,8 @@ class MergedNamespaceStats(ProtocolBuffer.ProtocolMessage):
     self.clear_items()
     self.clear_bytes()
     self.clear_oldest_item_age()
+    self.clear_near_cache_hit_ratio()
+    self.clear_remote_hit_ratio()
 
   def OutputUnchecked(self, out):
     out.putVarInt32(8)
@@ -2289,6 +2329,12 @@ class MergedNamespaceStats(ProtocolBuffer.ProtocolMessage):
     out.putVarUint64(self.bytes_)
     out.putVarInt32(53)
     out.put32(self.oldest_item_age_)
+    if (self.has_near_cache_hit_ratio_):
+      out.putVarInt32(57)
+      out.putDouble(self.near_cache_hit_ratio_)
+    if (self.has_remote_hit_ratio_):
+      out.putVarInt32(65)
+      out.putDouble(self.remote_hit_ratio_)
 
   def TryMerge(self, d):
     while d.avail() > 0:
@@ -2311,6 +2357,12 @@ class MergedNamespaceStats(ProtocolBuffer.ProtocolMessage):
       if tt == 53:
         self.set_oldest_item_age(d.get32())
         continue
+      if tt == 57:
+        self.set_near_cache_hit_ratio(d.getDouble())
+        continue
+      if tt == 65:
+        self.set_remote_hit_ratio(d.getDouble())
+        continue
       if (tt == 0): raise ProtocolBuffer.ProtocolBufferDecodeError
       d.skipData(tt)
 
@@ -2323,6 +2375,8 @@ class MergedNamespaceStats(ProtocolBuffer.ProtocolMessage):
     if self.has_items_: res+=prefix+("items: %s\n" % self.DebugFormatInt64(self.items_))
     if self.has_bytes_: res+=prefix+("bytes: %s\n" % self.DebugFormatInt64(self.bytes_))
     if self.has_oldest_item_age_: res+=prefix+("oldest_item_age: %s\n" % self.DebugFormatFixed32(self.oldest_item_age_))
+    if self.has_near_cache_hit_ratio_: res+=prefix+("near_cache_hit_ratio: %s\n" % self.DebugFormat(self.near_cache_hit_ratio_))
+    if self.has_remote_hit_ratio_: res+=prefix+("remote_hit_ratio: %s\n" % self.DebugFormat(self.remote_hit_ratio_))
     return res
 
 
@@ -2335,6 +2389,8 @@ class MergedNamespaceStats(ProtocolBuffer.ProtocolMessage):
   kitems = 4
   kbytes = 5
   koldest_item_age = 6
+  knear_cache_hit_ratio = 7
+  kremote_hit_ratio = 8
 
   _TEXT = _BuildTagLookupTable({
     0: "ErrorCode",
@@ -2344,7 +2400,9 @@ class MergedNamespaceStats(ProtocolBuffer.ProtocolMessage):
     4: "items",
     5: "bytes",
     6: "oldest_item_age",
-  }, 6)
+    7: "near_cache_hit_ratio",
+    8: "remote_hit_ratio",
+  }, 8)
 
   _TYPES = _BuildTagLookupTable({
     0: ProtocolBuffer.Encoder.NUMERIC,
@@ -2354,7 +2412,9 @@ class MergedNamespaceStats(ProtocolBuffer.ProtocolMessage):
     4: ProtocolBuffer.Encoder.NUMERIC,
     5: ProtocolBuffer.Encoder.NUMERIC,
     6: ProtocolBuffer.Encoder.FLOAT,
-  }, 6, ProtocolBuffer.Encoder.MAX_TYPE)
+    7: ProtocolBuffer.Encoder.DOUBLE,
+    8: ProtocolBuffer.Encoder.DOUBLE,
+  }, 8, ProtocolBuffer.Encoder.MAX_TYPE)
 
   _STYLE = """"""
   _STYLE_CONTENT_TYPE = """"""
@@ -22,11 +22,20 @@ import cyclozzo.apps.runtime.apiproxy_errors
 import logging
 import os
 import pylibmc
+import struct
 import time
+import zlib
 
 DEFAULT_ADDR = '127.0.0.1'
 DEFAULT_PORT = 11211
 
+# Values are stored as a header holding the memcache flags and how the bytes
+# are encoded, followed by the bytes themselves. Entries written before that
+# are pickled [flags, value] lists, which never start with a NUL byte.
+VALUE_HEADER = struct.Struct('>cBI')
+VALUE_MAGIC = '\0'
+VALUE_COMPRESSED = 0x01
+
 MemcacheSetResponse       = (cyclozzo.apps.api.memcache.memcache_service_pb.
                              MemcacheSetResponse)
 MemcacheSetRequest        = (cyclozzo.apps.api.memcache.memcache_service_pb.
@@ -51,18 +60,49 @@ def getKey(key, namespace=None):
     return base64.b64encode(key)
 
 
+def encodeValue(value, flags, compress_threshold=0):
+    """Returns the string to store for a value and its memcache flags.
+
+    Values longer than compress_threshold bytes are zlib compressed when that
+    makes them smaller; 0 disables compression.
+    """
+    encoding = 0
+    if compress_threshold and len(value) > compress_threshold:
+        compressed = zlib.compress(value)
+        if len(compressed) < len(value):
+            value = compressed
+            encoding |= VALUE_COMPRESSED
+    return VALUE_HEADER.pack(VALUE_MAGIC, encoding, flags) + value
+
+
+def decodeValue(stored):
+    """Returns (flags, value) for a string stored by encodeValue or by
+    earlier versions of this stub."""
+    if not stored.startswith(VALUE_MAGIC):
+        stored_flags, stored_value = cPickle.loads(stored)
+        return stored_flags, stored_value
+    magic, encoding, flags = VALUE_HEADER.unpack_from(stored)
+    value = stored[VALUE_HEADER.size:]
+    if encoding & VALUE_COMPRESSED:
+        value = zlib.decompress(value)
+    return flags, value
+
+
 class MemcacheServiceStub(cyclozzo.apps.api.apiproxy_stub.APIProxyStub):
     """Memcache service stub.
 
     This stub uses memcached to store data.
     """
 
-    def __init__(self, server, port, service_name='memcache'):
+    def __init__(self, server, port, service_name='memcache',
+                 compress_threshold=0):
         """Initializes memcache service stub.
 
         Args:
             config: Dictionary containing configuration parameters.
             service_name: Service name expected for all calls.
+            compress_threshold: Values longer than this many bytes are
+                stored compressed; 0 disables compression.
         """
         super(MemcacheServiceStub, self).__init__(service_name)
         if not server:
@@ -71,6 +111,7 @@ class MemcacheServiceStub(cyclozzo.apps.api.apiproxy_stub.APIProxyStub):
             port = DEFAULT_PORT
 
         self._cache = pylibmc.Client(['%s:%i' % (server, port)])
+        self._compress_threshold = compress_threshold
 
     def _GetMemcacheBehavior(self):
         behaviors = self._cache.behaviors
@@ -90,9 +131,7 @@ class MemcacheServiceStub(cyclozzo.apps.api.apiproxy_stub.APIProxyStub):
             value = self._cache.get(getKey(key, request.name_space()))
             if value is None:
                 continue
-            flags = 0
-            stored_flags, stored_value = cPickle.loads(value)
-            flags |= stored_flags
+            flags, stored_value = decodeValue(value)
             item = response.add_item()
             item.set_key(key)
             item.set_value(stored_value)
@@ -111,7 +150,8 @@ class MemcacheServiceStub(cyclozzo.apps.api.apiproxy_stub.APIProxyStub):
             old_entry = self._cache.get(key)
             set_status = MemcacheSetResponse.NOT_STORED
 
-            set_value = cPickle.dumps([item.flags(), item.value()])
+            set_value = encodeValue(item.value(), item.flags(),
+                                    self._compress_threshold)
 
             if ((set_policy == MemcacheSetRequest.SET) or
                 (set_policy == MemcacheSetRequest.ADD and old_entry is None) or
@@ -167,7 +207,7 @@ class MemcacheServiceStub(cyclozzo.apps.api.apiproxy_stub.APIProxyStub):
             flags, stored_value = (cyclozzo.apps.api.memcache.TYPE_INT,
                                    str(request.initial_value()))
         else:
-            flags, stored_value = cPickle.loads(value)
+            flags, stored_value = decodeValue(value)
 
         if flags == cyclozzo.apps.api.memcache.TYPE_INT:
             new_value = int(stored_value)
@@ -178,7 +218,7 @@ class MemcacheServiceStub(cyclozzo.apps.api.apiproxy_stub.APIProxyStub):
         elif request.direction() == MemcacheIncrementRequest.DECREMENT:
             new_value -= request.delta()
 
-        new_stored_value = cPickle.dumps([flags, str(new_value)])
+        new_stored_value = encodeValue(str(new_value), flags)
         try:
             self._cache.set(key, new_stored_value)
         except:
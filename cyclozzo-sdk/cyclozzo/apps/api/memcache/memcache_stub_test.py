@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+
+import cPickle
+import os
+import unittest
+import zlib
+
+from cyclozzo.apps.api import memcache
+from cyclozzo.apps.api.memcache import memcache_service_pb
+from cyclozzo.apps.api.memcache import memcache_stub
+
+
+class DictCache(dict):
+  """Stands in for the pylibmc client of the stub."""
+
+  def set(self, key, value, time=0):
+    self[key] = value
+    return True
+
+  def replace(self, key, value):
+    self[key] = value
+    return True
+
+  def delete(self, key):
+    self.pop(key, None)
+    return True
+
+
+class ValueEncodingTestCase(unittest.TestCase):
+
+  def test_round_trip(self):
+    for value, flags in (('', 0),
+                         ('abc', memcache.TYPE_STR),
+                         ('\0\0starts with the magic byte', 0),
+                         ('42', memcache.TYPE_INT),
+                         ('x' * 10000, 0xffffffff)):
+      stored = memcache_stub.encodeValue(value, flags)
+      self.assertEqual(memcache_stub.decodeValue(stored), (flags, value))
+      self.assertEqual(len(stored),
+                       memcache_stub.VALUE_HEADER.size + len(value))
+
+  def test_compression(self):
+    value = 'abcd' * 1000
+    stored = memcache_stub.encodeValue(value, 3, compress_threshold=100)
+    self.assertTrue(len(stored) < len(value))
+    self.assertEqual(memcache_stub.decodeValue(stored), (3, value))
+
+    # short values, and those that do not shrink, are stored as they are
+    stored = memcache_stub.encodeValue('abcd', 3, compress_threshold=100)
+    self.assertTrue(stored.endswith('abcd'))
+    incompressible = zlib.compress(os.urandom(1000))
+    stored = memcache_stub.encodeValue(incompressible, 3,
+                                       compress_threshold=100)
+    self.assertTrue(stored.endswith(incompressible))
+    self.assertEqual(memcache_stub.decodeValue(stored), (3, incompressible))
+
+  def test_legacy_pickled_values(self):
+    for protocol in (0, 1, 2):
+      for flags, value in ((0, 'abc'), (memcache.TYPE_INT, '42'), (7, '')):
+        stored = cPickle.dumps([flags, value], protocol)
+        self.assertFalse(stored.startswith(memcache_stub.VALUE_MAGIC))
+        self.assertEqual(memcache_stub.decodeValue(stored), (flags, value))
+
+
+class MemcacheServiceStubTestCase(unittest.TestCase):
+
+  def setUp(self):
+    self.stub = memcache_stub.MemcacheServiceStub('127.0.0.1', 11211,
+                                                  compress_threshold=100)
+    self.stub._cache = DictCache()
+
+  def Get(self, key):
+    request = memcache_service_pb.MemcacheGetRequest()
+    request.add_key(key)
+    response = memcache_service_pb.MemcacheGetResponse()
+    self.stub._Dynamic_Get(request, response)
+    return [(item.flags(), item.value()) for item in response.item_list()]
+
+  def test_set_and_get(self):
+    request = memcache_service_pb.MemcacheSetRequest()
+    for key, value in (('short', 'abc'), ('long', 'abcd' * 1000)):
+      item = request.add_item()
+      item.set_key(key)
+      item.set_value(value)
+      item.set_flags(memcache.TYPE_STR)
+    self.stub._Dynamic_Set(request,
+                           memcache_service_pb.MemcacheSetResponse())
+    self.assertEqual(self.Get('short'), [(memcache.TYPE_STR, 'abc')])
+    self.assertEqual(self.Get('long'), [(memcache.TYPE_STR, 'abcd' * 1000)])
+
+  def test_reads_and_increments_legacy_values(self):
+    self.stub._cache[memcache_stub.getKey('old')] = cPickle.dumps(
+        [memcache.TYPE_STR, 'abc'])
+    self.assertEqual(self.Get('old'), [(memcache.TYPE_STR, 'abc')])
+
+    self.stub._cache[memcache_stub.getKey('counter')] = cPickle.dumps(
+        [memcache.TYPE_INT, '41'])
+    request = memcache_service_pb.MemcacheIncrementRequest()
+    request.set_key('counter')
+    request.set_delta(1)
+    response = memcache_service_pb.MemcacheIncrementResponse()
+    self.stub._Dynamic_Increment(request, response)
+    self.assertEqual(response.new_value(), 42)
+    self.assertEqual(self.Get('counter'), [(memcache.TYPE_INT, '42')])
+
+
+if __name__ == '__main__':
+  test_cases = [ValueEncodingTestCase,
+                MemcacheServiceStubTestCase,
+               ]
+  for test_case in test_cases:
+    suite = unittest.TestLoader().loadTestsFromTestCase(test_case)
+    unittest.TextTestRunner(verbosity=2).run(suite)
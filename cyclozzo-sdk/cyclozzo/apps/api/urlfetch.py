@@ -233,6 +233,7 @@ def fetch(url, payload=None, method=GET, headers={},
   exception.
   """
   rpc = create_rpc(deadline=deadline)
+  rpc.synchronous = True
   make_fetch_call(rpc, url, payload, method, headers,
                   allow_truncated, follow_redirects)
   return rpc.get_result()
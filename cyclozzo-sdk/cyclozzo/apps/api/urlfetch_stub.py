@@ -71,6 +71,8 @@ def _IsAllowedPort(port):
 class URLFetchServiceStub(apiproxy_stub.APIProxyStub):
   """Stub version of the urlfetch API to be used with apiproxy_stub_map."""
 
+  THREADSAFE = True
+
   def __init__(self, service_name='urlfetch'):
     """Initializer.
 
@@ -24,11 +24,11 @@ import logging
 import cPickle as pickle
 import ht
 import threading
-import datetime
 
 from cyclozzo.apps.api import apiproxy_stub
-from cyclozzo.apps.api import datastore, datastore_types, datastore_errors, users
-from cyclozzo.apps.datastore import datastore_pb, entity_pb
+from cyclozzo.apps.api import datastore, datastore_types, datastore_errors
+from cyclozzo.apps.datastore import datastore_pb
+from cyclozzo.apps.datastore import datastore_query_eval
 
 log = logging.getLogger(__name__)
 
@@ -301,28 +301,7 @@ class _Cursor(object):
 
 class HypertableStub(apiproxy_stub.APIProxyStub):
 
-	_PROPERTY_TYPE_TAGS = {
-		datastore_types.Blob: entity_pb.PropertyValue.kstringValue,
-		bool: entity_pb.PropertyValue.kbooleanValue,
-		datastore_types.Category: entity_pb.PropertyValue.kstringValue,
-		datetime.datetime: entity_pb.PropertyValue.kint64Value,
-		datastore_types.Email: entity_pb.PropertyValue.kstringValue,
-		float: entity_pb.PropertyValue.kdoubleValue,
-		datastore_types.GeoPt: entity_pb.PropertyValue.kPointValueGroup,
-		datastore_types.IM: entity_pb.PropertyValue.kstringValue,
-		int: entity_pb.PropertyValue.kint64Value,
-		datastore_types.Key: entity_pb.PropertyValue.kReferenceValueGroup,
-		datastore_types.Link: entity_pb.PropertyValue.kstringValue,
-		long: entity_pb.PropertyValue.kint64Value,
-		datastore_types.PhoneNumber: entity_pb.PropertyValue.kstringValue,
-		datastore_types.PostalAddress: entity_pb.PropertyValue.kstringValue,
-		datastore_types.Rating: entity_pb.PropertyValue.kint64Value,
-		str: entity_pb.PropertyValue.kstringValue,
-		datastore_types.Text: entity_pb.PropertyValue.kstringValue,
-		type(None): 0,
-		unicode: entity_pb.PropertyValue.kstringValue,
-		users.User: entity_pb.PropertyValue.kUserValueGroup,
-   	 }
+	_PROPERTY_TYPE_TAGS = datastore_query_eval._PROPERTY_TYPE_TAGS
 
 
 	def __init__(self, app_id, ht_config='/etc/cyclozzo/hypertable.cfg', service_name='datastore_v3'):
@@ -447,7 +426,7 @@ class HypertableStub(apiproxy_stub.APIProxyStub):
 		table = self._client.open_table(table_name)
 		scan_spec_builder = ht.ScanSpecBuilder()
 		scan_spec_builder.set_max_versions(1)
-		if filters or orders:
+		if filters or orders or not query.has_limit():
 			scan_spec_builder.set_row_limit(0)
 		else:
 			scan_spec_builder.set_row_limit(offset + limit)
@@ -475,140 +454,10 @@ class HypertableStub(apiproxy_stub.APIProxyStub):
 		datastore_types.SetNamespace(query, namespace)
 		encoded = datastore_types.EncodeAppIdNamespace(self._app_id, namespace)
 	
-		operators = {datastore_pb.Query_Filter.LESS_THAN:			 '<',
-					 datastore_pb.Query_Filter.LESS_THAN_OR_EQUAL:	'<=',
-					 datastore_pb.Query_Filter.GREATER_THAN:			'>',
-					 datastore_pb.Query_Filter.GREATER_THAN_OR_EQUAL: '>=',
-					 datastore_pb.Query_Filter.EQUAL:				 '==',
-					 }
-	
-		def has_prop_indexed(entity, prop):
-			"""Returns True if prop is in the entity and is indexed."""
-			if prop in datastore_types._SPECIAL_PROPERTIES:
-				return True
-			elif prop in entity.unindexed_properties():
-				return False
-	
-			values = entity.get(prop, [])
-			if not isinstance(values, (tuple, list)):
-				values = [values]
-	
-			for value in values:
-				if type(value) not in datastore_types._RAW_PROPERTY_TYPES:
-					return True
-			return False
-	
-		for filt in filters:
-			assert filt.op() != datastore_pb.Query_Filter.IN
-	
-			prop = filt.property(0).name().decode('utf-8')
-			op = operators[filt.op()]
-	
-			filter_val_list = [datastore_types.FromPropertyPb(filter_prop)
-							 for filter_prop in filt.property_list()]
-	
-			def passes_filter(entity):
-				"""Returns True if the entity passes the filter, False otherwise.
-		
-				The filter being evaluated is filt, the current filter that we're on
-				in the list of filters in the query.
-				"""
-				log.debug('filter check for entity: %r' %entity)
-				if not has_prop_indexed(entity, prop):
-					return False
-		
-				try:
-					entity_vals = datastore._GetPropertyValue(entity, prop)
-				except KeyError:
-					entity_vals = []
-		
-				if not isinstance(entity_vals, list):
-					entity_vals = [entity_vals]
-		
-				for fixed_entity_val in entity_vals:
-					for filter_val in filter_val_list:
-						fixed_entity_type = self._PROPERTY_TYPE_TAGS.get(
-																		fixed_entity_val.__class__)
-						filter_type = self._PROPERTY_TYPE_TAGS.get(filter_val.__class__)
-						if fixed_entity_type == filter_type:
-							comp = u'%r %s %r' % (fixed_entity_val, op, filter_val)
-						elif op != '==':
-							comp = '%r %s %r' % (fixed_entity_type, op, filter_type)
-						else:
-							continue
-		
-						logging.log(logging.DEBUG - 1,
-								'Evaling filter expression "%s"', comp)
-		
-						try:
-							ret = eval(comp)
-							if ret and ret != NotImplementedError:
-								return True
-						except TypeError:
-							pass
-		
-				return False
-	
-			results = filter(passes_filter, results)
-		log.debug('entity list after filter operation: %r' %results)
-	
-		for order in orders:
-			prop = order.property().decode('utf-8')
-			results = [entity for entity in results if has_prop_indexed(entity, prop)]
-	
-		def order_compare_entities(a, b):
-			""" Return a negative, zero or positive number depending on whether
-			entity a is considered smaller than, equal to, or larger than b,
-			according to the query's orderings. """
-			cmped = 0
-			for o in orders:
-				prop = o.property().decode('utf-8')
-		
-				reverse = (o.direction() is datastore_pb.Query_Order.DESCENDING)
-		
-				a_val = datastore._GetPropertyValue(a, prop)
-				if isinstance(a_val, list):
-					a_val = sorted(a_val, order_compare_properties, reverse=reverse)[0]
-		
-				b_val = datastore._GetPropertyValue(b, prop)
-				if isinstance(b_val, list):
-					b_val = sorted(b_val, order_compare_properties, reverse=reverse)[0]
-		
-				cmped = order_compare_properties(a_val, b_val)
-		
-				if o.direction() is datastore_pb.Query_Order.DESCENDING:
-					cmped = -cmped
-	
-				if cmped != 0:
-					return cmped
-	
-			if cmped == 0:
-				return cmp(a.key(), b.key())
-	
-		def order_compare_properties(x, y):
-			"""Return a negative, zero or positive number depending on whether
-			property value x is considered smaller than, equal to, or larger than
-			property value y. If x and y are different types, they're compared based
-			on the type ordering used in the real datastore, which is based on the
-			tag numbers in the PropertyValue PB.
-			"""
-			if isinstance(x, datetime.datetime):
-				x = datastore_types.DatetimeToTimestamp(x)
-			if isinstance(y, datetime.datetime):
-				y = datastore_types.DatetimeToTimestamp(y)
-	
-			x_type = self._PROPERTY_TYPE_TAGS.get(x.__class__)
-			y_type = self._PROPERTY_TYPE_TAGS.get(y.__class__)
-	
-			if x_type == y_type:
-				try:
-					return cmp(x, y)
-				except TypeError:
-					return 0
-			else:
-				return cmp(x_type, y_type)
-	
-		results.sort(order_compare_entities)
+		results = datastore_query_eval.FilterEntities(results, filters, orders)
+		order_compare_entities = datastore_query_eval.EntityComparator(orders)
+		results = datastore_query_eval.SortEntities(
+				results, orders, datastore_query_eval.ResultLimit(query))
 
 		cursor = _Cursor(query, results, order_compare_entities)
 		self.__queries[cursor.cursor] = cursor
@@ -23,15 +23,15 @@
 import logging
 import ht
 import threading
-import datetime
 import re
 import array
 import itertools
 import uuid
 
 from cyclozzo.apps.api import apiproxy_stub
-from cyclozzo.apps.api import datastore, datastore_types, datastore_errors, users
+from cyclozzo.apps.api import datastore, datastore_types, datastore_errors
 from cyclozzo.apps.datastore import datastore_pb, entity_pb
+from cyclozzo.apps.datastore import datastore_query_eval
 from cyclozzo.apps.datastore import sortable_pb_encoder
 from cyclozzo.apps.datastore import datastore_index
 from cyclozzo.apps.datastore import datastore_stub_util
@@ -311,28 +311,7 @@ class _Cursor(object):
 
 class HypertableStub(apiproxy_stub.APIProxyStub):
 
-	_PROPERTY_TYPE_TAGS = {
-		datastore_types.Blob: entity_pb.PropertyValue.kstringValue,
-		bool: entity_pb.PropertyValue.kbooleanValue,
-		datastore_types.Category: entity_pb.PropertyValue.kstringValue,
-		datetime.datetime: entity_pb.PropertyValue.kint64Value,
-		datastore_types.Email: entity_pb.PropertyValue.kstringValue,
-		float: entity_pb.PropertyValue.kdoubleValue,
-		datastore_types.GeoPt: entity_pb.PropertyValue.kPointValueGroup,
-		datastore_types.IM: entity_pb.PropertyValue.kstringValue,
-		int: entity_pb.PropertyValue.kint64Value,
-		datastore_types.Key: entity_pb.PropertyValue.kReferenceValueGroup,
-		datastore_types.Link: entity_pb.PropertyValue.kstringValue,
-		long: entity_pb.PropertyValue.kint64Value,
-		datastore_types.PhoneNumber: entity_pb.PropertyValue.kstringValue,
-		datastore_types.PostalAddress: entity_pb.PropertyValue.kstringValue,
-		datastore_types.Rating: entity_pb.PropertyValue.kint64Value,
-		str: entity_pb.PropertyValue.kstringValue,
-		datastore_types.Text: entity_pb.PropertyValue.kstringValue,
-		type(None): 0,
-		unicode: entity_pb.PropertyValue.kstringValue,
-		users.User: entity_pb.PropertyValue.kUserValueGroup,
-   	 }
+	_PROPERTY_TYPE_TAGS = datastore_query_eval._PROPERTY_TYPE_TAGS
 
 
 	def __init__(self, app_id,
@@ -469,12 +448,23 @@ class HypertableStub(apiproxy_stub.APIProxyStub):
 	def __get_cells(self, table, key):
 		"""Get the Hypertable cells having the key
 		"""
+		return self.__get_rows(table, [key]).get(key, [])
+
+	def __get_rows(self, table, keys):
+		"""Get the Hypertable cells of many rows with a single scanner.
+
+		Returns:
+			dict mapping each row key that exists to its list of cells.
+		"""
 		scan_spec_builder = ht.ScanSpecBuilder()
-		scan_spec_builder.add_row_interval(key, True, key, True)
+		for key in sorted(set(keys)):
+			scan_spec_builder.add_row_interval(key, True, key, True)
 		scan_spec_builder.set_max_versions(1)
 		scan_spec_builder.set_row_limit(0)
-		cells = [cell for cell in table.create_scanner(scan_spec_builder)]
-		return cells
+		rows = {}
+		for cell in table.create_scanner(scan_spec_builder):
+			rows.setdefault(cell.row_key, []).append(cell)
+		return rows
 	
 	def __set_cell(self, table, key, family, qualifier, value):
 		"""Set the Hypertable cells with the provided keys and values
@@ -628,24 +618,30 @@ class HypertableStub(apiproxy_stub.APIProxyStub):
 			log.warning('drop_table: No table named %s in namespace: %s' %(kind, namespace))
 	
 	def _Dynamic_Get(self, get_request, get_response):
+		# group the requested rows by table so each table is scanned once.
+		requested = []
+		tables = {}
 		for key in get_request.key_list():
 			appid_namespace, kind = self._AppIdNamespaceKindForKey(key)
 			namespace = appid_namespace.rsplit('!', 1)[1] if '!' in appid_namespace else ''
+			encoded_key = str(datastore_types.Key._FromPb(key))
+			requested.append((key, (namespace, kind), encoded_key))
+			tables.setdefault((namespace, kind), []).append(encoded_key)
 
+		found = {}
+		for (namespace, kind), encoded_keys in tables.iteritems():
 			try:
 				ns = self.__client.open_namespace('%s/%s' %(self.__app_id, namespace))
 				table = ns.open_table(kind)
 			except RuntimeError:
 				log.warning('No data for %s' %kind)
-				group = get_response.add_entity()
 				continue
+			found[(namespace, kind)] = self.__get_rows(table, encoded_keys)
 
-			key_pb = key
-			key = datastore_types.Key._FromPb(key)
-			total_cells = self.__get_cells(table, str(key))
-
+		# missing keys still get an (empty) result group, in request order.
+		for key_pb, table, encoded_key in requested:
 			group = get_response.add_entity()
-			for cell in total_cells:
+			for cell in found.get(table, {}).get(encoded_key, []):
 				if cell.column_family == 'entity' and cell.column_qualifier == 'proto':
 					entity_proto = entity_pb.EntityProto(str(cell.value))
 					entity_proto.mutable_key().CopyFrom(key_pb)
@@ -669,7 +665,7 @@ class HypertableStub(apiproxy_stub.APIProxyStub):
 
 		scan_spec_builder = ht.ScanSpecBuilder()
 		scan_spec_builder.set_max_versions(1)
-		if filters or orders:
+		if filters or orders or not query.has_limit():
 			scan_spec_builder.set_row_limit(0)
 		else:
 			scan_spec_builder.set_row_limit(offset + limit)
@@ -700,138 +696,10 @@ class HypertableStub(apiproxy_stub.APIProxyStub):
 		datastore_types.SetNamespace(query, namespace)
 		encoded = datastore_types.EncodeAppIdNamespace(self.__app_id, namespace)
 	
-		operators = {datastore_pb.Query_Filter.LESS_THAN:			 '<',
-					 datastore_pb.Query_Filter.LESS_THAN_OR_EQUAL:	'<=',
-					 datastore_pb.Query_Filter.GREATER_THAN:			'>',
-					 datastore_pb.Query_Filter.GREATER_THAN_OR_EQUAL: '>=',
-					 datastore_pb.Query_Filter.EQUAL:				 '==',
-					 }
-	
-		def has_prop_indexed(entity, prop):
-			"""Returns True if prop is in the entity and is indexed."""
-			if prop in datastore_types._SPECIAL_PROPERTIES:
-				return True
-			elif prop in entity.unindexed_properties():
-				return False
-	
-			values = entity.get(prop, [])
-			if not isinstance(values, (tuple, list)):
-				values = [values]
-	
-			for value in values:
-				if type(value) not in datastore_types._RAW_PROPERTY_TYPES:
-					return True
-			return False
-	
-		for filt in filters:
-			assert filt.op() != datastore_pb.Query_Filter.IN
-	
-			prop = filt.property(0).name().decode('utf-8')
-			op = operators[filt.op()]
-	
-			filter_val_list = [datastore_types.FromPropertyPb(filter_prop)
-							 for filter_prop in filt.property_list()]
-	
-			def passes_filter(entity):
-				"""Returns True if the entity passes the filter, False otherwise.
-		
-				The filter being evaluated is filt, the current filter that we're on
-				in the list of filters in the query.
-				"""
-				if not has_prop_indexed(entity, prop):
-					return False
-		
-				try:
-					entity_vals = datastore._GetPropertyValue(entity, prop)
-				except KeyError:
-					entity_vals = []
-		
-				if not isinstance(entity_vals, list):
-					entity_vals = [entity_vals]
-		
-				for fixed_entity_val in entity_vals:
-					for filter_val in filter_val_list:
-						fixed_entity_type = self._PROPERTY_TYPE_TAGS.get(
-																		fixed_entity_val.__class__)
-						filter_type = self._PROPERTY_TYPE_TAGS.get(filter_val.__class__)
-						if fixed_entity_type == filter_type:
-							comp = u'%r %s %r' % (fixed_entity_val, op, filter_val)
-						elif op != '==':
-							comp = '%r %s %r' % (fixed_entity_type, op, filter_type)
-						else:
-							continue
-		
-						logging.log(logging.DEBUG - 1,
-								'Evaling filter expression "%s"', comp)
-		
-						try:
-							ret = eval(comp)
-							if ret and ret != NotImplementedError:
-								return True
-						except TypeError:
-							pass
-		
-				return False
-	
-			results = filter(passes_filter, results)
-	
-		for order in orders:
-			prop = order.property().decode('utf-8')
-			results = [entity for entity in results if has_prop_indexed(entity, prop)]
-	
-		def order_compare_entities(a, b):
-			""" Return a negative, zero or positive number depending on whether
-			entity a is considered smaller than, equal to, or larger than b,
-			according to the query's orderings. """
-			cmped = 0
-			for o in orders:
-				prop = o.property().decode('utf-8')
-		
-				reverse = (o.direction() is datastore_pb.Query_Order.DESCENDING)
-		
-				a_val = datastore._GetPropertyValue(a, prop)
-				if isinstance(a_val, list):
-					a_val = sorted(a_val, order_compare_properties, reverse=reverse)[0]
-		
-				b_val = datastore._GetPropertyValue(b, prop)
-				if isinstance(b_val, list):
-					b_val = sorted(b_val, order_compare_properties, reverse=reverse)[0]
-		
-				cmped = order_compare_properties(a_val, b_val)
-		
-				if o.direction() is datastore_pb.Query_Order.DESCENDING:
-					cmped = -cmped
-	
-				if cmped != 0:
-					return cmped
-	
-			if cmped == 0:
-				return cmp(a.key(), b.key())
-	
-		def order_compare_properties(x, y):
-			"""Return a negative, zero or positive number depending on whether
-			property value x is considered smaller than, equal to, or larger than
-			property value y. If x and y are different types, they're compared based
-			on the type ordering used in the real datastore, which is based on the
-			tag numbers in the PropertyValue PB.
-			"""
-			if isinstance(x, datetime.datetime):
-				x = datastore_types.DatetimeToTimestamp(x)
-			if isinstance(y, datetime.datetime):
-				y = datastore_types.DatetimeToTimestamp(y)
-	
-			x_type = self._PROPERTY_TYPE_TAGS.get(x.__class__)
-			y_type = self._PROPERTY_TYPE_TAGS.get(y.__class__)
-	
-			if x_type == y_type:
-				try:
-					return cmp(x, y)
-				except TypeError:
-					return 0
-			else:
-				return cmp(x_type, y_type)
-	
-		results.sort(order_compare_entities)
+		results = datastore_query_eval.FilterEntities(results, filters, orders)
+		order_compare_entities = datastore_query_eval.EntityComparator(orders)
+		results = datastore_query_eval.SortEntities(
+				results, orders, datastore_query_eval.ResultLimit(query))
 		cursor = _Cursor(query, results, order_compare_entities)
 		self.__queries[cursor.cursor] = cursor
 	
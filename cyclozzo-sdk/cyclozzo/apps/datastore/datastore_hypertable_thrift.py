@@ -22,21 +22,31 @@
 
 import logging
 import threading
-import datetime
+import collections
+import time
 import re
 import array
 import itertools
+import os
 import uuid
+import hashlib
+import binascii
 
-from cyclozzo.runtime.lib.thriftclient import ThriftClient
-from cyclozzo.hyperthrift.gen.ttypes import ClientException, Cell, Key, RowInterval, ScanSpec
+from cyclozzo.runtime.lib.thriftclient import ThriftClientPool
+from cyclozzo.hyperthrift.gen.ttypes import ClientException, Cell, Key, KeyFlag, RowInterval, ScanSpec, MutateSpec
+from cyclozzo.apps.api import api_base_pb
 from cyclozzo.apps.api import apiproxy_stub
-from cyclozzo.apps.api import datastore, datastore_types, datastore_errors, users
+from cyclozzo.apps.api import apiproxy_stub_map
+from cyclozzo.apps.api import datastore, datastore_types, datastore_errors
+from cyclozzo.apps.api.labs.taskqueue import taskqueue_service_pb
 from cyclozzo.apps.datastore import datastore_pb, entity_pb
+from cyclozzo.apps.datastore import datastore_query_eval
+from cyclozzo.apps.datastore import hypertable_serialized
 from cyclozzo.apps.datastore import sortable_pb_encoder
 from cyclozzo.apps.datastore import datastore_index
 from cyclozzo.apps.datastore import datastore_stub_util
 from cyclozzo.apps.api import namespace_manager
+from cyclozzo.apps.runtime import apiproxy_errors
 
 import __builtin__
 buffer = __builtin__.buffer
@@ -47,9 +57,145 @@ _MAXIMUM_RESULTS = 1000
 _MAX_QUERY_OFFSET = 1000
 _MAX_QUERY_COMPONENTS = 100
 _BATCH_SIZE = 20
+# rows a query reads from Hypertable with one call.
+_SCAN_BATCH_ROWS = 500
 _MAX_ACTIONS_PER_TXN = 5
 _CURSOR_CONCAT_STR = '!CURSOR!'
 
+# IDs of a kind are leased in blocks; block b holds the IDs
+# b * _ID_BLOCK_SIZE + 1 to (b + 1) * _ID_BLOCK_SIZE. Every process must
+# agree on the size.
+_ID_BLOCK_SIZE = 1000
+# most ID blocks claimed with one mutation when IDs are reserved up to a max.
+_ID_RESERVE_BLOCKS = 1000
+
+# a transaction commits by claiming the version cells of its entity groups.
+# Claims whose revision, a nanosecond timestamp the range server assigns, is
+# this much older than a new claim's are left over from dead commits.
+_TX_CLAIM_TIMEOUT = 30 * 1000000000
+_TX_CLAIM_PREFIX = 'lock:'
+# a commit records its writes in a row of the datastore table before it
+# applies them, so that they can be rolled forward if it dies half way.
+_TX_RECORD_PREFIX = 'TxCommit/'
+# writes outside transactions wait this many times for commits holding their
+# entity groups, first for _TX_WRITE_BACKOFF seconds, twice as long each time.
+_TX_WRITE_RETRIES = 5
+_TX_WRITE_BACKOFF = 0.05
+
+# single-property index rows of a kind live in a table of their own, keyed
+# by '<property>/<value>/<key>' with every part hex encoded so that row
+# order follows sortable_pb_encoder order.
+_INDEX_TABLE = '%s__index'
+_INDEX_SEP = '/'
+_INDEX_END = '0'
+_INDEX_PREFIX_END = '~'
+
+# composite index rows are keyed by '<index id>/<value><value>...<key>'. A
+# value of a descending property has its bytes inverted and a separator
+# sorting after every hex digit.
+_COMPOSITE_INDEX_PREFIX = 'x'
+_INDEX_DESC_SEP = 'g'
+
+# (lower, upper) suffixes appended to '<property>/<value>' to bound an index
+# range for each filter operator; None leaves that end of the range open.
+_INDEX_RANGE_BOUNDS = {
+  datastore_pb.Query_Filter.EQUAL: (_INDEX_SEP, _INDEX_END),
+  datastore_pb.Query_Filter.GREATER_THAN: (_INDEX_END, None),
+  datastore_pb.Query_Filter.GREATER_THAN_OR_EQUAL: (_INDEX_SEP, None),
+  datastore_pb.Query_Filter.LESS_THAN: (None, _INDEX_SEP),
+  datastore_pb.Query_Filter.LESS_THAN_OR_EQUAL: (None, _INDEX_END),
+}
+
+
+def _IndexComponent(value, direction):
+  """Hex encodes an index value so rows sort in the given direction."""
+  if direction == datastore_index.DESCENDING:
+    value = ''.join([chr(255 - ord(c)) for c in str(value)])
+    return binascii.hexlify(value) + _INDEX_DESC_SEP
+  return binascii.hexlify(value) + _INDEX_SEP
+
+
+def _KeyOnlyProto(key_pb):
+  """Returns an EntityProto holding just a key, as keys_only results do."""
+  entity_proto = entity_pb.EntityProto()
+  entity_proto.mutable_key().CopyFrom(key_pb)
+  entity_proto.mutable_entity_group().add_element().CopyFrom(
+      key_pb.path().element(0))
+  return entity_proto
+
+
+def _DecodeEntity(row, value, props=None, keys_only=False):
+  """Decodes the query result stored in an 'entity:proto' cell.
+
+  Args:
+    row: the row key of the cell
+    value: the value of the cell
+    props: names of the only properties to decode, or None for all of them
+    keys_only: whether the result is only wanted for its key
+
+  Returns:
+    a datastore.Entity, or a _ProjectedEntity if props or keys_only is given
+  """
+  entity_proto = entity_pb.EntityProto(str(value))
+  entity_proto.mutable_key().CopyFrom(
+      datastore_types.Key(encoded=row)._ToPb())
+  if props is None and not keys_only:
+    return datastore.Entity.FromPb(entity_proto)
+  return _ProjectedEntity(entity_proto, props or (), keys_only)
+
+
+class _KeyOnlyEntity(object):
+  """A keys_only query result, built from its row key without reading the
+  stored entity."""
+
+  def __init__(self, row):
+    self.__row = row
+
+  def key(self):
+    return datastore_types.Key(encoded=self.__row)
+
+  def ToPb(self):
+    return _KeyOnlyProto(self.key()._ToPb())
+
+  _ToPb = ToPb
+
+
+class _ProjectedEntity(object):
+  """A query result decoded with only the properties its query filters or
+  sorts on.
+
+  Evaluating the query sees just those properties, and so does ToPb(), which
+  compiled cursors are built from. _ToPb() returns the complete stored
+  entity, or just its key for keys_only queries.
+  """
+
+  def __init__(self, entity_proto, props, keys_only=False):
+    projected = entity_pb.EntityProto()
+    projected.mutable_key().CopyFrom(entity_proto.key())
+    projected.mutable_entity_group().CopyFrom(entity_proto.entity_group())
+    for prop in entity_proto.property_list():
+      if prop.name() in props:
+        projected.add_property().CopyFrom(prop)
+    for prop in entity_proto.raw_property_list():
+      if prop.name() in props:
+        projected.add_raw_property().CopyFrom(prop)
+    self.__entity = datastore.Entity.FromPb(projected)
+    if keys_only:
+      entity_proto = _KeyOnlyProto(entity_proto.key())
+    self.__entity_proto = entity_proto
+
+  def __getattr__(self, name):
+    return getattr(self.__entity, name)
+
+  def __getitem__(self, name):
+    return self.__entity[name]
+
+  def ToPb(self):
+    return self.__entity.ToPb()
+
+  def _ToPb(self):
+    return self.__entity_proto
+
 
 class _Cursor(object):
   """A query cursor.
@@ -67,57 +213,119 @@ class _Cursor(object):
   _next_cursor = 1
   _next_cursor_lock = threading.Lock()
 
-  def __init__(self, query, results, order_compare_entities):
+  def __init__(self, query, results, order_compare_entities, size=0):
     """Constructor.
 
     Args:
       query: the query request proto
       # the query results, in order, such that results[self.offset+1] is
       # the next result
-      results: list of datastore.Entity
+      results: list of datastore.Entity, or a _ScanStream that yields them
+        for a query that is only counted
       order_compare_entities: a __cmp__ function for datastore.Entity that
         follows sort order as specified by the query
+      size: approximate size in bytes of a list of results
     """
+    self.__stream = None
 
     if query.has_compiled_cursor() and query.compiled_cursor().position_list():
       (self.__last_result, inclusive) = self._DecodeCompiledCursor(
           query, query.compiled_cursor())
-      start_cursor_position = _Cursor._GetCursorOffset(results,
-                                                       self.__last_result,
-                                                       inclusive,
-                                                       order_compare_entities)
+      start = (str(self.__last_result.key()), inclusive)
     else:
       self.__last_result = None
-      start_cursor_position = 0
+      start = None
 
     if query.has_end_compiled_cursor():
       (end_cursor_entity, inclusive) = self._DecodeCompiledCursor(
           query, query.end_compiled_cursor())
-      end_cursor_position = _Cursor._GetCursorOffset(results,
-                                                     end_cursor_entity,
-                                                     inclusive,
-                                                     order_compare_entities)
+      # an inclusive end position sits before the entity, so excludes it.
+      end = (str(end_cursor_entity.key()), not inclusive)
     else:
-      end_cursor_position = len(results)
-
-    results = results[start_cursor_position:end_cursor_position]
+      end_cursor_entity = None
+      end = None
 
+    limit = None
     if query.has_limit():
       limit = query.limit()
       if query.offset():
         limit += query.offset()
+
+    if isinstance(results, _ScanStream):
+      # streams are not in any sort order, so cannot be positioned.
+      assert start is None and end is None
+      results.Open(limit or None)
+      self.__stream = results
+      results = []
+    else:
+      total = len(results)
+      if start is not None:
+        start_cursor_position = _Cursor._GetCursorOffset(results,
+                                                         self.__last_result,
+                                                         start[1],
+                                                         order_compare_entities)
+      else:
+        start_cursor_position = 0
+
+      if end_cursor_entity is not None:
+        end_cursor_position = _Cursor._GetCursorOffset(results,
+                                                       end_cursor_entity,
+                                                       not end[1],
+                                                       order_compare_entities)
+      else:
+        end_cursor_position = len(results)
+
+      results = results[start_cursor_position:end_cursor_position]
+
       if limit > 0 and limit < len(results):
         results = results[:limit]
+      if total:
+        size = size * len(results) // total
 
     self.__results = results
     self.__query = query
     self.__offset = 0
+    self.__consumed = 0
+    self.__size = size
 
     self.app = query.app()
     self.keys_only = query.keys_only()
-    self.count = len(self.__results)
     self.cursor = self._AcquireCursorID()
 
+  def Count(self, limit=None):
+    """Returns the total number of results, reading a stream to its end or
+    until limit results are found."""
+    count = self.__consumed + len(self.__results)
+    if self.__stream is not None:
+      if limit is None:
+        count += self.__stream.Count()
+      elif count < limit:
+        count += self.__stream.Count(limit - count)
+    return count
+
+  count = property(Count)
+
+  @property
+  def size(self):
+    """Approximate number of bytes held by this cursor."""
+    if self.__stream is not None:
+      return self.__stream.size
+    return self.__size
+
+  def Close(self):
+    """Releases the scanner of a streaming cursor."""
+    if self.__stream is not None:
+      self.__stream.Close()
+
+  def __Available(self, count):
+    """Returns how many results are buffered past the offset, reading up to
+    count more from the stream if needed."""
+    if self.__stream is not None:
+      wanted = self.__offset + count - len(self.__results)
+      if wanted > 0:
+        self.__results.extend(self.__stream.Next(wanted))
+    return len(self.__results) - self.__offset
+
   def _AcquireCursorID(self):
     """Acquires the next cursor id in a thread safe manner.
     """
@@ -284,7 +492,7 @@ class _Cursor(object):
       offset: integer of how many results to skip
       compile: boolean, whether we are compiling this query
     """
-    offset = min(offset, self.count - self.__offset)
+    offset = min(offset, self.__Available(offset))
     limited_offset = min(offset, _MAX_QUERY_OFFSET)
     if limited_offset:
       self.__offset += limited_offset
@@ -293,6 +501,7 @@ class _Cursor(object):
     if offset == limited_offset and count:
       if count > _MAXIMUM_RESULTS:
         count = _MAXIMUM_RESULTS
+      self.__Available(count)
       results = self.__results[self.__offset:self.__offset + count]
       count = len(results)
       self.__offset += count
@@ -304,45 +513,446 @@ class _Cursor(object):
     result.mutable_cursor().set_app(self.app)
     result.mutable_cursor().set_cursor(self.cursor)
     result.set_keys_only(self.keys_only)
-    result.set_more_results(self.__offset < self.count)
+    result.set_more_results(self.__Available(1) > 0)
+
+    if self.__stream is not None:
+      # results already handed out are not needed again.
+      del self.__results[:self.__offset]
+      self.__consumed += self.__offset
+      self.__offset = 0
+
     if compile:
       self._EncodeCompiledCursor(
           self.__query, result.mutable_compiled_cursor())
 
 
+class _ScanStream(object):
+  """The entities of a kind, read lazily from Hypertable a batch of rows at
+  a time.
+
+  Each batch borrows a pooled thrift connection for a single
+  get_cells_serialized call and the next one resumes after the last row
+  read, so nothing is held on the broker between batches. Only the entities
+  that are returned, or evaluated against the query's filters, are decoded.
+  Rows come back in the order of their encoded keys, which is not the order
+  of the keys themselves.
+
+  Public properties:
+    size: bytes of cell values in the batch last read
+    bytes_read: bytes of cell values read so far
+    rows_read: rows read so far
+  """
+
+  def __init__(self, get_client, ns, kind, keys_only, matches=None,
+               props=None, keys=None, row_limit=0,
+               batch_rows=_SCAN_BATCH_ROWS):
+    """Constructor.
+
+    Args:
+      get_client: callable borrowing a pooled thrift client
+      ns: the namespace id
+      kind: the kind table to scan
+      keys_only: whether only the keys of the entities are needed; without
+        a predicate the stored entities are then not read at all
+      matches: predicate the entities must pass, or None
+      props: names of the only properties to decode, or None for all
+      keys: encoded keys of the only rows to read, or None for all rows
+      row_limit: most rows to read, or 0 for no limit
+      batch_rows: most rows to read with one call
+    """
+    self.__get_client = get_client
+    self.__ns = ns
+    self.__kind = kind
+    self.__keys_only = keys_only
+    self.__matches = matches
+    self.__props = props
+    self.__keys = keys
+    self.__row_limit = row_limit
+    self.__batch_rows = batch_rows
+    self.__limit = None
+    self.__entities = self.__Entities()
+    self.size = 0
+    self.bytes_read = 0
+    self.rows_read = 0
+
+  def Open(self, limit=None):
+    """Restarts the stream, returning at most limit entities, or all of them
+    if limit is None."""
+    self.__limit = limit
+    self.__entities = self.__Entities()
+
+  def __iter__(self):
+    return self.__entities
+
+  def Next(self, count):
+    """Returns a list of up to count more entities."""
+    return list(itertools.islice(self.__entities, count))
+
+  def Count(self, limit=None):
+    """Reads the rest of the stream, or until limit entities are found, and
+    returns how many entities it held."""
+    count = 0
+    for entity in itertools.islice(self.__entities, limit):
+      count += 1
+    return count
+
+  def Close(self):
+    """Stops reading; there is no scanner or connection to release."""
+    self.__entities = iter(())
+    self.size = 0
+
+  def __Read(self, row_intervals, row_limit):
+    """Reads one batch of rows, holding a connection only for the call.
+
+    Returns:
+      list of (row, column family, column qualifier, value) of its cells
+    """
+    client = self.__get_client()
+    try:
+      page = client.get_cells_serialized(
+          self.__ns, self.__kind,
+          ScanSpec(columns = ['entity'],
+                   row_intervals = row_intervals,
+                   row_limit = row_limit,
+                   cell_limit = 1,
+                   revs = 1,
+                   keys_only = self.__keys_only and self.__matches is None))
+    finally:
+      client.close()
+    self.size = len(page)
+    self.bytes_read += len(page)
+    cells = list(hypertable_serialized.SerializedCellsReader(page))
+    self.rows_read += len(set([cell[0] for cell in cells]))
+    return cells
+
+  def __Cells(self):
+    """Yields (row, column family, column qualifier, value) of the cells of
+    the scan, reading a batch of rows at a time."""
+    if self.__keys is not None:
+      keys = sorted(set(self.__keys))
+      for start in xrange(0, len(keys), self.__batch_rows):
+        row_intervals = [RowInterval(start_row = key,
+                                     start_inclusive = True,
+                                     end_row = key,
+                                     end_inclusive = True)
+                         for key in keys[start:start + self.__batch_rows]]
+        for cell in self.__Read(row_intervals, 0):
+          yield cell
+      return
+
+    last_row = None
+    remaining = self.__row_limit
+    while True:
+      batch_rows = self.__batch_rows
+      if self.__row_limit:
+        batch_rows = min(batch_rows, remaining)
+      row_intervals = None
+      if last_row is not None:
+        row_intervals = [RowInterval(start_row = last_row,
+                                     start_inclusive = False)]
+      rows = 0
+      for cell in self.__Read(row_intervals, batch_rows):
+        if cell[0] != last_row:
+          last_row = cell[0]
+          rows += 1
+        yield cell
+      remaining -= rows
+      if rows < batch_rows or (self.__row_limit and remaining <= 0):
+        return
+
+  def __Entities(self):
+    """Yields the entities of the scan that pass the query's filters."""
+    returned = 0
+    try:
+      if self.__limit == 0:
+        return
+      for row, family, qualifier, value in self.__Cells():
+        if family != 'entity' or qualifier != 'proto':
+          continue
+        if self.__matches is None and self.__keys_only:
+          entity = _KeyOnlyEntity(row)
+        else:
+          entity = _DecodeEntity(row, value, self.__props, self.__keys_only)
+          if self.__matches is not None and not self.__matches(entity):
+            continue
+        yield entity
+        returned += 1
+        if returned == self.__limit:
+          break
+    except ClientException, e:
+      log.warning('No data for %s: %s' % (self.__kind, e))
+
+
+class _CursorRegistry(object):
+  """The open query cursors of a stub.
+
+  Cursors left idle for longer than ttl seconds are closed, as are the least
+  recently used ones whenever more than max_cursors are open or together
+  they hold more than max_bytes.
+  """
+
+  def __init__(self, max_cursors=1000, max_bytes=64 << 20, ttl=600):
+    self.__max_cursors = max_cursors
+    self.__max_bytes = max_bytes
+    self.__ttl = ttl
+    # cursor id -> (cursor, last use), least recently used first.
+    self.__cursors = collections.OrderedDict()
+    self.__evictions = 0
+    self.__lock = threading.Lock()
+
+  def Add(self, cursor):
+    """Registers a new cursor, evicting others if over the limits."""
+    self.__lock.acquire()
+    try:
+      self.__cursors[cursor.cursor] = (cursor, time.time())
+      evicted = self.__Evict(cursor.cursor)
+    finally:
+      self.__lock.release()
+    for old in evicted:
+      old.Close()
+
+  def Get(self, cursor_id):
+    """Returns the cursor with the given id.
+
+    Raises:
+      KeyError if there is no such cursor, or it has been evicted.
+    """
+    self.__lock.acquire()
+    try:
+      cursor, last_used = self.__cursors.pop(cursor_id)
+      self.__cursors[cursor_id] = (cursor, time.time())
+      evicted = self.__Evict(cursor_id)
+    finally:
+      self.__lock.release()
+    for old in evicted:
+      old.Close()
+    return cursor
+
+  def Pop(self, cursor_id):
+    """Unregisters and closes the cursor with the given id."""
+    self.__lock.acquire()
+    try:
+      cursor, last_used = self.__cursors.pop(cursor_id)
+    finally:
+      self.__lock.release()
+    cursor.Close()
+    return cursor
+
+  def Clear(self):
+    """Closes every open cursor."""
+    self.__lock.acquire()
+    try:
+      cursors = [cursor for cursor, last_used in self.__cursors.itervalues()]
+      self.__cursors.clear()
+    finally:
+      self.__lock.release()
+    for cursor in cursors:
+      cursor.Close()
+
+  def Stats(self):
+    """Returns the number of open cursors, their size and evictions so far."""
+    self.__lock.acquire()
+    try:
+      return {'open': len(self.__cursors),
+              'bytes': sum([cursor.size for cursor, last_used in
+                            self.__cursors.itervalues()]),
+              'evictions': self.__evictions}
+    finally:
+      self.__lock.release()
+
+  def __Evict(self, keep):
+    """Removes expired cursors, then the least recently used ones until the
+    limits are met. Never evicts the cursor keep. Must hold the lock.
+
+    Returns:
+      list of the evicted cursors, to be closed outside the lock.
+    """
+    evicted = []
+    deadline = time.time() - self.__ttl
+    for cursor_id, (cursor, last_used) in self.__cursors.items():
+      if last_used >= deadline:
+        break
+      if cursor_id != keep:
+        evicted.append(self.__cursors.pop(cursor_id)[0])
+
+    total = sum([cursor.size for cursor, last_used in
+                 self.__cursors.itervalues()])
+    for cursor_id in self.__cursors.keys():
+      if (len(self.__cursors) <= self.__max_cursors and
+          total <= self.__max_bytes):
+        break
+      if cursor_id != keep:
+        cursor = self.__cursors.pop(cursor_id)[0]
+        total -= cursor.size
+        evicted.append(cursor)
+
+    self.__evictions += len(evicted)
+    if evicted:
+      log.debug('evicted %d query cursors' % len(evicted))
+    return evicted
+
+
+class _IdAllocator(object):
+  """Hands out entity IDs from blocks leased by a shared store.
+
+  Each process takes IDs from its current block of a kind without locking
+  or calling the store; once half of the block is used, the next one is
+  leased in the background. Blocks are tied to the process that leased them,
+  so a forked child leases its own.
+  """
+
+  def __init__(self, lease_blocks):
+    """Constructor.
+
+    Args:
+      lease_blocks: function (kind, count) returning the number of the first
+        of count consecutive blocks leased for this process
+    """
+    self.__lease_blocks = lease_blocks
+    # kind -> (pid, itertools.count of the block's IDs, last ID of the block)
+    self.__blocks = {}
+    # kind -> (pid, number of a block leased ahead of time)
+    self.__spare = {}
+    # kind -> the highest ID reserved, which blocks no longer hand out
+    self.__reserved = {}
+    self.__lock = threading.Lock()
+
+  def Next(self, kind):
+    """Returns a new ID for an entity of kind."""
+    block = self.__blocks.get(kind)
+    if block is not None:
+      pid, ids, last = block
+      id_ = ids.next()
+      if (id_ <= last and pid == os.getpid() and
+          id_ > self.__reserved.get(kind, 0)):
+        if id_ == last - _ID_BLOCK_SIZE // 2:
+          self.__Prefetch(kind)
+        return id_
+    return self.__NextBlock(kind)
+
+  def Range(self, kind, size):
+    """Leases size consecutive IDs of kind, returning the first and last."""
+    count = (size + _ID_BLOCK_SIZE - 1) // _ID_BLOCK_SIZE
+    start = self.__lease_blocks(kind, count) * _ID_BLOCK_SIZE + 1
+    return start, start + size - 1
+
+  def Reserve(self, kind, max_id):
+    """Stops handing out the IDs of kind up to max_id from local blocks,
+    including blocks leased later or by threads already leasing one."""
+    self.__lock.acquire()
+    try:
+      self.__reserved[kind] = max(self.__reserved.get(kind, 0), max_id)
+      block = self.__blocks.get(kind)
+      if block is not None and block[2] - _ID_BLOCK_SIZE < max_id:
+        del self.__blocks[kind]
+      spare = self.__spare.get(kind)
+      if spare is not None and spare[1] * _ID_BLOCK_SIZE < max_id:
+        del self.__spare[kind]
+    finally:
+      self.__lock.release()
+
+  def __NextBlock(self, kind):
+    """Moves kind on to a new block and returns its first ID."""
+    self.__lock.acquire()
+    try:
+      reserved = self.__reserved.get(kind, 0)
+      block = self.__blocks.get(kind)
+      if block is not None and block[0] == os.getpid():
+        # another thread may have moved on already.
+        id_ = block[1].next()
+        if reserved < id_ <= block[2]:
+          return id_
+      spare = self.__spare.pop(kind, None)
+      if spare is not None and spare[0] == os.getpid():
+        number = spare[1]
+      else:
+        number = self.__lease_blocks(kind, 1)
+      while number * _ID_BLOCK_SIZE < reserved:
+        # leased before the IDs were reserved.
+        number = self.__lease_blocks(kind, 1)
+      ids = itertools.count(number * _ID_BLOCK_SIZE + 1)
+      self.__blocks[kind] = (os.getpid(), ids,
+                             (number + 1) * _ID_BLOCK_SIZE)
+      return ids.next()
+    finally:
+      self.__lock.release()
+
+  def __Prefetch(self, kind):
+    """Leases the next block of kind in a background thread."""
+    def prefetch():
+      try:
+        number = self.__lease_blocks(kind, 1)
+      except Exception, e:
+        log.warning('could not lease an ID block for %s: %s' % (kind, e))
+        return
+      self.__lock.acquire()
+      try:
+        self.__spare.setdefault(kind, (os.getpid(), number))
+      finally:
+        self.__lock.release()
+
+    thread = threading.Thread(target=prefetch)
+    thread.setDaemon(True)
+    thread.start()
+
+
+class _Transaction(object):
+  """The state of one open transaction.
+
+  Public properties:
+    app: the app the transaction was begun for
+    writes: dict of encoded key to the EntityProto to put at commit
+    deletes: dict of encoded key to the Reference to delete at commit
+    actions: list of taskqueue_service_pb.TaskQueueAddRequest to run at commit
+    versions: dict of (namespace, root kind, encoded root key) to the
+      revision of each entity group's version cell when the transaction
+      first touched the group, or None if it had none
+  """
+
+  def __init__(self, app):
+    self.app = app
+    self.writes = {}
+    self.deletes = {}
+    self.actions = []
+    self.versions = {}
+
+
 class HypertableStub(apiproxy_stub.APIProxyStub):
 
-	_PROPERTY_TYPE_TAGS = {
-		datastore_types.Blob: entity_pb.PropertyValue.kstringValue,
-		bool: entity_pb.PropertyValue.kbooleanValue,
-		datastore_types.Category: entity_pb.PropertyValue.kstringValue,
-		datetime.datetime: entity_pb.PropertyValue.kint64Value,
-		datastore_types.Email: entity_pb.PropertyValue.kstringValue,
-		float: entity_pb.PropertyValue.kdoubleValue,
-		datastore_types.GeoPt: entity_pb.PropertyValue.kPointValueGroup,
-		datastore_types.IM: entity_pb.PropertyValue.kstringValue,
-		int: entity_pb.PropertyValue.kint64Value,
-		datastore_types.Key: entity_pb.PropertyValue.kReferenceValueGroup,
-		datastore_types.Link: entity_pb.PropertyValue.kstringValue,
-		long: entity_pb.PropertyValue.kint64Value,
-		datastore_types.PhoneNumber: entity_pb.PropertyValue.kstringValue,
-		datastore_types.PostalAddress: entity_pb.PropertyValue.kstringValue,
-		datastore_types.Rating: entity_pb.PropertyValue.kint64Value,
-		str: entity_pb.PropertyValue.kstringValue,
-		datastore_types.Text: entity_pb.PropertyValue.kstringValue,
-		type(None): 0,
-		unicode: entity_pb.PropertyValue.kstringValue,
-		users.User: entity_pb.PropertyValue.kUserValueGroup,
-   	 }
+	THREADSAFE = True
+
+	_PROPERTY_TYPE_TAGS = datastore_query_eval._PROPERTY_TYPE_TAGS
 
 
 	def __init__(self, app_id,
 				thrift_address='127.0.0.1',
 				thrift_port='38080', 
 				service_name='datastore_v3', 
-				trusted=False):
+				trusted=False,
+				pool_size=8,
+				flush_interval=0,
+				use_indexes=True,
+				app_root=None,
+				require_indexes=False,
+				max_cursors=1000,
+				cursor_memory=64 << 20,
+				cursor_ttl=600,
+				projection=False):
 		"""
 		Initialize this stub with the service name.
+
+		pool_size is the number of idle ThriftBroker connections kept open
+		for reuse across calls. A non-zero flush_interval (milliseconds)
+		makes writes go through the broker's shared periodic mutator, which
+		trades durability of the last interval's writes for throughput.
+		With use_indexes, queries read candidate keys from the single-property
+		indexes, or the composite indexes defined in app_root's index.yaml,
+		instead of scanning the kind. require_indexes rejects queries that
+		need a composite index index.yaml does not define.
+		At most max_cursors query cursors holding cursor_memory bytes are
+		kept open; cursors idle for cursor_ttl seconds are dropped. With
+		projection, queries only decode the properties they filter or sort on
+		to evaluate them.
 		"""
 		self.__app_id = app_id
 		self.__schema = '''
@@ -358,20 +968,41 @@ class HypertableStub(apiproxy_stub.APIProxyStub):
     </ColumnFamily>
   </AccessGroup>
 </Schema>
+'''
+		self.__index_schema = '''
+<Schema>
+  <AccessGroup name="default">
+    <ColumnFamily>
+      <Name>ref</Name>
+      <deleted>false</deleted>
+    </ColumnFamily>
+  </AccessGroup>
+</Schema>
 '''
 		self.__thrift_address = thrift_address
 		self.__thrift_port = thrift_port
 		self.__trusted = trusted
-		self.__queries = {}
+		self.__flush_interval = flush_interval
+		self.__use_indexes = use_indexes
+		self.__require_indexes = require_indexes
+		self.__projection = projection
+		self.__LoadIndexDefinitions(app_root)
+		self.__pool = ThriftClientPool(thrift_address, thrift_port,
+										size=pool_size)
+		self.__queries = _CursorRegistry(max_cursors, cursor_memory,
+										cursor_ttl)
+
+		# opened namespace ids keyed by (app, namespace) and the
+		# (app, namespace, kind) tables known to exist.
+		self.__namespaces = {}
+		self.__tables = set()
 		
-		self.__id_lock = threading.Lock()
-		self.__id_map = {}
+		self.__ids = _IdAllocator(self.__LeaseIdBlocks)
 		
 		# transaction support
+		# open transactions by handle; the lock only guards the dict.
 		self.__next_tx_handle = 1
-		self.__tx_writes = {}
-		self.__tx_deletes = set()
-		self.__tx_actions = []
+		self.__transactions = {}
 		self.__tx_lock = threading.Lock()
 
 		super(HypertableStub, self).__init__(service_name)
@@ -381,27 +1012,73 @@ class HypertableStub(apiproxy_stub.APIProxyStub):
 		
 		This is mainly for testing purposes and the admin console.
 		"""
-		self.__queries = {}
+		self.__queries.Clear()
 		self.__query_history = {}
 		self.__indexes = {}
-		self.__id_map = {}
+		self.__ids = _IdAllocator(self.__LeaseIdBlocks)
 		self.__next_tx_handle = 1
-		self.__tx_writes = {}
-		self.__tx_deletes = set()
-		self.__tx_actions = []
+		self.__transactions = {}
+		self._InvalidateSchemaCache()
 
 	def _GetThriftClient(self):
-		"""Get a new Thrift connection"""
-		return ThriftClient(self.__thrift_address, self.__thrift_port)
+		"""Borrow a Thrift connection from the pool.
+
+		Calling close() on the returned client hands it back to the pool.
+		"""
+		return self.__pool.get()
 
-	def _Create_Obj_Datastore(self, client, kind, namespace):
-		namespace = '%s/%s' %(self.__app_id, namespace)
-		if not client.exists_namespace(namespace):
-			ns = client.create_namespace(namespace)
-		ns = client.open_namespace(namespace)
+	def PoolStats(self):
+		"""Returns the connection pool hit/miss counters."""
+		return self.__pool.stats()
 
+	def CursorStats(self):
+		"""Returns the number and size of open query cursors."""
+		return self.__queries.Stats()
+
+	def _OpenNamespace(self, client, namespace, create=False):
+		"""Get the id of the app's Hypertable namespace, opening it only once.
+
+		Args:
+			client: a Thrift connection
+			namespace: the datastore namespace
+			create: create the Hypertable namespace if it does not exist
+		"""
+		cache_key = (self.__app_id, namespace)
+		ns = self.__namespaces.get(cache_key)
+		if ns is None:
+			name = '%s/%s' % cache_key
+			if create and not client.exists_namespace(name):
+				client.create_namespace(name)
+			ns = client.open_namespace(name)
+			self.__namespaces[cache_key] = ns
+		return ns
+
+	def _InvalidateSchemaCache(self, namespace=None, kind=None):
+		"""Forget cached namespace ids and tables.
+
+		With a kind only that table is forgotten, otherwise the whole cache is
+		dropped, e.g. after a ClientException left it in doubt.
+		"""
+		if kind is not None:
+			self.__tables.discard((self.__app_id, namespace, kind))
+		else:
+			self.__namespaces = {}
+			self.__tables = set()
+
+	def _Create_Obj_Datastore(self, client, kind, namespace, indexed=True):
+		"""Make sure the table for kind, and its index table, exist once per
+		process."""
+		table_key = (self.__app_id, namespace, kind)
+		ns = self.__namespaces.get((self.__app_id, namespace))
+		if ns is not None and table_key in self.__tables:
+			return ns
+
+		ns = self._OpenNamespace(client, namespace, create=True)
 		if not client.exists_table(ns, kind):
 			client.create_table(ns, kind, self.__schema)
+		if indexed and not client.exists_table(ns, _INDEX_TABLE % kind):
+			client.create_table(ns, _INDEX_TABLE % kind, self.__index_schema)
+		self.__tables.add(table_key)
 		return ns
 		
 	def _AppIdNamespaceKindForKey(self, key):
@@ -474,27 +1151,62 @@ class HypertableStub(apiproxy_stub.APIProxyStub):
 	def __get_cells(self, client, ns, key, kind, columns):
 		"""Get the Hypertable cells having the key
 		"""
-		row_spec = RowInterval(start_row = key,
+		return self.__get_rows(client, ns, kind, [key], columns).get(key, [])
+
+	def __get_rows(self, client, ns, kind, keys, columns):
+		"""Get the Hypertable cells of many rows with a single scanner.
+
+		Returns:
+			dict mapping each row key that exists to its list of cells.
+		"""
+		row_intervals = [RowInterval(start_row = key,
 									start_inclusive = True,
 									end_row = key,
 									end_inclusive = True)
+						for key in sorted(set(keys))]
 		scanner_id = client.open_scanner(ns, kind,
 										ScanSpec(columns = columns,
-												row_intervals = [row_spec],
+												row_intervals = row_intervals,
 												row_limit = 0,
 												revs = 1),
 										True);
-		total_cells = []
-		while True:
-			cells = client.next_cells(scanner_id)
-			if len(cells) > 0:
-				total_cells += cells
-			else:
-				break
-		
-		client.close_scanner(scanner_id)
-		return total_cells
+		rows = {}
+		try:
+			while True:
+				cells = client.next_cells(scanner_id)
+				if not cells:
+					break
+				for cell in cells:
+					rows.setdefault(cell.key.row, []).append(cell)
+		finally:
+			client.close_scanner(scanner_id)
+		return rows
 	
+	def __get_row_values(self, client, ns, kind, keys, columns):
+		"""Like __get_rows, but reads the cells as one serialized buffer.
+
+		Returns:
+			dict mapping each row key that exists to a list of
+			(column family, column qualifier, value) of its cells.
+		"""
+		row_intervals = [RowInterval(start_row = key,
+									start_inclusive = True,
+									end_row = key,
+									end_inclusive = True)
+						for key in sorted(set(keys))]
+		if not row_intervals:
+			return {}
+		page = client.get_cells_serialized(ns, kind,
+										ScanSpec(columns = columns,
+												row_intervals = row_intervals,
+												row_limit = 0,
+												revs = 1))
+		rows = {}
+		for row, family, qualifier, value in \
+				hypertable_serialized.SerializedCellsReader(page):
+			rows.setdefault(row, []).append((family, qualifier, value))
+		return rows
+
 	def __set_cell(self, client, ns, key, kind, family, qualifier, value):
 		"""Set the Hypertable cells with the provided keys and values
 		"""
@@ -509,70 +1221,157 @@ class HypertableStub(apiproxy_stub.APIProxyStub):
 		client.set_cell(mutator, cell)
 		client.close_mutator(mutator, True);
 
-	def __AllocateIds(self, kind, size=None, max=None):
-		"""Allocates IDs.
+	def __set_cells(self, client, groups, shared=True):
+		"""Write batches of cells, one mutator per table, as serialized
+		buffers; the broker's periodic mutator only takes Cell lists.
 
 		Args:
-			kind: A kind.
-			size: Number of IDs to allocate.
-			max: Upper bound of IDs to allocate.
+			client: a Thrift connection
+			groups: dict mapping (ns, kind) to a list of Cells
+			shared: whether the cells may go through the broker's periodic
+				mutator when a flush interval is set
+		"""
+		for (ns, kind), cells in groups.iteritems():
+			if shared and self.__flush_interval:
+				client.offer_cells(ns, kind,
+								MutateSpec(appname=self.__app_id,
+											flush_interval=self.__flush_interval,
+											flags=0),
+								cells)
+				continue
+			writer = hypertable_serialized.SerializedCellsWriter()
+			for cell in cells:
+				writer.add(cell.key.row, cell.key.column_family,
+						cell.key.column_qualifier, cell.value, cell.key.flag)
+			mutator = client.open_mutator(ns, kind, 0, 0)
+			try:
+				client.set_cells_serialized(mutator, writer.finalize(), False)
+			finally:
+				client.close_mutator(mutator, True)
+
+	def __IdBlockHint(self, client, ns, kind):
+		"""Returns the first ID block of kind that may still be free.
+
+		Stores that predate block leases only kept the next free ID.
+		"""
+		cells = self.__get_cells(client, ns, 'IdSeq_%s' % kind, 'datastore',
+								['meta'])
+		values = dict((cell.key.column_qualifier, cell.value) for cell in cells)
+		if values.get('next_block'):
+			return int(values['next_block'])
+		next_id = int(values.get('next_id') or 1)
+		return (next_id + _ID_BLOCK_SIZE - 2) // _ID_BLOCK_SIZE
+
+	def __LeaseIdBlocks(self, kind, count):
+		"""Leases count consecutive ID blocks of kind for this process.
+
+		A block is claimed by writing a cell to its row named after a token
+		unique to the claim. Of all the claims on a block, the one Hypertable
+		gave the lowest revision owns it, so processes racing for a block
+		agree on the winner and the losers move on to the next one. The next
+		block worth trying is kept as a hint.
 
 		Returns:
-			Integer as the beginning of a range of size IDs.
+			the number of the first block
 		"""
 		client = self._GetThriftClient()
-		self.__id_lock.acquire()
-		ret = None
-		_id = 'IdSeq_%s' % kind
-		
-		ns = self._Create_Obj_Datastore(client, 'datastore', '')
-		
 		try:
-			current_next_id = int(self.__get_cells(client, ns, _id, 'datastore', ['meta'])[0].value)
-		except:
-			current_next_id = 0
-
-		if not current_next_id:
-			self.__set_cell(client, ns, _id, 'datastore', 'meta', 'next_id', '1')
-			current_next_id = 1
-		if size is not None:
-			assert size > 0
-			next_id, block_size = self.__id_map.get(kind, (0, 0))
-			if not block_size:
-				block_size = (size / 1000 + 1) * 1000
-				incr = next_id + block_size
-				self.__set_cell(client, ns, _id, 'datastore', 'meta', 'next_id', str(current_next_id + incr))
-				next_id = current_next_id + incr
-				current_next_id += incr
-			if size > block_size:
-				incr = size
-				self.__set_cell(client, ns, _id, 'datastore', 'meta', 'next_id', str(current_next_id + incr))
-				ret = current_next_id + incr
-				current_next_id += incr
-			else:
-				ret = next_id;
-				next_id += size
-				block_size -= size
-				self.__id_map[kind] = (next_id, block_size)
+			ns = self._Create_Obj_Datastore(client, 'datastore', '', indexed=False)
+			first = self.__IdBlockHint(client, ns, kind)
+			while True:
+				lost = self.__ClaimIdBlocks(client, ns, kind, first, count)
+				if lost is None:
+					break
+				# blocks reserved up to a max may lie past the lost one.
+				first = max(lost + 1, self.__IdBlockHint(client, ns, kind))
+			self.__set_cell(client, ns, 'IdSeq_%s' % kind, 'datastore', 'meta',
+							'next_block', str(first + count))
+			return first
+		finally:
+			client.close()
+
+	def __ClaimIdBlocks(self, client, ns, kind, first, count):
+		"""Claims the ID blocks first to first + count - 1 of kind.
+
+		Returns:
+			None if every claim won, otherwise the last block lost.
+		"""
+		token = uuid.uuid4().hex
+		rows = ['IdSeq_%s/%d' % (kind, number)
+				for number in range(first, first + count)]
+		mutator = client.open_mutator(ns, 'datastore', 0, 0)
+		try:
+			client.set_cells(mutator, [Cell(Key(row = row,
+												column_family = 'meta',
+												column_qualifier = token,
+												flag = 255),
+											'')
+										for row in rows])
+		finally:
+			client.close_mutator(mutator, True)
+
+		claims = self.__get_rows(client, ns, 'datastore', rows, ['meta'])
+		lost = None
+		for number, row in enumerate(rows):
+			claimants = [(cell.key.revision, cell.key.timestamp,
+						cell.key.column_qualifier)
+						for cell in claims.get(row, [])]
+			if not claimants or min(claimants)[2] != token:
+				lost = first + number
+		return lost
+
+	def __ReserveIdBlocks(self, kind, max_id):
+		"""Claims the ID blocks of kind up to the one holding max_id, so that
+		no lease can hand out an ID up to max_id any more.
+
+		The hint is moved past the reserved blocks first, so that new leases
+		start after them, and the blocks below it are then claimed as a lease
+		claims them. Blocks another process won are already its own.
+
+		Returns:
+			the number of the first block that may have been free
+		"""
+		last = (max_id - 1) // _ID_BLOCK_SIZE
+		client = self._GetThriftClient()
+		try:
+			ns = self._Create_Obj_Datastore(client, 'datastore', '', indexed=False)
+			first = self.__IdBlockHint(client, ns, kind)
+			if last < first:
+				return first
+			self.__set_cell(client, ns, 'IdSeq_%s' % kind, 'datastore', 'meta',
+							'next_block', str(last + 1))
+			for number in xrange(first, last + 1, _ID_RESERVE_BLOCKS):
+				self.__ClaimIdBlocks(client, ns, kind, number,
+									min(_ID_RESERVE_BLOCKS, last + 1 - number))
+			return first
+		finally:
+			client.close()
+
+	def _Dynamic_AllocateIds(self, allocate_ids_request, allocate_ids_response):
+		model_key = allocate_ids_request.model_key()
+		self.__ValidateAppId(model_key.app())
+
+		if allocate_ids_request.has_size() and allocate_ids_request.has_max():
+			raise apiproxy_errors.ApplicationError(datastore_pb.Error.BAD_REQUEST,
+											'Both size and max cannot be set.')
+		kind = model_key.path().element_list()[-1].type()
+		if allocate_ids_request.has_size():
+			start, end = self.__ids.Range(kind, allocate_ids_request.size())
 		else:
-			next_id_from_cell =int(self.__get_cells(client, ns, _id, 'datastore', ['meta'])[0].value)
-			if max and max >= next_id_from_cell:
-				self.__set_cell(client, ns, _id, 'datastore', 'meta', 'next_id', str(max + 1))
-		
-		self.__id_lock.release()
-		client.close()
-		return ret
+			max_id = allocate_ids_request.max()
+			first = self.__ReserveIdBlocks(kind, max_id)
+			self.__ids.Reserve(kind, max_id)
+			start = first * _ID_BLOCK_SIZE + 1
+			end = max(max_id, start - 1)
+
+		allocate_ids_response.set_start(start)
+		allocate_ids_response.set_end(end)
 
 	def __GenerateNewKey(self, kind):
 		return datastore_types.Key.from_path( kind, str(uuid.uuid4()).replace('-', ''), _app=self.__app_id )
 	
-	def __PutEntities(self, entities):
-		"""Inserts or updates entities in the DB.
-		
-		Args:
-			entities: A list of entities to store.
-		"""
-		client = self._GetThriftClient()
+	def __EntityCells(self, client, entities, groups):
+		"""Add a cell storing each entity to groups, keyed by (ns, kind)."""
 		for entity in entities:
 			kind = self.__GetEntityKind(entity)
 			namespace = entity.key().name_space()
@@ -581,33 +1380,579 @@ class HypertableStub(apiproxy_stub.APIProxyStub):
 			key = datastore_types.Key._FromPb(entity.key())
 			# encode the key
 			encoded_key = str(key)
-			self.__set_cell(client, ns, encoded_key, kind, 'entity', 'proto', str(buffer(entity.Encode())))
-		client.close()
-		
-	def __DeleteEntities(self, keys):
-		"""Deletes entities from the DB.
-		
-		Args:
-			keys: A list of keys to delete index entries for.
-		Returns:
-			The number of rows deleted.
+			cell = Cell(
+						Key(
+							row = encoded_key,
+							column_family = 'entity',
+							column_qualifier = 'proto',
+							flag = 255),
+						str(buffer(entity.Encode())))
+			groups.setdefault((ns, kind), []).append(cell)
+
+	def __DeleteCells(self, client, keys, groups):
+		"""Add a cell deleting the entity of each key to groups, keyed by
+		(ns, kind).
+
+		Only the entity column family goes, so the version and commit claims of
+		an entity group outlive its root entity.
 		"""
-		client = self._GetThriftClient()
-		keys = [datastore_types.Key._FromPb(key) for key in keys]
 		for key in keys:
+			key = datastore_types.Key._FromPb(key)
 			kind, namespace = key.kind(), key.namespace()
-			ns = client.open_namespace('%s/%s' %(self.__app_id, namespace))
-			mutator = client.open_mutator(ns, kind, 0, 0)
+			ns = self._OpenNamespace(client, namespace)
 			key = str(key)
 			log.debug('deleting cells with key: %s' %key)
 			this_key_cells = Cell(
 								Key(
 									row = key,
-									flag = 0),
+									column_family = 'entity',
+									flag = KeyFlag.DELETE_CF),
 								)
-			client.set_cells(mutator, [this_key_cells])
-			client.close_mutator(mutator, True);
-		client.close()
+			groups.setdefault((ns, kind), []).append(this_key_cells)
+
+	def __IndexRows(self, entity):
+		"""Returns the set of index row keys for an EntityProto.
+
+		Every indexed property value gets a single-property row, and every
+		composite index of the kind from index.yaml gets one row for each
+		combination of the entity's values for its properties.
+		"""
+		key_value = self.__EncodeIndexPB(entity.key())
+		key_part = binascii.hexlify(key_value)
+		values = {datastore_types._KEY_SPECIAL_PROPERTY: [key_value]}
+		rows = set()
+		for prop in entity.property_list():
+			value = self.__EncodeIndexPB(prop.value())
+			values.setdefault(prop.name(), []).append(value)
+			rows.add(_INDEX_SEP.join((binascii.hexlify(prop.name()),
+									binascii.hexlify(value),
+									key_part)))
+
+		kind = self.__GetEntityKind(entity)
+		for index_id, props in self.__composite_indexes.get(kind, ()):
+			if [name for name, direction in props if name not in values]:
+				continue
+			columns = [[_IndexComponent(encoded, direction)
+						for encoded in values[name]]
+					for name, direction in props]
+			for combination in itertools.product(*columns):
+				rows.add(index_id + _INDEX_SEP + ''.join(combination) + key_part)
+		return rows
+
+	def __IndexCells(self, client, entities, keys, groups):
+		"""Add the cells that keep property indexes in step with a write.
+
+		Index rows of the stored version of each written or deleted entity are
+		removed unless the new version still has them. Queries re-check every
+		entity they fetch through an index, so a stale row left behind by a
+		failed write only costs an extra lookup.
+		"""
+		new_rows = {}
+		stored = {}
+		for entity in entities:
+			kind = self.__GetEntityKind(entity)
+			namespace = entity.key().name_space()
+			ns = self._Create_Obj_Datastore(client, kind, namespace)
+			encoded_key = str(datastore_types.Key._FromPb(entity.key()))
+			new_rows[(ns, kind, encoded_key)] = self.__IndexRows(entity)
+			stored.setdefault((ns, kind), {})[encoded_key] = entity.key()
+		for key in keys:
+			key_obj = datastore_types.Key._FromPb(key)
+			if not self.__HasTable(client, key_obj.namespace(),
+									_INDEX_TABLE % key_obj.kind(), key_obj.kind()):
+				# no index rows to remove
+				continue
+			ns = self._OpenNamespace(client, key_obj.namespace())
+			new_rows[(ns, key_obj.kind(), str(key_obj))] = set()
+			stored.setdefault((ns, key_obj.kind()), {})[str(key_obj)] = key
+
+		for (ns, kind), key_pbs in stored.iteritems():
+			index_cells = groups.setdefault((ns, _INDEX_TABLE % kind), [])
+			old_rows = self.__get_row_values(client, ns, kind, key_pbs.keys(),
+											['entity'])
+			for encoded_key, key_pb in key_pbs.iteritems():
+				rows = new_rows[(ns, kind, encoded_key)]
+				for family, qualifier, value in old_rows.get(encoded_key, []):
+					old_entity = entity_pb.EntityProto(str(value))
+					old_entity.mutable_key().CopyFrom(key_pb)
+					for row in self.__IndexRows(old_entity) - rows:
+						index_cells.append(Cell(Key(row = row, flag = 0)))
+				index_cells.extend(self.__IndexRowCells(rows, encoded_key))
+
+	@staticmethod
+	def __IndexRowCells(rows, encoded_key):
+		return [Cell(
+					Key(
+						row = row,
+						column_family = 'ref',
+						column_qualifier = '',
+						flag = 255),
+					encoded_key)
+				for row in rows]
+
+	def __IndexRange(self, prefix, filters):
+		"""Returns the RowInterval of the index rows under prefix whose next
+		value can satisfy filters.
+
+		Args:
+			prefix: row prefix that the next (ascending) value follows
+			filters: Query_Filters, all on the property of that value
+		"""
+		start, end = prefix, prefix + _INDEX_PREFIX_END
+		for filt in filters:
+			if filt.op() not in _INDEX_RANGE_BOUNDS:
+				continue
+			value = prefix + binascii.hexlify(
+					self.__EncodeIndexPB(filt.property(0).value()))
+			lower, upper = _INDEX_RANGE_BOUNDS[filt.op()]
+			if lower is not None:
+				start = max(start, value + lower)
+			if upper is not None:
+				end = min(end, value + upper)
+		return RowInterval(start_row = start,
+							start_inclusive = True,
+							end_row = end,
+							end_inclusive = False)
+
+	def __PropertyRange(self, prop, filters):
+		"""Returns the single-property index range for filters on prop."""
+		return self.__IndexRange(binascii.hexlify(prop) + _INDEX_SEP,
+								[f for f in filters if f.property(0).name() == prop])
+
+	@staticmethod
+	def __QueryProperties(filters, orders):
+		"""Returns the names of the properties a query filters or sorts on."""
+		names = set(f.property(0).name() for f in filters)
+		names.update(o.property() for o in orders)
+		return names
+
+	def __KindScanPlan(self, query, filters, orders):
+		"""Queries on kind alone, or sorted by key, scan the kind table."""
+		names = self.__QueryProperties(filters, orders)
+		if names.issubset([datastore_types._KEY_SPECIAL_PROPERTY]):
+			return []
+
+	def __SinglePropertyPlan(self, query, filters, orders):
+		"""Filters and orders on one property read its single-property index."""
+		names = self.__QueryProperties(filters, orders)
+		if len(names) != 1:
+			return None
+		prop = names.pop()
+		if prop.decode('utf-8') in datastore_types._SPECIAL_PROPERTIES:
+			return None
+		if len([f for f in filters
+				if f.op() == datastore_pb.Query_Filter.EQUAL]) > 1:
+			return None
+		if not filters and not self.__IndexReadLimit(query):
+			# the index would only order every entity of the kind, fetched one
+			# row interval each; scanning the kind reads less.
+			return []
+		return [self.__PropertyRange(prop, filters)]
+
+	def __MergeJoinPlan(self, query, filters, orders):
+		"""Equality filters only: intersect the single-property ranges."""
+		if orders:
+			return None
+		for filt in filters:
+			if filt.op() != datastore_pb.Query_Filter.EQUAL:
+				return None
+			if (filt.property(0).name().decode('utf-8') in
+					datastore_types._SPECIAL_PROPERTIES):
+				return None
+		return [self.__IndexRange(binascii.hexlify(f.property(0).name()) +
+									_INDEX_SEP, [f])
+				for f in filters]
+
+	def __CompositePlan(self, query, filters, orders):
+		"""Reads a composite index from index.yaml that matches the query.
+
+		The equality values and an inequality on the next (ascending)
+		property of the index bound the range.
+		"""
+		index = self.__FindIndexForQuery(query)
+		if index is None or query.has_ancestor():
+			return None
+		index_id, props = index
+		equality = {}
+		for filt in filters:
+			if filt.op() == datastore_pb.Query_Filter.EQUAL:
+				name = filt.property(0).name()
+				if name in equality:
+					return None
+				equality[name] = filt
+
+		prefix = index_id + _INDEX_SEP
+		for name, direction in props:
+			if name not in equality:
+				break
+			value = self.__EncodeIndexPB(equality.pop(name).property(0).value())
+			prefix += _IndexComponent(value, direction)
+		else:
+			name, direction = None, None
+		if equality:
+			return None
+
+		if direction == datastore_index.ASCENDING:
+			return [self.__IndexRange(prefix,
+					[f for f in filters if f.property(0).name() == name])]
+		return [self.__IndexRange(prefix, [])]
+
+	def __LastResortPlan(self, query, filters, orders):
+		"""Narrows the scan with one filter or order, or scans the kind.
+
+		With require_indexes, queries that need a composite index that is not
+		defined in index.yaml are rejected instead.
+		"""
+		if self.__require_indexes:
+			required = datastore_index.CompositeIndexForQuery(query)[0]
+			if required and self.__FindIndexForQuery(query, True) is None:
+				raise apiproxy_errors.ApplicationError(
+					datastore_pb.Error.NEED_INDEX,
+					'This query requires a composite index that is not defined. '
+					'You must update the index.yaml file in your application root.')
+
+		for filt in filters:
+			if filt.op() == datastore_pb.Query_Filter.EQUAL:
+				break
+		else:
+			filt = filters and filters[0] or None
+		if filt is not None:
+			prop = filt.property(0).name()
+		elif len(orders) == 1:
+			prop = orders[0].property()
+		else:
+			return []
+		if prop.decode('utf-8') in datastore_types._SPECIAL_PROPERTIES:
+			return []
+		if filt is not None and filt.op() == datastore_pb.Query_Filter.EQUAL:
+			return [self.__PropertyRange(prop, [filt])]
+		return [self.__PropertyRange(prop, filters)]
+
+	_QUERY_STRATEGIES = [
+		__KindScanPlan,
+		__SinglePropertyPlan,
+		__MergeJoinPlan,
+		__CompositePlan,
+		__LastResortPlan,
+	]
+
+	def __PlanQuery(self, query):
+		"""Chooses how to find the candidate entities of a query.
+
+		Returns:
+			A list of RowIntervals over the kind's index table whose entity
+			keys are intersected, or an empty list to scan the kind table.
+		"""
+		filters = query.filter_list()
+		orders = query.order_list()
+		if not self.__use_indexes:
+			return []
+		for strategy in self._QUERY_STRATEGIES:
+			plan = strategy(self, query, filters, orders)
+			if plan is not None:
+				return plan
+
+	@staticmethod
+	def __IndexReadLimit(query, index_plan=None):
+		"""Returns how many rows of its index plan an ordered query needs, or 0
+		if it needs every row in the range.
+
+		Single-property index rows sort by value, then key, so a query that
+		sorts ascending on the only property it filters on finds its first
+		offset + limit results among as many index rows, unless duplicate or
+		stale rows take their place.
+
+		Args:
+			query: A datastore_pb.Query PB.
+			index_plan: the RowIntervals __PlanQuery chose, or None to only
+				check the query
+		"""
+		orders = query.order_list()
+		if (len(orders) != 1 or
+				orders[0].direction() != datastore_pb.Query_Order.ASCENDING or
+				not query.has_limit() or query.has_compiled_cursor() or
+				query.has_end_compiled_cursor()):
+			return 0
+		prop = orders[0].property()
+		if [f for f in query.filter_list() if f.property(0).name() != prop]:
+			return 0
+		if index_plan is not None and (len(index_plan) != 1 or
+				not index_plan[0].start_row.startswith(
+					binascii.hexlify(prop) + _INDEX_SEP)):
+			return 0
+		return query.offset() + query.limit()
+
+	def __FindIndexForQuery(self, query, include_ancestor=False):
+		"""Finds an index from index.yaml that can satisfy the query.
+
+		Args:
+			query: A datastore_pb.Query PB.
+			include_ancestor: also match ancestor indexes, which are defined but
+				not materialized.
+		Returns:
+			(index_id, props) of a suitable index, otherwise None.
+		"""
+		unused_required, kind, ancestor, props, num_eq_filters = (
+			datastore_index.CompositeIndexForQuery(query))
+		eq_filters_set = set(props[:num_eq_filters])
+		remaining_filters = props[num_eq_filters:]
+		indexes = self.__composite_indexes.get(kind, [])
+		if include_ancestor:
+			indexes = indexes + self.__ancestor_indexes.get(kind, [])
+		for index_id, index_props in indexes:
+			index_ancestor = index_id in self.__ancestor_index_ids
+			if index_ancestor != ancestor:
+				continue
+			if index_props == props:
+				return index_id, index_props
+			if num_eq_filters > 1:
+				this_eq_filters_set = set(index_props[:num_eq_filters])
+				this_remaining_filters = index_props[num_eq_filters:]
+				if (eq_filters_set == this_eq_filters_set and
+						remaining_filters == this_remaining_filters):
+					return index_id, index_props
+
+	def __LoadIndexDefinitions(self, app_root):
+		"""Reads the composite indexes of the app from its index.yaml."""
+		self.__composite_indexes = {}
+		self.__ancestor_indexes = {}
+		self.__ancestor_index_ids = set()
+		if not app_root:
+			return
+		try:
+			document = open(os.path.join(app_root, 'index.yaml'), 'r')
+		except IOError:
+			return
+		try:
+			index_defs = datastore_index.ParseIndexDefinitions(document)
+		finally:
+			document.close()
+		if index_defs is None or not index_defs.indexes:
+			return
+
+		for index in index_defs.indexes:
+			kind, ancestor, props = datastore_index.IndexToKey(index)
+			index_id = _COMPOSITE_INDEX_PREFIX + hashlib.md5(
+					repr((ancestor, props))).hexdigest()[:16]
+			if ancestor:
+				self.__ancestor_index_ids.add(index_id)
+				self.__ancestor_indexes.setdefault(kind, []).append((index_id, props))
+			else:
+				self.__composite_indexes.setdefault(kind, []).append((index_id, props))
+
+	def __IndexLookup(self, client, ns, kind, row_intervals, row_limit=0):
+		"""Returns the encoded keys of the entities found in all of the index
+		ranges, in index order, or None if the kind has no index table yet.
+
+		A row_limit only reads that many rows of each range."""
+		found = None
+		for row_interval in row_intervals:
+			keys = self.__IndexScan(client, ns, kind, row_interval, row_limit)
+			if keys is None:
+				return None
+			if found is None:
+				found = keys
+			else:
+				keys = set(keys)
+				found = [key for key in found if key in keys]
+			if not found:
+				break
+		return found
+
+	def __IndexScan(self, client, ns, kind, row_interval, row_limit=0):
+		"""Returns the encoded entity keys in the first row_limit rows, or all
+		rows, of an index range, or None if the kind has no index table yet."""
+		scanner_id = None
+		keys = []
+		try:
+			if row_interval.start_row < row_interval.end_row:
+				scanner_id = client.open_scanner(ns, _INDEX_TABLE % kind,
+										ScanSpec(columns = ['ref'],
+												row_intervals = [row_interval],
+												row_limit = row_limit,
+												revs = 1),
+										True)
+				while True:
+					cells = client.next_cells(scanner_id)
+					if not cells:
+						break
+					keys.extend(cell.value for cell in cells)
+		except ClientException:
+			log.debug('no index table for %s' % kind)
+			return None
+		finally:
+			if scanner_id:
+				client.close_scanner(scanner_id)
+		return keys
+
+	def BackfillIndexes(self, namespace='', kinds=None):
+		"""Writes the index rows of entities that are already stored.
+
+		Meant to be run offline, after index.yaml gained new indexes or for
+		data written before indexes were maintained. Rows of indexes that
+		were removed from index.yaml are left alone.
+
+		Args:
+			namespace: the datastore namespace to index
+			kinds: the kinds to index, all kinds of the namespace by default
+
+		Returns:
+			The number of entities indexed.
+		"""
+		client = self._GetThriftClient()
+		try:
+			ns = self._OpenNamespace(client, namespace)
+			if kinds is None:
+				# the 'datastore' table holds the id sequences.
+				kinds = [table for table in client.get_tables(ns)
+						if not table.endswith(_INDEX_TABLE % '') and
+						table != 'datastore']
+			count = 0
+			for kind in kinds:
+				self._Create_Obj_Datastore(client, kind, namespace)
+				scanner_id = client.open_scanner(ns, kind,
+												ScanSpec(columns = ['entity'],
+														row_limit = 0,
+														revs = 1),
+												True)
+				try:
+					while True:
+						cells = client.next_cells(scanner_id)
+						if not cells:
+							break
+						index_cells = []
+						for cell in cells:
+							if cell.key.column_qualifier != 'proto':
+								continue
+							entity = entity_pb.EntityProto(str(cell.value))
+							key = datastore_types.Key(encoded=cell.key.row)
+							entity.mutable_key().CopyFrom(key._ToPb())
+							index_cells.extend(self.__IndexRowCells(
+									self.__IndexRows(entity), cell.key.row))
+							count += 1
+						if index_cells:
+							self.__set_cells(client, {(ns, _INDEX_TABLE % kind): index_cells})
+				finally:
+					client.close_scanner(scanner_id)
+				log.info('indexed kind %s of %s/%s' % (kind, self.__app_id, namespace))
+		finally:
+			client.close()
+		return count
+
+	def __WriteEntities(self, entities=(), keys=()):
+		"""Stores entities and deletes keys with one mutator per kind.
+
+		The writes claim their entity groups as a commit does, so that they
+		never land between a transaction's check of a group and its own
+		writes, and wait for commits that hold the groups.
+
+		Args:
+			entities: A list of entities to store.
+			keys: A list of keys to delete.
+
+		Raises:
+			apiproxy_errors.ApplicationError: CONCURRENT_TRANSACTION if commits
+				kept the entity groups claimed.
+		"""
+		groups = dict.fromkeys(
+			[self.__EntityGroup(entity.key()) for entity in entities] +
+			[self.__EntityGroup(key) for key in keys])
+		for attempt in xrange(_TX_WRITE_RETRIES):
+			if self.__ApplyClaimed(groups, entities, keys, False):
+				return
+			time.sleep(_TX_WRITE_BACKOFF * 2 ** attempt)
+		raise apiproxy_errors.ApplicationError(
+			datastore_pb.Error.CONCURRENT_TRANSACTION, 'Concurrency exception.')
+
+	def __MutationCells(self, client, entities, keys):
+		"""Returns the cells that store entities and delete keys, grouped by
+		(ns, kind): index upkeep, the entities, the row deletes and a new
+		version for every entity group written."""
+		groups = {}
+		keys = self.__StoredKeys(client, keys)
+		self.__IndexCells(client, entities, keys, groups)
+		self.__EntityCells(client, entities, groups)
+		self.__DeleteCells(client, keys, groups)
+		self.__VersionCells(client, entities, keys, groups)
+		return groups
+
+	def __HasTable(self, client, namespace, table, kind=None):
+		"""Whether a table of the namespace exists, without creating it.
+
+		Args:
+			client: a Thrift connection
+			namespace: the datastore namespace
+			table: the table name
+			kind: the kind table is the table or index table of; tables of kinds
+				this process provisioned are known to exist
+		"""
+		if (self.__app_id, namespace, kind or table) in self.__tables:
+			return True
+		try:
+			ns = self._OpenNamespace(client, namespace)
+			return client.exists_table(ns, table)
+		except ClientException:
+			return False
+
+	def __StoredKeys(self, client, keys):
+		"""Returns the keys whose kind has a table, the only ones that can
+		have anything to delete."""
+		kinds = {}
+		stored = []
+		for key in keys:
+			key_obj = datastore_types.Key._FromPb(key)
+			kind = (key_obj.namespace(), key_obj.kind())
+			if kind not in kinds:
+				kinds[kind] = self.__HasTable(client, kind[0], kind[1])
+			if kinds[kind]:
+				stored.append(key)
+		return stored
+
+	@staticmethod
+	def __EntityGroup(key):
+		"""Returns (namespace, root kind, encoded root key) of the entity group
+		of a Reference."""
+		root = entity_pb.Reference()
+		root.set_app(key.app())
+		if key.has_name_space():
+			root.set_name_space(key.name_space())
+		root.mutable_path().add_element().CopyFrom(key.path().element(0))
+		return (key.name_space(), root.path().element(0).type(),
+				str(datastore_types.Key._FromPb(root)))
+
+	def __VersionCells(self, client, entities, keys, groups):
+		"""Add a cell rewriting the version of each entity group written.
+
+		The version is the 'meta:version' cell in the row of the group's root
+		entity; every write gives it a new revision.
+		"""
+		written = set(self.__EntityGroup(entity.key()) for entity in entities)
+		written.update(self.__EntityGroup(key) for key in keys)
+		for namespace, root_kind, root_row in sorted(written):
+			ns = self._Create_Obj_Datastore(client, root_kind, namespace)
+			groups.setdefault((ns, root_kind), []).append(Cell(
+						Key(
+							row = root_row,
+							column_family = 'meta',
+							column_qualifier = 'version',
+							flag = 255),
+						''))
+
+	def __PutEntities(self, entities):
+		"""Inserts or updates entities in the DB.
+		
+		Args:
+			entities: A list of entities to store.
+		"""
+		self.__WriteEntities(entities=entities)
+		
+	def __DeleteEntities(self, keys):
+		"""Deletes entities from the DB.
+		
+		Args:
+			keys: A list of keys to delete index entries for.
+		"""
+		self.__WriteEntities(keys=keys)
 
 	def _Dynamic_Put(self, put_request, put_response):
 		entities = put_request.entity_list()
@@ -623,7 +1968,7 @@ class HypertableStub(apiproxy_stub.APIProxyStub):
 			
 			last_path = entity.key().path().element_list()[-1]
 			if last_path.id() == 0 and not last_path.has_name():
-				id_ = self.__AllocateIds(last_path.type(), 1)
+				id_ = self.__ids.Next(last_path.type())
 				last_path.set_id(id_)
 				
 				assert entity.entity_group().element_size() == 0
@@ -634,11 +1979,14 @@ class HypertableStub(apiproxy_stub.APIProxyStub):
 				assert (entity.has_entity_group() and
 					entity.entity_group().element_size() > 0)
 				
-			if put_request.transaction().handle():
-				self.__tx_writes[entity.key()] = entity
-				self.__tx_deletes.discard(entity.key())
-		
-		if not put_request.transaction().handle():
+		if put_request.has_transaction():
+			tx = self.__ValidateTransaction(put_request.transaction())
+			self.__ObserveGroups(tx, [entity.key() for entity in entities])
+			for entity in entities:
+				encoded_key = str(datastore_types.Key._FromPb(entity.key()))
+				tx.writes[encoded_key] = entity
+				tx.deletes.pop(encoded_key, None)
+		else:
 			self.__PutEntities(entities)
 			
 		put_response.key_list().extend([e.key() for e in entities])
@@ -647,244 +1995,146 @@ class HypertableStub(apiproxy_stub.APIProxyStub):
 		keys = delete_request.key_list()
 		for key in keys:
 			self.__ValidateAppId(key.app())
-			if delete_request.transaction().handle():
-				self.__tx_deletes.add(key)
-				self.__tx_writes.pop(key, None)
-		
-		if not delete_request.transaction().handle():
+
+		if delete_request.has_transaction():
+			tx = self.__ValidateTransaction(delete_request.transaction())
+			self.__ObserveGroups(tx, keys)
+			for key in keys:
+				encoded_key = str(datastore_types.Key._FromPb(key))
+				tx.deletes[encoded_key] = key
+				tx.writes.pop(encoded_key, None)
+		else:
 			self.__DeleteEntities(delete_request.key_list())
 
 	def _Dynamic_Drop(self, drop_request, drop_response):
-		client = self._GetThriftClient()
 		kind = drop_request.kind
 		namespace = namespace_manager.get_namespace()
-		ns = client.open_namespace('%s/%s' %(self.__app_id, namespace))
-		client.drop_table(ns, kind, True)
-		client.close()
+		client = self._GetThriftClient()
+		try:
+			ns = self._OpenNamespace(client, namespace)
+			self._InvalidateSchemaCache(namespace, kind)
+			client.drop_table(ns, kind, True)
+			client.drop_table(ns, _INDEX_TABLE % kind, True)
+		finally:
+			client.close()
 	
 	def _Dynamic_Get(self, get_request, get_response):
-		client = self._GetThriftClient()
+		if get_request.has_transaction():
+			tx = self.__ValidateTransaction(get_request.transaction())
+			self.__ObserveGroups(tx, get_request.key_list())
+		# group the requested rows by table so each table is scanned once.
+		requested = []
+		tables = {}
 		for key in get_request.key_list():
 			appid_namespace, kind = self._AppIdNamespaceKindForKey(key)
 			namespace = appid_namespace.rsplit('!', 1)[1] if '!' in appid_namespace else ''
+			encoded_key = str(datastore_types.Key._FromPb(key))
+			requested.append((key, (namespace, kind), encoded_key))
+			tables.setdefault((namespace, kind), []).append(encoded_key)
 
-			total_cells = []
-			key_pb = key
-			key = datastore_types.Key._FromPb(key)
-			try:
-				ns = client.open_namespace('%s/%s' %(self.__app_id, namespace))
-				total_cells = self.__get_cells(client, ns, str(key), kind, ['entity'])
-			except ClientException:
-				log.warning('No data for %s' %kind)
+		found = {}
+		client = self._GetThriftClient()
+		try:
+			for (namespace, kind), encoded_keys in tables.iteritems():
+				try:
+					ns = self._OpenNamespace(client, namespace)
+					found[(namespace, kind)] = self.__get_row_values(
+								client, ns, kind, encoded_keys, ['entity'])
+				except ClientException:
+					log.warning('No data for %s' %kind)
+					self._InvalidateSchemaCache()
+		finally:
+			client.close()
 
+		# missing keys still get an (empty) result group, in request order.
+		for key_pb, table, encoded_key in requested:
 			group = get_response.add_entity()
-
-			for cell in total_cells:
-				if cell.key.column_family == 'entity' and cell.key.column_qualifier == 'proto':
-					entity_proto = entity_pb.EntityProto(str(cell.value))
+			for family, qualifier, value in found.get(table, {}).get(encoded_key, []):
+				if family == 'entity' and qualifier == 'proto':
+					entity_proto = entity_pb.EntityProto(str(value))
 					entity_proto.mutable_key().CopyFrom(key_pb)
 					group.mutable_entity().CopyFrom(entity_proto)
-		client.close()
 
-	def _Dynamic_RunQuery(self, query, query_result):
-		client = self._GetThriftClient()
+	def __OpenCursor(self, query, keys_only, ordered=True):
+		"""Starts running a query, returning its _Cursor.
+
+		Rows are read a batch at a time and sorted, by key when the query has
+		no sort orders. Queries that need not be ordered, because they are only
+		counted, stream their results instead. keys_only queries only decode
+		the properties they filter or sort on, as do all queries in projection
+		mode, and not even those when they have no filters or orders.
+		"""
+		index_plan = self.__PlanQuery(query)
 		kind = query.kind()
-		keys_only = query.keys_only()
 		filters = query.filter_list()
 		orders = query.order_list()
 		offset = query.offset()
 		limit = query.limit()
 		namespace = query.name_space()
 		
-		if filters or orders:
+		if ordered or filters or orders or not query.has_limit():
 			row_limit = 0
 		else:
 			row_limit = offset + limit
-		
-		scanner_id = None
-		try:
-			ns = client.open_namespace('%s/%s' %(self.__app_id, namespace))
-			scanner_id = client.open_scanner(ns, kind,
-											ScanSpec(columns = ['entity'],
-													row_limit = row_limit,
-													revs = 1,
-													keys_only = keys_only),
-											True);
-			total_cells = []
 
-			while True:
-				cells = client.next_cells(scanner_id)
-				if len(cells) > 0:
-					total_cells += cells
-				else:
-					break
-		except ClientException:
-			log.warning('No data for %s' %kind)
-			client.close()
-			return
-		finally:
-			if scanner_id:
-				client.close_scanner(scanner_id)
+		props = None
+		if keys_only or self.__projection:
+			props = self.__QueryProperties(filters, orders)
 		
-		# make a cell-key dictionary
-		key_cell_dict = {}
-		for cell in total_cells:
-			if key_cell_dict.has_key(cell.key.row):
-				key_cell_dict[cell.key.row].append(cell)
-			else:
-				key_cell_dict[cell.key.row] = [cell]
-				
-		pb_entities = []
-		for key in key_cell_dict:
-			key_obj = datastore_types.Key(encoded=key)
-			key_pb = key_obj._ToPb()
-			for cell in key_cell_dict[key]:
-				if cell.key.column_family == 'entity' and cell.key.column_qualifier == 'proto':
-					entity_proto = entity_pb.EntityProto(str(cell.value))
-					entity_proto.mutable_key().CopyFrom(key_pb)
-					pb_entities.append(entity_proto)
-		
-		results = map(lambda entity: datastore.Entity.FromPb(entity), pb_entities)
-	
+		index_limit = 0
+		if index_plan and orders and ordered:
+			index_limit = self.__IndexReadLimit(query, index_plan)
+
 		query.set_app(self.__app_id)
 		datastore_types.SetNamespace(query, namespace)
-		encoded = datastore_types.EncodeAppIdNamespace(self.__app_id, namespace)
-	
-		operators = {datastore_pb.Query_Filter.LESS_THAN:			 '<',
-					 datastore_pb.Query_Filter.LESS_THAN_OR_EQUAL:	'<=',
-					 datastore_pb.Query_Filter.GREATER_THAN:			'>',
-					 datastore_pb.Query_Filter.GREATER_THAN_OR_EQUAL: '>=',
-					 datastore_pb.Query_Filter.EQUAL:				 '==',
-					 }
-	
-		def has_prop_indexed(entity, prop):
-			"""Returns True if prop is in the entity and is indexed."""
-			if prop in datastore_types._SPECIAL_PROPERTIES:
-				return True
-			elif prop in entity.unindexed_properties():
-				return False
-	
-			values = entity.get(prop, [])
-			if not isinstance(values, (tuple, list)):
-				values = [values]
-	
-			for value in values:
-				if type(value) not in datastore_types._RAW_PROPERTY_TYPES:
-					return True
-			return False
-	
-		for filt in filters:
-			assert filt.op() != datastore_pb.Query_Filter.IN
-	
-			prop = filt.property(0).name().decode('utf-8')
-			op = operators[filt.op()]
-	
-			filter_val_list = [datastore_types.FromPropertyPb(filter_prop)
-							 for filter_prop in filt.property_list()]
-	
-			def passes_filter(entity):
-				"""Returns True if the entity passes the filter, False otherwise.
-		
-				The filter being evaluated is filt, the current filter that we're on
-				in the list of filters in the query.
-				"""
-				if not has_prop_indexed(entity, prop):
-					return False
-		
-				try:
-					entity_vals = datastore._GetPropertyValue(entity, prop)
-				except KeyError:
-					entity_vals = []
-		
-				if not isinstance(entity_vals, list):
-					entity_vals = [entity_vals]
-		
-				for fixed_entity_val in entity_vals:
-					for filter_val in filter_val_list:
-						fixed_entity_type = self._PROPERTY_TYPE_TAGS.get(
-																		fixed_entity_val.__class__)
-						filter_type = self._PROPERTY_TYPE_TAGS.get(filter_val.__class__)
-						if fixed_entity_type == filter_type:
-							comp = u'%r %s %r' % (fixed_entity_val, op, filter_val)
-						elif op != '==':
-							comp = '%r %s %r' % (fixed_entity_type, op, filter_type)
-						else:
-							continue
-		
-						logging.log(logging.DEBUG - 1,
-								'Evaling filter expression "%s"', comp)
-		
-						try:
-							ret = eval(comp)
-							if ret and ret != NotImplementedError:
-								return True
-						except TypeError:
-							pass
-		
-				return False
-	
-			results = filter(passes_filter, results)
-	
-		for order in orders:
-			prop = order.property().decode('utf-8')
-			results = [entity for entity in results if has_prop_indexed(entity, prop)]
-	
-		def order_compare_entities(a, b):
-			""" Return a negative, zero or positive number depending on whether
-			entity a is considered smaller than, equal to, or larger than b,
-			according to the query's orderings. """
-			cmped = 0
-			for o in orders:
-				prop = o.property().decode('utf-8')
-		
-				reverse = (o.direction() is datastore_pb.Query_Order.DESCENDING)
-		
-				a_val = datastore._GetPropertyValue(a, prop)
-				if isinstance(a_val, list):
-					a_val = sorted(a_val, order_compare_properties, reverse=reverse)[0]
-		
-				b_val = datastore._GetPropertyValue(b, prop)
-				if isinstance(b_val, list):
-					b_val = sorted(b_val, order_compare_properties, reverse=reverse)[0]
-		
-				cmped = order_compare_properties(a_val, b_val)
-		
-				if o.direction() is datastore_pb.Query_Order.DESCENDING:
-					cmped = -cmped
-	
-				if cmped != 0:
-					return cmped
-	
-			if cmped == 0:
-				return cmp(a.key(), b.key())
-	
-		def order_compare_properties(x, y):
-			"""Return a negative, zero or positive number depending on whether
-			property value x is considered smaller than, equal to, or larger than
-			property value y. If x and y are different types, they're compared based
-			on the type ordering used in the real datastore, which is based on the
-			tag numbers in the PropertyValue PB.
-			"""
-			if isinstance(x, datetime.datetime):
-				x = datastore_types.DatetimeToTimestamp(x)
-			if isinstance(y, datetime.datetime):
-				y = datastore_types.DatetimeToTimestamp(y)
-	
-			x_type = self._PROPERTY_TYPE_TAGS.get(x.__class__)
-			y_type = self._PROPERTY_TYPE_TAGS.get(y.__class__)
-	
-			if x_type == y_type:
-				try:
-					return cmp(x, y)
-				except TypeError:
-					return 0
-			else:
-				return cmp(x_type, y_type)
-	
-		results.sort(order_compare_entities)
+		order_compare_entities = datastore_query_eval.EntityComparator(orders)
+		matches = None
+		if filters or orders:
+			matches = datastore_query_eval.CompileFilters(filters, orders)
 
-		cursor = _Cursor(query, results, order_compare_entities)
-		self.__queries[cursor.cursor] = cursor
+		while True:
+			client = self._GetThriftClient()
+			try:
+				ns = self._OpenNamespace(client, namespace)
+				index_keys = None
+				if index_plan:
+					# the index narrows the candidates; they are still filtered.
+					index_keys = self.__IndexLookup(client, ns, kind, index_plan,
+													index_limit)
+			except ClientException:
+				log.warning('No data for %s' %kind)
+				self._InvalidateSchemaCache()
+				return _Cursor(query, [], order_compare_entities)
+			finally:
+				client.close()
+
+			stream = _ScanStream(self._GetThriftClient, ns, kind, keys_only,
+								matches, props, keys=index_keys,
+								row_limit=row_limit)
+			if not ordered:
+				return _Cursor(query, stream, None)
+
+			# rows are stored in the order of their encoded keys, so even
+			# queries without sort orders read every candidate to return them
+			# in key order. Limited queries only keep the first results.
+			results = datastore_query_eval.SortEntities(
+					stream, orders, datastore_query_eval.ResultLimit(query))
+			if (not index_limit or len(index_keys) < index_limit or
+					len(results) >= index_limit):
+				break
+			# duplicate or stale index rows took the place of results: read
+			# the whole range.
+			index_limit = 0
+
+		size = stream.bytes_read * len(results) // max(stream.rows_read, 1)
+		return _Cursor(query, results, order_compare_entities, size)
+
+	def _Dynamic_RunQuery(self, query, query_result):
+		if query.has_transaction() and query.has_ancestor():
+			tx = self.__ValidateTransaction(query.transaction())
+			self.__ObserveGroups(tx, [query.ancestor()])
+		cursor = self.__OpenCursor(query, query.keys_only())
+		self.__queries.Add(cursor)
 	
 		if query.has_count():
 			count = query.count()
@@ -900,7 +2150,6 @@ class HypertableStub(apiproxy_stub.APIProxyStub):
 			compiled_query = query_result.mutable_compiled_query()
 			compiled_query.set_keys_only(query.keys_only())
 			compiled_query.mutable_primaryscan().set_index_name(query.Encode())
-		client.close()
 	
 	def _Dynamic_Next(self, next_request, query_result):
 		self.__ValidateAppId(next_request.cursor().app())
@@ -908,7 +2157,7 @@ class HypertableStub(apiproxy_stub.APIProxyStub):
 		cursor_handle = next_request.cursor().cursor()
 	
 		try:
-			cursor = self.__queries[cursor_handle]
+			cursor = self.__queries.Get(cursor_handle)
 		except KeyError:
 			raise apiproxy_errors.ApplicationError(
 				datastore_pb.Error.BAD_REQUEST, 'Cursor %d not found' % cursor_handle)
@@ -923,11 +2172,16 @@ class HypertableStub(apiproxy_stub.APIProxyStub):
 									 next_request.compile())
 	
 	def _Dynamic_Count(self, query, integer64proto):
-		query_result = datastore_pb.QueryResult()
-		self._Dynamic_RunQuery(query, query_result)
-		cursor = query_result.cursor().cursor()
-		integer64proto.set_value(min(self.__queries[cursor].count, _MAXIMUM_RESULTS))
-		del self.__queries[cursor]
+		# counting needs no sort unless a compiled cursor positions the query
+		# by sort order. Entities are only decoded to evaluate filters.
+		ordered = (query.has_compiled_cursor() or
+					query.has_end_compiled_cursor())
+		cursor = self.__OpenCursor(query, True, ordered)
+		try:
+			count = cursor.Count(_MAXIMUM_RESULTS)
+		finally:
+			cursor.Close()
+		integer64proto.set_value(min(count, _MAXIMUM_RESULTS))
 
 	def __ValidateTransaction(self, tx):
 		"""Verify that this transaction exists and is valid.
@@ -935,23 +2189,271 @@ class HypertableStub(apiproxy_stub.APIProxyStub):
 		Args:
 			tx: datastore_pb.Transaction
 		
+		Returns:
+			the _Transaction of tx
+
 		Raises:
-			datastore_errors.BadRequestError: if the tx is valid or doesn't exist.
+			apiproxy_errors.ApplicationError: if the tx is invalid or doesn't exist.
 		"""
 		assert isinstance(tx, datastore_pb.Transaction)
 		self.__ValidateAppId(tx.app())
+		try:
+			return self.__transactions[tx.handle()]
+		except KeyError:
+			raise apiproxy_errors.ApplicationError(datastore_pb.Error.BAD_REQUEST,
+								'Transaction %d not found' % tx.handle())
+
+	def __PopTransaction(self, tx):
+		"""Like __ValidateTransaction, but also ends the transaction."""
+		state = self.__ValidateTransaction(tx)
+		self.__tx_lock.acquire()
+		try:
+			self.__transactions.pop(tx.handle(), None)
+		finally:
+			self.__tx_lock.release()
+		return state
+
+	def __ObserveGroups(self, tx, keys):
+		"""Record the version of each entity group of keys that tx has not
+		touched yet, before it reads or writes the group."""
+		tables = {}
+		for key in keys:
+			group = self.__EntityGroup(key)
+			if group not in tx.versions:
+				namespace, root_kind, root_row = group
+				tables.setdefault((namespace, root_kind), set()).add(root_row)
+		if not tables:
+			return
+
+		client = self._GetThriftClient()
+		try:
+			for (namespace, root_kind), root_rows in tables.iteritems():
+				try:
+					ns = self._OpenNamespace(client, namespace)
+					rows = self.__get_rows(client, ns, root_kind, root_rows, ['meta'])
+				except ClientException:
+					rows = {}
+				for root_row in root_rows:
+					tx.versions[(namespace, root_kind, root_row)] = \
+						self.__GroupVersion(rows.get(root_row, []))
+		finally:
+			client.close()
+
+	@staticmethod
+	def __GroupVersion(cells):
+		"""Returns the revision of the version cell among a root row's cells."""
+		for cell in cells:
+			if (cell.key.column_family == 'meta' and
+				cell.key.column_qualifier == 'version'):
+				return cell.key.revision
+		return None
+
+	def __CommitTransaction(self, tx):
+		"""Applies the writes of tx if none of its entity groups changed since
+		it first touched them.
+
+		Raises:
+			apiproxy_errors.ApplicationError: CONCURRENT_TRANSACTION if another
+				commit got in first.
+		"""
+		entities = tx.writes.values()
+		keys = tx.deletes.values()
+		if not entities and not keys:
+			return
+		if not self.__ApplyClaimed(tx.versions, entities, keys, True):
+			raise apiproxy_errors.ApplicationError(
+				datastore_pb.Error.CONCURRENT_TRANSACTION,
+				'Concurrency exception.')
+
+	def __ApplyClaimed(self, versions, entities, keys, transactional):
+		"""Stores entities and deletes keys under a claim on their entity groups.
+
+		The commit puts a claim cell in the root row of each group, then reads
+		them back. It goes ahead only if no other live claim on a group got a
+		lower revision than its own and, for a transaction, every group still
+		has the version it first saw. A transaction then records its writes,
+		which from then on are committed: the writes, the new group versions and
+		the removal of the claims go out in one batch per table, and the record
+		is removed after them. A commit that finds the claim of a dead one with
+		a record rolls it forward and gives way.
+
+		Args:
+			versions: dict of (namespace, root kind, encoded root key) of each
+				group written to the group version the writes depend on
+			entities: A list of entities to store.
+			keys: A list of keys to delete.
+			transactional: whether the group versions must be unchanged and the
+				writes recorded
+
+		Returns:
+			True if the writes were applied, False if another commit held one of
+			the groups.
+		"""
+		token = uuid.uuid4().hex
+		claim = _TX_CLAIM_PREFIX + token
+		record = ''
+		if transactional:
+			record = _TX_RECORD_PREFIX + token
+		client = self._GetThriftClient()
+		claims = {}
+		try:
+			observed = {}
+			for (namespace, root_kind, root_row), version in versions.iteritems():
+				ns = self._Create_Obj_Datastore(client, root_kind, namespace)
+				observed.setdefault((ns, root_kind), {})[root_row] = version
+				claims.setdefault((ns, root_kind), []).append(Cell(
+							Key(
+								row = root_row,
+								column_family = 'meta',
+								column_qualifier = claim,
+								flag = 255),
+							record))
+			self.__set_cells(client, claims, shared=False)
+
+			if not self.__ClaimedGroups(client, observed, claim, transactional):
+				return False
+
+			groups = self.__MutationCells(client, entities, keys)
+			for table, cells in self.__ReleaseCells(claims).iteritems():
+				groups.setdefault(table, []).extend(cells)
+			if record:
+				self.__WriteCommitRecord(client, record, claim, versions, entities,
+										keys)
+			# committed: only applying the writes releases the claims now.
+			claims = {}
+			self.__set_cells(client, groups, shared=False)
+			if record:
+				self.__DeleteCommitRecord(client, record)
+			return True
+		except ClientException:
+			self._InvalidateSchemaCache()
+			raise
+		finally:
+			if claims:
+				try:
+					self.__set_cells(client, self.__ReleaseCells(claims), shared=False)
+				except ClientException:
+					log.warning('could not release transaction claim %s' % claim)
+			client.close()
+
+	@staticmethod
+	def __ReleaseCells(claims):
+		"""Returns cells deleting the claim cells in claims."""
+		return dict((table, [Cell(Key(row = cell.key.row,
+									column_family = cell.key.column_family,
+									column_qualifier = cell.key.column_qualifier,
+									flag = KeyFlag.DELETE_CELL))
+							for cell in cells])
+					for table, cells in claims.iteritems())
+
+	def __ClaimedGroups(self, client, observed, claim, transactional):
+		"""Returns True if the commit owning claim may write its groups.
+
+		Args:
+			client: a Thrift connection
+			observed: dict of (ns, root kind) to a dict of root row to the
+				group version the commit depends on
+			claim: qualifier of the commit's claim cells
+			transactional: whether the group versions must be unchanged
+		"""
+		for (ns, root_kind), versions in observed.iteritems():
+			rows = self.__get_rows(client, ns, root_kind, versions.keys(), ['meta'])
+			for root_row, version in versions.iteritems():
+				cells = rows.get(root_row, [])
+				if transactional and self.__GroupVersion(cells) != version:
+					return False
+				mine = None
+				others = []
+				for cell in cells:
+					qualifier = cell.key.column_qualifier or ''
+					if qualifier == claim:
+						mine = cell.key.revision
+					elif qualifier.startswith(_TX_CLAIM_PREFIX):
+						others.append(cell)
+				if mine is None:
+					return False
+				for cell in others:
+					if cell.key.revision > mine - _TX_CLAIM_TIMEOUT:
+						if cell.key.revision < mine:
+							return False
+					elif cell.value:
+						self.__RollForward(client, cell.value)
+						return False
+		return True
+
+	def __WriteCommitRecord(self, client, record, claim, versions, entities,
+							keys):
+		"""Stores the writes of a commit, and where its claims are, in the row
+		record of the app's datastore table."""
+		cells = [('claim', claim)]
+		cells += [('group:%d' % number, '\0'.join(group))
+				for number, group in enumerate(versions)]
+		cells += [('entity:%d' % number, entity.Encode())
+				for number, entity in enumerate(entities)]
+		cells += [('key:%d' % number, key.Encode())
+				for number, key in enumerate(keys)]
+		ns = self._Create_Obj_Datastore(client, 'datastore', '', indexed=False)
+		self.__set_cells(client, {(ns, 'datastore'): [
+							Cell(Key(row = record,
+									column_family = 'meta',
+									column_qualifier = qualifier,
+									flag = 255),
+								value)
+							for qualifier, value in cells]},
+						shared=False)
+
+	def __DeleteCommitRecord(self, client, record):
+		ns = self._Create_Obj_Datastore(client, 'datastore', '', indexed=False)
+		self.__set_cells(client, {(ns, 'datastore'): [
+							Cell(Key(row = record, flag = KeyFlag.DELETE_ROW))]},
+						shared=False)
+
+	def __RollForward(self, client, record):
+		"""Applies the writes recorded by a commit that died before it applied
+		them, and removes its claims and record. Does nothing if the record is
+		gone, as the commit then finished."""
+		ns = self._Create_Obj_Datastore(client, 'datastore', '', indexed=False)
+		cells = self.__get_cells(client, ns, record, 'datastore', ['meta'])
+		if not cells:
+			return
+		log.warning('rolling forward transaction commit %s' % record)
+		values = dict((cell.key.column_qualifier, cell.value) for cell in cells)
+		entities = []
+		keys = []
+		claims = {}
+		for qualifier, value in values.iteritems():
+			if qualifier.startswith('entity:'):
+				entities.append(entity_pb.EntityProto(value))
+			elif qualifier.startswith('key:'):
+				keys.append(entity_pb.Reference(value))
+			elif qualifier.startswith('group:'):
+				namespace, root_kind, root_row = value.split('\0')
+				group_ns = self._Create_Obj_Datastore(client, root_kind, namespace)
+				claims.setdefault((group_ns, root_kind), []).append(Cell(
+							Key(
+								row = root_row,
+								column_family = 'meta',
+								column_qualifier = values['claim'],
+								flag = 255)))
+		groups = self.__MutationCells(client, entities, keys)
+		for table, release in self.__ReleaseCells(claims).iteritems():
+			groups.setdefault(table, []).extend(release)
+		self.__set_cells(client, groups, shared=False)
+		self.__DeleteCommitRecord(client, record)
 
 	def _Dynamic_BeginTransaction(self, request, transaction):
 		self.__ValidateAppId(request.app())
 		
 		self.__tx_lock.acquire()
-		handle = self.__next_tx_handle
-		self.__next_tx_handle += 1
+		try:
+			handle = self.__next_tx_handle
+			self.__next_tx_handle += 1
+			self.__transactions[handle] = _Transaction(request.app())
+		finally:
+			self.__tx_lock.release()
 		
 		transaction.set_app(request.app())
 		transaction.set_handle(handle)
-		
-		self.__tx_actions = []
 	
 	def _Dynamic_AddActions(self, request, _):
 		"""Associates the creation of one or more tasks with a transaction.
@@ -960,7 +2462,10 @@ class HypertableStub(apiproxy_stub.APIProxyStub):
 			request: A taskqueue_service_pb.TaskQueueBulkAddRequest containing the
 				tasks that should be created when the transaction is comitted.
 		"""
-		if ((len(self.__tx_actions) + request.add_request_size()) >
+		if not request.add_request_size():
+			return
+		tx = self.__ValidateTransaction(request.add_request(0).transaction())
+		if ((len(tx.actions) + request.add_request_size()) >
 				_MAX_ACTIONS_PER_TXN):
 			raise apiproxy_errors.ApplicationError(
 							datastore_pb.Error.BAD_REQUEST,
@@ -974,32 +2479,19 @@ class HypertableStub(apiproxy_stub.APIProxyStub):
 			clone.clear_transaction()
 			new_actions.append(clone)
 		
-		self.__tx_actions.extend(new_actions)
+		tx.actions.extend(new_actions)
 		
 	def _Dynamic_Commit(self, transaction, transaction_response):
-		self.__ValidateTransaction(transaction)
-		
-		try:
-			self.__PutEntities(self.__tx_writes.values())
-			self.__DeleteEntities(self.__tx_deletes)
-			for action in self.__tx_actions:
-				try:
-				  apiproxy_stub_map.MakeSyncCall(
-					  'taskqueue', 'Add', action, api_base_pb.VoidProto())
-				except apiproxy_errors.ApplicationError, e:
-			 		logging.warning('Transactional task %s has been dropped, %s',
-							  action, e)
-			 		pass
-		finally:
-			self.__tx_writes = {}
-			self.__tx_deletes = set()
-			self.__tx_actions = []
-			self.__tx_lock.release()
+		tx = self.__PopTransaction(transaction)
+		self.__CommitTransaction(tx)
+		for action in tx.actions:
+			try:
+			  apiproxy_stub_map.MakeSyncCall(
+				  'taskqueue', 'Add', action, api_base_pb.VoidProto())
+			except apiproxy_errors.ApplicationError, e:
+		 		logging.warning('Transactional task %s has been dropped, %s',
+						  action, e)
+		 		pass
 			
 	def _Dynamic_Rollback(self, transaction, transaction_response):
-		self.__ValidateTransaction(transaction)
-		
-		self.__tx_writes = {}
-		self.__tx_deletes = set()
-		self.__tx_actions = []
-		self.__tx_lock.release()
\ No newline at end of file
+		self.__PopTransaction(transaction)
@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+#
+#   Copyright (C) 2010-2011 Stackless Recursion
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2, or (at your option)
+#   any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+
+"""In-memory query evaluation shared by the Hypertable datastore stubs.
+
+Filters are compiled once per query into comparators that call the native
+operator functions directly, instead of formatting and eval'ing an
+expression for every (entity, value) pair. Values of different types are
+ordered by the tag numbers in the PropertyValue PB, like the real datastore.
+"""
+
+
+import datetime
+import heapq
+import operator
+
+from cyclozzo.apps.api import datastore
+from cyclozzo.apps.api import datastore_types
+from cyclozzo.apps.api import users
+from cyclozzo.apps.datastore import datastore_pb
+from cyclozzo.apps.datastore import entity_pb
+
+
+_PROPERTY_TYPE_TAGS = {
+  datastore_types.Blob: entity_pb.PropertyValue.kstringValue,
+  bool: entity_pb.PropertyValue.kbooleanValue,
+  datastore_types.Category: entity_pb.PropertyValue.kstringValue,
+  datetime.datetime: entity_pb.PropertyValue.kint64Value,
+  datastore_types.Email: entity_pb.PropertyValue.kstringValue,
+  float: entity_pb.PropertyValue.kdoubleValue,
+  datastore_types.GeoPt: entity_pb.PropertyValue.kPointValueGroup,
+  datastore_types.IM: entity_pb.PropertyValue.kstringValue,
+  int: entity_pb.PropertyValue.kint64Value,
+  datastore_types.Key: entity_pb.PropertyValue.kReferenceValueGroup,
+  datastore_types.Link: entity_pb.PropertyValue.kstringValue,
+  long: entity_pb.PropertyValue.kint64Value,
+  datastore_types.PhoneNumber: entity_pb.PropertyValue.kstringValue,
+  datastore_types.PostalAddress: entity_pb.PropertyValue.kstringValue,
+  datastore_types.Rating: entity_pb.PropertyValue.kint64Value,
+  str: entity_pb.PropertyValue.kstringValue,
+  datastore_types.Text: entity_pb.PropertyValue.kstringValue,
+  type(None): 0,
+  unicode: entity_pb.PropertyValue.kstringValue,
+  users.User: entity_pb.PropertyValue.kUserValueGroup,
+  }
+
+_OPERATORS = {
+  datastore_pb.Query_Filter.LESS_THAN: operator.lt,
+  datastore_pb.Query_Filter.LESS_THAN_OR_EQUAL: operator.le,
+  datastore_pb.Query_Filter.GREATER_THAN: operator.gt,
+  datastore_pb.Query_Filter.GREATER_THAN_OR_EQUAL: operator.ge,
+  datastore_pb.Query_Filter.EQUAL: operator.eq,
+  }
+
+
+def HasPropIndexed(entity, prop):
+  """Returns True if prop is in the entity and is indexed."""
+  if prop in datastore_types._SPECIAL_PROPERTIES:
+    return True
+  elif prop in entity.unindexed_properties():
+    return False
+
+  values = entity.get(prop, [])
+  if not isinstance(values, (tuple, list)):
+    values = [values]
+
+  for value in values:
+    if type(value) not in datastore_types._RAW_PROPERTY_TYPES:
+      return True
+  return False
+
+
+def _PropertyValues(entity, prop):
+  """Returns the values of prop in entity as a list, empty if it is unset."""
+  try:
+    values = datastore._GetPropertyValue(entity, prop)
+  except KeyError:
+    return []
+  if not isinstance(values, list):
+    values = [values]
+  return values
+
+
+class CompiledFilter(object):
+  """A Query_Filter compiled into a predicate over datastore.Entity.
+
+  The property name, operator function and type tags of the filter values
+  are resolved once, so evaluating an entity only does tag lookups for the
+  entity's own values. Values are compared as _PropertySortKey orders them,
+  so datetimes compare with the integers that share their tag as timestamps.
+  """
+
+  def __init__(self, filt):
+    """Constructor.
+
+    Args:
+      filt: datastore_pb.Query_Filter, not an IN filter
+    """
+    assert filt.op() != datastore_pb.Query_Filter.IN
+    self.prop = filt.property(0).name().decode('utf-8')
+    self.__op = _OPERATORS[filt.op()]
+    self.__equality = filt.op() == datastore_pb.Query_Filter.EQUAL
+    self.__values = []
+    for filter_prop in filt.property_list():
+      value = datastore_types.FromPropertyPb(filter_prop)
+      self.__values.append(_PropertySortKey(value))
+
+  def Matches(self, entity):
+    """Returns True if any value of the filter property passes the filter.
+
+    The caller is responsible for checking that the property is indexed.
+    """
+    op = self.__op
+    for entity_val in _PropertyValues(entity, self.prop):
+      entity_type, entity_val = _PropertySortKey(entity_val)
+      for filter_type, filter_val in self.__values:
+        if entity_type == filter_type:
+          if op(entity_val, filter_val):
+            return True
+        elif not self.__equality and op(entity_type, filter_type):
+          return True
+    return False
+
+
+class _Descending(object):
+  """Wraps a sort key so that it orders in reverse."""
+
+  __slots__ = ('value',)
+
+  def __init__(self, value):
+    self.value = value
+
+  def __cmp__(self, other):
+    return cmp(other.value, self.value)
+
+
+def _PropertySortKey(value):
+  """Returns a key ordering property values by the tag numbers in the
+  PropertyValue PB, like the real datastore, then by value."""
+  if isinstance(value, datetime.datetime):
+    value = datastore_types.DatetimeToTimestamp(value)
+  return (_PROPERTY_TYPE_TAGS.get(value.__class__), value)
+
+
+def EntitySortKey(orders):
+  """Returns a key function for datastore.Entity for the given orders.
+
+  Multi-valued properties sort by their smallest value when ascending and
+  their largest when descending; ties are broken by entity key. The key of
+  each entity is a tuple, so sorts compute it once per entity instead of
+  once per comparison.
+
+  Args:
+    orders: list of datastore_pb.Query_Order
+  """
+  compiled = [(o.property().decode('utf-8'),
+               o.direction() == datastore_pb.Query_Order.DESCENDING)
+              for o in orders]
+
+  def sort_key(entity):
+    key = []
+    for prop, descending in compiled:
+      value = datastore._GetPropertyValue(entity, prop)
+      if isinstance(value, list):
+        values = [_PropertySortKey(v) for v in value]
+        if descending:
+          value = max(values)
+        else:
+          value = min(values)
+      else:
+        value = _PropertySortKey(value)
+      if descending:
+        value = _Descending(value)
+      key.append(value)
+    key.append(entity.key())
+    return tuple(key)
+
+  return sort_key
+
+
+def EntityComparator(orders):
+  """Returns a __cmp__ function for datastore.Entity for the given orders,
+  following the same order as EntitySortKey."""
+  sort_key = EntitySortKey(orders)
+
+  def order_compare_entities(a, b):
+    return cmp(sort_key(a), sort_key(b))
+
+  return order_compare_entities
+
+
+def SortEntities(entities, orders, limit=None):
+  """Sorts entities by a query's orders.
+
+  Args:
+    entities: iterable of datastore.Entity
+    orders: list of datastore_pb.Query_Order
+    limit: if given, only this many of the first entities are wanted, and
+      they are picked with a bounded heap instead of sorting them all
+
+  Returns:
+    a sorted list of datastore.Entity
+  """
+  sort_key = EntitySortKey(orders)
+  if limit:
+    return heapq.nsmallest(limit, entities, key=sort_key)
+  return sorted(entities, key=sort_key)
+
+
+def ResultLimit(query):
+  """Returns how many of the first sorted results a query can return, or
+  None if it may need all of them.
+
+  A query resuming from a compiled cursor starts at an arbitrary position,
+  so needs the full ordering.
+  """
+  if not query.has_limit() or not query.limit():
+    return None
+  if query.has_compiled_cursor() and query.compiled_cursor().position_list():
+    return None
+  return query.offset() + query.limit()
+
+
+def CompileFilters(filters, orders):
+  """Compiles a query's filters into a single predicate over entities.
+
+  The predicate rejects entities that lack an indexed value for any filtered
+  or ordered property, as the real datastore would not find them through an
+  index. Which of those properties are indexed is worked out once per entity.
+
+  Args:
+    filters: list of datastore_pb.Query_Filter
+    orders: list of datastore_pb.Query_Order
+
+  Returns:
+    a function taking a datastore.Entity and returning True if it passes
+    every filter.
+  """
+  compiled = [CompiledFilter(filt) for filt in filters]
+  props = set(f.prop for f in compiled)
+  props.update(o.property().decode('utf-8') for o in orders)
+
+  def matches(entity):
+    for prop in props:
+      if not HasPropIndexed(entity, prop):
+        return False
+    for f in compiled:
+      if not f.Matches(entity):
+        return False
+    return True
+
+  return matches
+
+
+def FilterEntities(entities, filters, orders):
+  """Applies a query's filters to a list of entities.
+
+  Args:
+    entities: list of datastore.Entity
+    filters: list of datastore_pb.Query_Filter
+    orders: list of datastore_pb.Query_Order
+
+  Returns:
+    list of the datastore.Entity that pass every filter, in input order
+  """
+  if not filters and not orders:
+    return list(entities)
+  return filter(CompileFilters(filters, orders), entities)
@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+
+import datetime
+import itertools
+import os
+import unittest
+
+from cyclozzo.apps.api import datastore
+from cyclozzo.apps.api import datastore_types
+from cyclozzo.apps.api import users
+from cyclozzo.apps.datastore import datastore_pb
+from cyclozzo.apps.datastore import datastore_query_eval
+
+
+_OPERATOR_TEXT = {datastore_pb.Query_Filter.LESS_THAN: '<',
+                  datastore_pb.Query_Filter.LESS_THAN_OR_EQUAL: '<=',
+                  datastore_pb.Query_Filter.GREATER_THAN: '>',
+                  datastore_pb.Query_Filter.GREATER_THAN_OR_EQUAL: '>=',
+                  datastore_pb.Query_Filter.EQUAL: '==',
+                  }
+
+_TAGS = datastore_query_eval._PROPERTY_TYPE_TAGS
+
+# users.User, as eval'ed from its repr by the old filters, needs it.
+os.environ.setdefault('AUTH_DOMAIN', 'example.com')
+
+
+def OldPassesFilter(entity, filt):
+  """The per-value eval the Hypertable stubs used before
+  datastore_query_eval, kept as the reference the compiled filters must
+  agree with."""
+  prop = filt.property(0).name().decode('utf-8')
+  op = _OPERATOR_TEXT[filt.op()]
+  filter_val_list = [datastore_types.FromPropertyPb(filter_prop)
+                     for filter_prop in filt.property_list()]
+  if not datastore_query_eval.HasPropIndexed(entity, prop):
+    return False
+  try:
+    entity_vals = datastore._GetPropertyValue(entity, prop)
+  except KeyError:
+    entity_vals = []
+  if not isinstance(entity_vals, list):
+    entity_vals = [entity_vals]
+  for fixed_entity_val in entity_vals:
+    for filter_val in filter_val_list:
+      fixed_entity_type = _TAGS.get(fixed_entity_val.__class__)
+      filter_type = _TAGS.get(filter_val.__class__)
+      if fixed_entity_type == filter_type:
+        comp = u'%r %s %r' % (fixed_entity_val, op, filter_val)
+      elif op != '==':
+        comp = '%r %s %r' % (fixed_entity_type, op, filter_type)
+      else:
+        continue
+      try:
+        ret = eval(comp)
+        if ret and ret != NotImplementedError:
+          return True
+      except TypeError:
+        pass
+  return False
+
+
+def OldCompareEntities(orders):
+  """The __cmp__ function the Hypertable stubs sorted results with before
+  datastore_query_eval."""
+
+  def order_compare_properties(x, y):
+    if isinstance(x, datetime.datetime):
+      x = datastore_types.DatetimeToTimestamp(x)
+    if isinstance(y, datetime.datetime):
+      y = datastore_types.DatetimeToTimestamp(y)
+    x_type = _TAGS.get(x.__class__)
+    y_type = _TAGS.get(y.__class__)
+    if x_type == y_type:
+      try:
+        return cmp(x, y)
+      except TypeError:
+        return 0
+    else:
+      return cmp(x_type, y_type)
+
+  def order_compare_entities(a, b):
+    cmped = 0
+    for o in orders:
+      prop = o.property().decode('utf-8')
+      reverse = (o.direction() is datastore_pb.Query_Order.DESCENDING)
+      a_val = datastore._GetPropertyValue(a, prop)
+      if isinstance(a_val, list):
+        a_val = sorted(a_val, order_compare_properties, reverse=reverse)[0]
+      b_val = datastore._GetPropertyValue(b, prop)
+      if isinstance(b_val, list):
+        b_val = sorted(b_val, order_compare_properties, reverse=reverse)[0]
+      cmped = order_compare_properties(a_val, b_val)
+      if o.direction() is datastore_pb.Query_Order.DESCENDING:
+        cmped = -cmped
+      if cmped != 0:
+        return cmped
+    return cmp(a.key(), b.key())
+
+  return order_compare_entities
+
+
+def MixesDatetimeAndInteger(values, filter_value):
+  """Returns True if a datetime would be compared with an int or long."""
+  if not isinstance(values, list):
+    values = [values]
+  classes = set(value.__class__ for value in values + [filter_value])
+  return (datetime.datetime in classes and
+          bool(classes.intersection((int, long, datastore_types.Rating))))
+
+
+def MakeFilter(prop, op, *values):
+  filt = datastore_pb.Query_Filter()
+  filt.set_op(op)
+  for value in values:
+    filt.add_property().CopyFrom(datastore_types.ToPropertyPb(prop, value))
+  return filt
+
+
+def MakeOrder(prop, direction=datastore_pb.Query_Order.ASCENDING):
+  order = datastore_pb.Query_Order()
+  order.set_property(prop)
+  order.set_direction(direction)
+  return order
+
+
+# values of p, mixing the types that share and that differ in type tags
+_VALUES = [None, False, True, -3, 0, 2, 7L, 2.5, -1.0, 'abc', u'abd', '',
+           datastore_types.Category('b'), datastore_types.Rating(40),
+           datetime.datetime(2010, 3, 27, 12, 0),
+           datetime.datetime(2011, 1, 1),
+           users.User('a@example.com', 'example.com'),
+           datastore_types.GeoPt(1.5, -2.0),
+           [1, 5], ['x', 3], [2.0, u'z', None]]
+
+_FILTER_VALUES = [None, False, 0, 2, 6, 2.5, 'abc', u'abc', 'b', '',
+                  datetime.datetime(2010, 6, 1),
+                  users.User('a@example.com', 'example.com'),
+                  datastore_types.GeoPt(1.5, -2.0)]
+
+
+class QueryEvalTestCase(unittest.TestCase):
+
+  def setUp(self):
+    self.entities = []
+    for number, value in enumerate(_VALUES):
+      entity = datastore.Entity('Thing', id=number + 1, _app='test')
+      entity['p'] = value
+      entity['q'] = number % 3
+      self.entities.append(entity)
+    unset = datastore.Entity('Thing', id=100, _app='test')
+    unset['q'] = 1
+    self.entities.append(unset)
+    unindexed = datastore.Entity('Thing', id=101, _app='test')
+    unindexed['p'] = datastore_types.Text('abc')
+    unindexed['q'] = 2
+    self.entities.append(unindexed)
+
+  def Keys(self, entities):
+    return [entity.key() for entity in entities]
+
+  def test_filters_match_old_eval(self):
+    for op, value in itertools.product(sorted(_OPERATOR_TEXT),
+                                       _FILTER_VALUES):
+      filt = MakeFilter('p', op, value)
+      # the old eval could not compare datetimes with the integers sharing
+      # their tag, see test_datetimes_compare_with_integers_as_timestamps.
+      entities = [entity for entity in self.entities
+                  if not MixesDatetimeAndInteger(entity.get('p'), value)]
+      expected = [entity for entity in entities
+                  if OldPassesFilter(entity, filt)]
+      actual = datastore_query_eval.FilterEntities(entities, [filt], [])
+      self.assertEqual(self.Keys(actual), self.Keys(expected),
+                       'p %s %r' % (_OPERATOR_TEXT[op], value))
+
+  def test_combined_filters_and_orders(self):
+    filters = [MakeFilter('p', datastore_pb.Query_Filter.GREATER_THAN, 0),
+               MakeFilter('q', datastore_pb.Query_Filter.EQUAL, 1)]
+    expected = [entity for entity in self.entities
+                if OldPassesFilter(entity, filters[0]) and
+                OldPassesFilter(entity, filters[1])]
+    actual = datastore_query_eval.FilterEntities(self.entities, filters, [])
+    self.assertEqual(self.Keys(actual), self.Keys(expected))
+
+    # ordering on a property also drops entities without an indexed value
+    actual = datastore_query_eval.FilterEntities(self.entities, [],
+                                                 [MakeOrder('p')])
+    self.assertEqual(len(actual), len(_VALUES))
+
+  def test_sort_matches_old_comparator(self):
+    indexed = datastore_query_eval.FilterEntities(self.entities, [],
+                                                  [MakeOrder('p')])
+    for orders in ([MakeOrder('p')],
+                   [MakeOrder('p', datastore_pb.Query_Order.DESCENDING)],
+                   [MakeOrder('q'), MakeOrder('p')],
+                   [MakeOrder('q', datastore_pb.Query_Order.DESCENDING),
+                    MakeOrder('p', datastore_pb.Query_Order.DESCENDING)]):
+      expected = sorted(indexed, OldCompareEntities(orders))
+      actual = datastore_query_eval.SortEntities(indexed, orders)
+      self.assertEqual(self.Keys(actual), self.Keys(expected))
+      limited = datastore_query_eval.SortEntities(indexed, orders, 5)
+      self.assertEqual(self.Keys(limited), self.Keys(expected[:5]))
+      comparator = datastore_query_eval.EntityComparator(orders)
+      self.assertEqual(self.Keys(sorted(indexed, comparator)),
+                       self.Keys(expected))
+
+  def test_datetimes_compare_with_integers_as_timestamps(self):
+    entity = datastore.Entity('Thing', id=1, _app='test')
+    entity['p'] = datetime.datetime(1970, 1, 1, 0, 0, 1)
+    filt = MakeFilter('p', datastore_pb.Query_Filter.GREATER_THAN, 999999)
+    self.assertEqual(
+        datastore_query_eval.FilterEntities([entity], [filt], []), [entity])
+    filt = MakeFilter('p', datastore_pb.Query_Filter.EQUAL, 1000000)
+    self.assertEqual(
+        datastore_query_eval.FilterEntities([entity], [filt], []), [entity])
+
+  def test_result_limit(self):
+    query = datastore_pb.Query()
+    self.assertEqual(datastore_query_eval.ResultLimit(query), None)
+    query.set_limit(10)
+    query.set_offset(5)
+    self.assertEqual(datastore_query_eval.ResultLimit(query), 15)
+    query.mutable_compiled_cursor().add_position().set_start_key('k')
+    self.assertEqual(datastore_query_eval.ResultLimit(query), None)
+
+
+if __name__ == '__main__':
+  test_cases = [QueryEvalTestCase,
+               ]
+  for test_case in test_cases:
+    suite = unittest.TestLoader().loadTestsFromTestCase(test_case)
+    unittest.TextTestRunner(verbosity=2).run(suite)
@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+#
+#   Copyright (C) 2010-2011 Stackless Recursion
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2, or (at your option)
+#   any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+
+"""Reader and writer of Hypertable's SerializedCells buffers.
+
+The ThriftBroker's *_serialized calls pass cells as one string instead of a
+list of Cell structs, so a page of cells costs a single Thrift string
+instead of three objects and a dozen fields per cell. The reader yields
+plain (row, column family, column qualifier, value) tuples.
+
+A buffer starts with a 32 bit version, followed by the cells:
+
+  flags           1 byte, FLAG_*
+  timestamp       8 bytes, if FLAG_HAVE_TIMESTAMP
+  revision        8 bytes, if FLAG_HAVE_REVISION and not FLAG_REV_IS_TS
+  row             NUL terminated, empty if the same as the previous cell's
+  column family   NUL terminated
+  qualifier       NUL terminated
+  value length    4 bytes
+  value
+  cell flag       1 byte, a KeyFlag
+
+and ends with a flags byte holding FLAG_EOB, plus FLAG_EOS after the last
+page of a scan. Integers are little endian.
+
+Run as a script to compare reading a page of cells this way with decoding
+it as Cell structs.
+"""
+
+
+import struct
+import sys
+import time
+
+
+VERSION = 1
+
+FLAG_EOB = 0x01
+FLAG_EOS = 0x02
+FLAG_FLUSH = 0x04
+FLAG_REV_IS_TS = 0x10
+FLAG_AUTO_TIMESTAMP = 0x20
+FLAG_HAVE_TIMESTAMP = 0x40
+FLAG_HAVE_REVISION = 0x80
+
+# KeyFlag values of the cell flag byte.
+DELETE_ROW = 0
+DELETE_CF = 1
+DELETE_CELL = 2
+INSERT = 255
+
+_INT32 = struct.Struct('<i')
+_INT64 = struct.Struct('<q')
+
+
+class SerializedCellsReader(object):
+  """Iterates over the cells of a SerializedCells buffer.
+
+  Public properties:
+    eos: whether the buffer ended the scan, known once it has been read
+  """
+
+  def __init__(self, buf):
+    self.__buf = buf
+    self.eos = False
+
+  def __iter__(self):
+    """Yields (row, column family, column qualifier, value) of each cell."""
+    for row, family, qualifier, value, flag in self.cells_with_flags():
+      yield row, family, qualifier, value
+
+  def cells_with_flags(self):
+    """Yields (row, column family, column qualifier, value, cell flag) of
+    each cell."""
+    buf = self.__buf
+    end = len(buf)
+    if end < _INT32.size:
+      self.eos = True
+      return
+    find = buf.find
+    unpack_int32 = _INT32.unpack_from
+    pos = _INT32.size
+    row = None
+    while pos < end:
+      flags = ord(buf[pos])
+      pos += 1
+      if flags & (FLAG_EOB | FLAG_EOS):
+        self.eos = bool(flags & FLAG_EOS)
+        return
+      if flags & FLAG_HAVE_TIMESTAMP:
+        pos += 8
+      if flags & FLAG_HAVE_REVISION and not flags & FLAG_REV_IS_TS:
+        pos += 8
+      nul = find('\0', pos)
+      if nul != pos:
+        row = buf[pos:nul]
+      pos = nul + 1
+      nul = find('\0', pos)
+      family = buf[pos:nul]
+      pos = nul + 1
+      nul = find('\0', pos)
+      qualifier = buf[pos:nul]
+      pos = nul + 1
+      length = unpack_int32(buf, pos)[0]
+      pos += 4
+      value = buf[pos:pos + length]
+      pos += length
+      yield row, family, qualifier, value, ord(buf[pos])
+      pos += 1
+
+
+class SerializedCellsWriter(object):
+  """Builds a SerializedCells buffer."""
+
+  def __init__(self):
+    self.__parts = [_INT32.pack(VERSION)]
+    self.__previous_row = None
+    self.__count = 0
+
+  def __len__(self):
+    return self.__count
+
+  def add(self, row, family, qualifier, value, flag=INSERT, timestamp=None):
+    """Appends a cell.
+
+    Args:
+      row: the row key
+      family: the column family, or None for a row delete
+      qualifier: the column qualifier, or None
+      value: the value, or None
+      flag: the KeyFlag of the cell
+      timestamp: the timestamp, or None to have the server assign one
+    """
+    if timestamp is None:
+      parts = [chr(FLAG_AUTO_TIMESTAMP)]
+    else:
+      parts = [chr(FLAG_HAVE_TIMESTAMP), _INT64.pack(timestamp)]
+    if row == self.__previous_row:
+      parts.append('\0')
+    else:
+      parts.extend((row, '\0'))
+      self.__previous_row = row
+    value = value or ''
+    parts.extend((family or '', '\0', qualifier or '', '\0',
+                  _INT32.pack(len(value)), value, chr(flag)))
+    self.__parts.append(''.join(parts))
+    self.__count += 1
+
+  def finalize(self, eos=False):
+    """Returns the buffer, ending the scan if eos is set."""
+    flags = FLAG_EOB
+    if eos:
+      flags |= FLAG_EOS
+    return ''.join(self.__parts) + chr(flags)
+
+
+def _RetainedBytes(obj):
+  """Returns the bytes held by obj and the lists, tuples, instance dicts and
+  strings it refers to, counting shared objects once."""
+  seen = set()
+  total = 0
+  stack = [obj]
+  while stack:
+    obj = stack.pop()
+    if id(obj) in seen:
+      continue
+    seen.add(id(obj))
+    total += sys.getsizeof(obj)
+    if isinstance(obj, (list, tuple)):
+      stack.extend(obj)
+    elif isinstance(obj, dict):
+      stack.extend(obj.itervalues())
+    elif hasattr(obj, '__dict__'):
+      stack.append(obj.__dict__)
+  return total
+
+
+def _Measure(function):
+  """Returns the seconds function takes and the KB its result holds."""
+  start = time.time()
+  result = function()
+  seconds = time.time() - start
+  return seconds, _RetainedBytes(result) // 1024
+
+
+def Benchmark(count=100000, value_size=100):
+  """Compares keeping a scan of count cells as Cell structs decoded from a
+  next_cells reply and as tuples read from a SerializedCells buffer.
+
+  Returns:
+    list of (method, seconds, KB of memory holding the cells)
+  """
+  from thrift.protocol import TBinaryProtocol
+  from thrift.transport import TTransport
+  from cyclozzo.hyperthrift.gen import ClientService
+  from cyclozzo.hyperthrift.gen.ttypes import Cell, Key
+
+  value = 'v' * value_size
+  writer = SerializedCellsWriter()
+  cells = []
+  for i in xrange(count):
+    row = '%016x' % i
+    writer.add(row, 'entity', 'proto', value)
+    cells.append(Cell(Key(row=row, column_family='entity',
+                          column_qualifier='proto', flag=INSERT), value))
+  serialized = writer.finalize(eos=True)
+  buf = TTransport.TMemoryBuffer()
+  ClientService.next_cells_result(success=cells).write(
+      TBinaryProtocol.TBinaryProtocol(buf))
+  data = buf.getvalue()
+  del cells, buf
+
+  def decode(factory):
+    def run():
+      result = ClientService.next_cells_result()
+      result.read(factory.getProtocol(TTransport.TMemoryBuffer(data)))
+      return result.success
+    return run
+
+  def read():
+    return list(SerializedCellsReader(serialized))
+
+  methods = [('next_cells', decode(TBinaryProtocol.TBinaryProtocolFactory()))]
+  try:
+    from thrift.protocol import fastbinary
+    methods.append(('next_cells accelerated',
+                    decode(TBinaryProtocol.TBinaryProtocolAcceleratedFactory())))
+  except ImportError:
+    pass
+  methods.append(('serialized', read))
+  return [(name,) + _Measure(function) for name, function in methods]
+
+
+if __name__ == '__main__':
+  count = 100000
+  if len(sys.argv) > 1:
+    count = int(sys.argv[1])
+  for name, seconds, kilobytes in Benchmark(count):
+    print '%-24s %d cells in %6.2fs, %7d KB' % (name, count, seconds,
+                                                 kilobytes)
@@ -32,6 +32,7 @@ Example:
 from cyclozzo.apps.tools import os_compat
 
 import __builtin__
+import abc
 import BaseHTTPServer
 import tornado
 import tornado.web
@@ -47,6 +48,11 @@ try:
 except ImportError:
   pass
 
+try:
+  import pyinotify
+except ImportError:
+  pyinotify = None
+
 import dummy_thread
 import email.Utils
 import errno
@@ -86,6 +92,7 @@ import urllib
 import cyclozzo
 from cyclozzo.pyglib import gexcept
 
+from cyclozzo.apps.api import apiproxy_rpc
 from cyclozzo.apps.api import apiproxy_stub_map
 from cyclozzo.apps.api import appinfo
 from cyclozzo.apps.api import appinfo_includes
@@ -152,6 +159,8 @@ MAX_REQUEST_SIZE = 10 * 1024 * 1024
 
 COPY_BLOCK_SIZE = 1 << 20
 
+MODULE_RELOAD_POLL_INTERVAL = 1.0
+
 API_VERSION = '1'
 
 SITE_PACKAGES = os.path.normcase(os.path.join(os.path.dirname(os.__file__),
@@ -241,6 +250,25 @@ def CopyStreamPart(source, destination, content_size):
   return bytes_copied
 
 
+def CreateRequestFile(body, spool_size=0):
+  """Wraps a request body in a file-like object for dispatch.
+
+  Args:
+    body: String containing the request body.
+    spool_size: Bodies larger than this many bytes are written to an
+      anonymous temporary file; 0 keeps every body in memory.
+
+  Returns:
+    Seekable file-like object positioned at the start of the body.
+  """
+  if not spool_size or len(body) <= spool_size:
+    return cStringIO.StringIO(body)
+  request_file = tempfile.TemporaryFile()
+  request_file.write(body)
+  request_file.seek(0)
+  return request_file
+
+
 class AppServerRequest(object):
   """Encapsulates app-server request.
 
@@ -2288,7 +2316,8 @@ def ExecuteCGI(root_path,
       like 'foo/bar/baz.py'). May contain $PYTHON_LIB references.
     cgi_path: Absolute path to the CGI script file on disk.
     env: Dictionary of environment variables to use for the execution.
-    infile: File-like object to read HTTP request input data from.
+    infile: Seekable file-like object to read HTTP request input data from;
+      it is rewound and installed as sys.stdin.
     outfile: FIle-like object to write HTTP response data to.
     module_dict: Dictionary in which application-loaded modules should be
       preserved between requests. This removes the need to reload modules that
@@ -2296,27 +2325,37 @@ def ExecuteCGI(root_path,
       This dictionary must be separate from the sys.modules dictionary.
     exec_script: Used for dependency injection.
   """
-  old_module_dict = sys.modules.copy()
+  sandbox = WarmSandbox.GetInstance()
+  if sandbox is None:
+    old_module_dict = sys.modules.copy()
   old_builtin = __builtin__.__dict__.copy()
   old_argv = sys.argv
   old_stdin = sys.stdin
   old_stdout = sys.stdout
   old_stderr = sys.stderr
-  old_env = os.environ.copy()
+  if sandbox is None:
+    old_env = os.environ.copy()
   old_cwd = os.getcwd()
   old_file_type = types.FileType
+  before_path = sys.path[:]
   reset_modules = False
 
   try:
-    ClearAllButEncodingsModules(sys.modules)
-    before_path = sys.path[:]
-    sys.modules.update(module_dict)
+    if sandbox is None:
+      ClearAllButEncodingsModules(sys.modules)
+      sys.modules.update(module_dict)
+    else:
+      old_module_dict = sandbox.EnterModules(module_dict)
     sys.argv = [cgi_path]
-    sys.stdin = cStringIO.StringIO(infile.getvalue())
+    infile.seek(0)
+    sys.stdin = infile
     sys.stdout = outfile
     sys.stderr = logfile
-    os.environ.clear()
-    os.environ.update(env)
+    if sandbox is None:
+      os.environ.clear()
+      os.environ.update(env)
+    else:
+      old_env = sandbox.EnterEnviron(env)
     cgi_dir = os.path.normpath(os.path.dirname(cgi_path))
     root_path = os.path.normpath(os.path.abspath(root_path))
     if cgi_dir.startswith(root_path + os.sep):
@@ -2324,10 +2363,13 @@ def ExecuteCGI(root_path,
     else:
       os.chdir(root_path)
 
-    hook = HardenedModulesHook(sys.modules)
+    if sandbox is None:
+      hook = HardenedModulesHook(sys.modules)
+      if hasattr(sys, 'path_importer_cache'):
+        sys.path_importer_cache.clear()
+    else:
+      hook = sandbox.EnterImporters()
     sys.meta_path = [hook]
-    if hasattr(sys, 'path_importer_cache'):
-      sys.path_importer_cache.clear()
 
     __builtin__.file = FakeFile
     __builtin__.open = FakeFile
@@ -2335,7 +2377,8 @@ def ExecuteCGI(root_path,
 
     #__builtin__.buffer = NotImplementedFakeClass
 
-    logging.debug('Executing CGI with env:\n%s', pprint.pformat(env))
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+      logging.debug('Executing CGI with env:\n%s', pprint.pformat(env))
     try:
       reset_modules = exec_script(handler_path, cgi_path, hook)
     except SystemExit, e:
@@ -2348,13 +2391,19 @@ def ExecuteCGI(root_path,
 
   finally:
     sys.meta_path = []
-    sys.path_importer_cache.clear()
+    if sandbox is None:
+      sys.path_importer_cache.clear()
+    else:
+      sandbox.ExitImporters()
 
     _ClearTemplateCache(sys.modules)
 
-    module_dict.update(sys.modules)
-    ClearAllButEncodingsModules(sys.modules)
-    sys.modules.update(old_module_dict)
+    if sandbox is None:
+      module_dict.update(sys.modules)
+      ClearAllButEncodingsModules(sys.modules)
+      sys.modules.update(old_module_dict)
+    else:
+      sandbox.ExitModules(module_dict, old_module_dict)
 
     __builtin__.__dict__.update(old_builtin)
     sys.argv = old_argv
@@ -2364,13 +2413,165 @@ def ExecuteCGI(root_path,
 
     sys.path[:] = before_path
 
-    os.environ.clear()
-    os.environ.update(old_env)
+    if sandbox is None:
+      os.environ.clear()
+      os.environ.update(old_env)
+    else:
+      sandbox.ExitEnviron(old_env)
     os.chdir(old_cwd)
 
     types.FileType = old_file_type
 
 
+class WarmSandbox(object):
+  """Sandbox state ExecuteCGI keeps between requests of a process.
+
+  By default every request rebuilds the sandbox: sys.modules is emptied of all
+  but encodings modules, one module at a time, and refilled from module_dict,
+  a new HardenedModulesHook is installed, the importer cache is cleared and
+  every environment variable is unset and set again; afterwards all of it is
+  reversed. With the warm sandbox, enabled by warm_sandbox in the satellite
+  configuration, the hook and the application's importer cache are built
+  once and kept. sys.modules and sys.path_importer_cache are swapped between
+  the server's and the application's contents with whole-dictionary
+  operations, and encodings modules, which cannot be reloaded, are looked for
+  only when a module name shows up for the first time. os.environ is swapped
+  the same way, and putenv and unsetenv are called only for the variables
+  that differ, so the C library's environment always matches os.environ.
+
+  Application code sees the same modules and environment as before. The
+  instance is created before the app server forks its workers, so each worker
+  warms its own copy.
+  """
+
+  _instance = None
+
+  @staticmethod
+  def SetEnabled(enabled):
+    """Turns the warm sandbox on or off for this process.
+
+    Args:
+      enabled: True to keep the sandbox between requests.
+    """
+    if enabled:
+      if WarmSandbox._instance is None:
+        WarmSandbox._instance = WarmSandbox()
+    else:
+      WarmSandbox._instance = None
+
+  @staticmethod
+  def GetInstance():
+    """Returns the WarmSandbox, or None when it is disabled."""
+    return WarmSandbox._instance
+
+  def __init__(self):
+    """Initializer."""
+    self._hook = HardenedModulesHook(sys.modules)
+    self._importer_cache = {}
+    self._server_importer_cache = {}
+    self._encodings_modules = {}
+    self._seen_module_names = set()
+
+  def _KeepEncodingsModules(self, module_dict):
+    """Records the encodings modules of module_dict if it holds a module name
+    not seen before."""
+    seen_count = len(self._seen_module_names)
+    self._seen_module_names.update(module_dict)
+    if len(self._seen_module_names) == seen_count:
+      return
+    for name, module in module_dict.iteritems():
+      if IsEncodingsModule(name) and name not in self._encodings_modules:
+        self._encodings_modules[name] = module
+
+  def EnterModules(self, module_dict):
+    """Replaces sys.modules with the application's modules.
+
+    Args:
+      module_dict: Dictionary of the application's modules.
+
+    Returns:
+      The server's modules, to be passed to ExitModules.
+    """
+    old_module_dict = sys.modules.copy()
+    self._KeepEncodingsModules(old_module_dict)
+    sys.modules.clear()
+    sys.modules.update(module_dict)
+    sys.modules.update(self._encodings_modules)
+    return old_module_dict
+
+  def ExitModules(self, module_dict, old_module_dict):
+    """Saves the application's modules and restores the server's.
+
+    Args:
+      module_dict: Dictionary in which the application's modules are saved.
+      old_module_dict: The server's modules, as returned by EnterModules.
+    """
+    module_dict.update(sys.modules)
+    self._KeepEncodingsModules(sys.modules)
+    sys.modules.clear()
+    sys.modules.update(old_module_dict)
+    sys.modules.update(self._encodings_modules)
+
+  def _SwapEnviron(self, env):
+    """Replaces the contents of os.environ, calling putenv and unsetenv only
+    for the variables whose values change.
+
+    Args:
+      env: Dictionary of environment variables to install.
+
+    Returns:
+      The previous contents of os.environ.
+    """
+    environ = os.environ.data
+    old_env = environ.copy()
+    for name in old_env:
+      if name not in env:
+        os.unsetenv(name)
+    for name, value in env.iteritems():
+      if old_env.get(name) != value:
+        os.putenv(name, value)
+    environ.clear()
+    environ.update(env)
+    return old_env
+
+  def EnterEnviron(self, env):
+    """Replaces the environment with the application's.
+
+    Args:
+      env: Dictionary of environment variables to use for the execution.
+
+    Returns:
+      The server's environment, to be passed to ExitEnviron.
+    """
+    return self._SwapEnviron(env)
+
+  def ExitEnviron(self, old_env):
+    """Restores the server's environment.
+
+    Args:
+      old_env: The server's environment, as returned by EnterEnviron.
+    """
+    self._SwapEnviron(old_env)
+
+  def EnterImporters(self):
+    """Installs the application's importer cache.
+
+    Returns:
+      The HardenedModulesHook to put on sys.meta_path.
+    """
+    self._server_importer_cache = sys.path_importer_cache.copy()
+    sys.path_importer_cache.clear()
+    sys.path_importer_cache.update(self._importer_cache)
+    return self._hook
+
+  def ExitImporters(self):
+    """Saves the application's importer cache and restores the server's."""
+    self._importer_cache = sys.path_importer_cache.copy()
+    sys.path_importer_cache.clear()
+    sys.path_importer_cache.update(self._server_importer_cache)
+    self._server_importer_cache = {}
+
+
 class CGIDispatcher(URLDispatcher):
   """Dispatcher that executes Python CGI scripts."""
 
@@ -2409,9 +2610,11 @@ class CGIDispatcher(URLDispatcher):
     if not CheckRequestSize(request_size, outfile):
       return
 
-    memory_file = cStringIO.StringIO()
-    CopyStreamPart(request.infile, memory_file, request_size)
-    memory_file.seek(0)
+    infile = request.infile
+    if DEVEL_PAYLOAD_RAW_HEADER in request.headers:
+      infile = cStringIO.StringIO()
+      CopyStreamPart(request.infile, infile, request_size)
+      infile.seek(0)
 
     handler = self._create_logging_handler()
     logging.getLogger().addHandler(handler)
@@ -2424,12 +2627,12 @@ class CGIDispatcher(URLDispatcher):
       env.update(self._setup_env(cgi_path,
                                  request.relative_url,
                                  request.headers,
-                                 memory_file))
+                                 infile))
       self._exec_cgi(self._root_path,
                      request.path,
                      cgi_path,
                      env,
-                     memory_file,
+                     infile,
                      outfile,
                      logfile,
                      self._module_dict)
@@ -3014,12 +3217,10 @@ class ModuleManager(object):
     Returns:
       True if one or more files have been modified, False otherwise.
     """
-    for name, (mtime, fname) in self._modification_times.iteritems():
+    for name, (mtime, fname) in self._modification_times.items():
       if name not in self._modules:
         continue
 
-      module = self._modules[name]
-
       if not os.path.isfile(fname):
         return True
 
@@ -3030,19 +3231,24 @@ class ModuleManager(object):
 
   def UpdateModuleFileModificationTimes(self):
     """Records the current modification times of all monitored modules."""
-    self._modification_times.clear()
+    modification_times = {}
     for name, module in self._modules.items():
-      if not isinstance(module, types.ModuleType):
-        continue
-      module_file = self.GetModuleFile(module)
-      if not module_file:
-        continue
-      try:
-        self._modification_times[name] = (os.path.getmtime(module_file),
-                                          module_file)
-      except OSError, e:
-        if e.errno not in FILE_MISSING_EXCEPTIONS:
-          raise e
+      self._RecordModificationTime(modification_times, name, module)
+    self._modification_times = modification_times
+
+  def _RecordModificationTime(self, modification_times, name, module):
+    """Records the modification time of one module's file in
+    modification_times, if it has one."""
+    if not isinstance(module, types.ModuleType):
+      return
+    module_file = self.GetModuleFile(module)
+    if not module_file:
+      return
+    try:
+      modification_times[name] = (os.path.getmtime(module_file), module_file)
+    except OSError, e:
+      if e.errno not in FILE_MISSING_EXCEPTIONS:
+        raise e
 
   def ResetModules(self):
     """Clear modules so that when request is run they are reloaded."""
@@ -3053,6 +3259,182 @@ class ModuleManager(object):
     apiproxy_stub_map.apiproxy.GetPostCallHooks().Clear()
 
 
+class FrozenModuleManager(ModuleManager):
+  """ModuleManager for code that never changes under a running instance.
+
+  Used for module_reload: off; no module file is ever checked.
+  """
+
+  def AreModuleFilesModified(self):
+    """Returns False; modules are never reloaded."""
+    return False
+
+  def UpdateModuleFileModificationTimes(self):
+    """Does nothing; no modification times are kept."""
+
+
+class _WatchingModuleManager(ModuleManager):
+  """ModuleManager whose files are checked by a background thread.
+
+  Requests only read the flag the thread raises. The thread is started by the
+  first request of each process, since threads do not survive the fork into
+  pre-forked workers. Subclasses start it in _StartWatching.
+  """
+
+  __metaclass__ = abc.ABCMeta
+
+  def __init__(self, modules):
+    """Initializer.
+
+    Args:
+      modules: Dictionary containing monitored modules.
+    """
+    ModuleManager.__init__(self, modules)
+    self._modified = False
+    self._watching_pid = None
+
+  @abc.abstractmethod
+  def _StartWatching(self):
+    """Starts the thread that calls _SetModified when files change."""
+
+  def _SetModified(self):
+    self._modified = True
+
+  def AreModuleFilesModified(self):
+    """Determines if the watcher has seen monitored files change.
+
+    Returns:
+      True if one or more files have been modified, False otherwise.
+    """
+    if self._watching_pid != os.getpid():
+      self._watching_pid = os.getpid()
+      self._StartWatching()
+    return self._modified
+
+  def ResetModules(self):
+    """Clear modules so that when request is run they are reloaded."""
+    self._modified = False
+    ModuleManager.ResetModules(self)
+
+
+class PollingModuleManager(_WatchingModuleManager):
+  """Checks module modification times at most once per interval.
+
+  Used for module_reload: poll(interval). Requests only stat the files of
+  modules they newly loaded.
+  """
+
+  def __init__(self, modules, interval=MODULE_RELOAD_POLL_INTERVAL):
+    """Initializer.
+
+    Args:
+      modules: Dictionary containing monitored modules.
+      interval: Seconds between checks.
+    """
+    _WatchingModuleManager.__init__(self, modules)
+    self._interval = interval
+
+  def _StartWatching(self):
+    watcher = threading.Thread(target=self._Poll)
+    watcher.setDaemon(True)
+    watcher.start()
+
+  def _Poll(self):
+    while True:
+      time.sleep(self._interval)
+      if not self._modified and ModuleManager.AreModuleFilesModified(self):
+        self._SetModified()
+
+  def UpdateModuleFileModificationTimes(self):
+    """Records the modification times of modules loaded since the last call.
+
+    The polling thread reads the times while requests run, so they are
+    replaced with an updated copy rather than changed in place.
+    """
+    modification_times = None
+    for name, module in self._modules.items():
+      if name not in self._modification_times:
+        if modification_times is None:
+          modification_times = self._modification_times.copy()
+        self._RecordModificationTime(modification_times, name, module)
+    if modification_times is not None:
+      self._modification_times = modification_times
+
+  def ResetModules(self):
+    """Clear modules so that when request is run they are reloaded."""
+    self._modification_times = {}
+    _WatchingModuleManager.ResetModules(self)
+
+
+class InotifyModuleManager(_WatchingModuleManager):
+  """Flags changes to Python files under the application root with inotify.
+
+  Used for module_reload: inotify; requests never stat module files. Modules
+  outside the application root, such as the SDK's, are not watched.
+  """
+
+  def __init__(self, modules, root_path):
+    """Initializer.
+
+    Args:
+      modules: Dictionary containing monitored modules.
+      root_path: Path to the root of the application.
+    """
+    _WatchingModuleManager.__init__(self, modules)
+    self._root_path = root_path
+
+  def _StartWatching(self):
+    watch_manager = pyinotify.WatchManager()
+    notifier = pyinotify.ThreadedNotifier(watch_manager, self._ProcessEvent)
+    notifier.setDaemon(True)
+    notifier.start()
+    watch_manager.add_watch(self._root_path,
+                            pyinotify.IN_CLOSE_WRITE |
+                            pyinotify.IN_CREATE |
+                            pyinotify.IN_DELETE |
+                            pyinotify.IN_MOVED_FROM |
+                            pyinotify.IN_MOVED_TO,
+                            rec=True,
+                            auto_add=True)
+
+  def _ProcessEvent(self, event):
+    if event.pathname.endswith('.py'):
+      self._SetModified()
+
+  def UpdateModuleFileModificationTimes(self):
+    """Does nothing; changes are reported by inotify."""
+
+
+def CreateModuleManager(modules, root_path, module_reload=None):
+  """Creates the ModuleManager for a module_reload setting.
+
+  Args:
+    modules: Dictionary containing monitored modules.
+    root_path: Path to the root of the application.
+    module_reload: None to check module files before and after every request,
+      'off' (or False, as YAML reads it) to never reload modules, 'inotify' to
+      watch the application root, or 'poll' or 'poll(seconds)' to check on a
+      background thread.
+
+  Returns:
+    Instance of ModuleManager.
+  """
+  if module_reload is None:
+    return ModuleManager(modules)
+  if module_reload is False or module_reload == 'off':
+    return FrozenModuleManager(modules)
+  if module_reload == 'inotify':
+    if pyinotify is not None:
+      return InotifyModuleManager(modules, root_path)
+    logging.warning('pyinotify is not installed, polling module files instead')
+    return PollingModuleManager(modules)
+  match = re.match(r'^poll(?:\((\d+(?:\.\d*)?)\))?$', str(module_reload))
+  if match:
+    return PollingModuleManager(
+        modules, float(match.group(1) or MODULE_RELOAD_POLL_INTERVAL))
+  logging.error('Invalid module_reload setting %r, checking module files '
+                'on every request', module_reload)
+  return ModuleManager(modules)
 
 
 def _ClearTemplateCache(module_dict=sys.modules):
@@ -3105,6 +3487,8 @@ def CreateRequestHandler(root_path,
   # An output stream for catching whatever written to stderr
   logfile = cStringIO.StringIO()
 
+  request_spool_size = int(cyclozzo_config.request_spool_size or 0)
+
   class DevAppServerRequestHandler(tornado.web.RequestHandler):
     """Dispatches URLs using patterns from a URLMatcher.
 
@@ -3125,7 +3509,8 @@ def CreateRequestHandler(root_path,
     server_version = 'Cyclozzo Production/1.0'
 
     module_dict = application_module_dict
-    module_manager = ModuleManager(application_module_dict)
+    module_manager = CreateModuleManager(application_module_dict, root_path,
+                                         cyclozzo_config.module_reload)
 
     config_cache = application_config_cache
 
@@ -3164,51 +3549,29 @@ def CreateRequestHandler(root_path,
       """Handle DELETE requests."""
       self._HandleRequest()
 
-    def _Dispatch(self, dispatcher, socket_infile, outfile, logfile, env_dict):
-      """Copy request data from socket and dispatch.
+    def _Dispatch(self, dispatcher, infile, outfile, logfile, env_dict):
+      """Dispatch the request body.
 
       Args:
         dispatcher: Dispatcher to handle request (MatcherDispatcher).
-        socket_infile: Original request file stream.
+        infile: File-like object holding the request body.
         outfile: Output file to write response to.
         env_dict: Environment dictionary.
       """
-      request_descriptor, request_file_name = tempfile.mkstemp('.tmp',
-                                                               'request.')
+      app_server_request = AppServerRequest(self.request.uri,
+                                            None,
+                                            self._appserver_headers,
+                                            infile)
 
-      try:
-        request_file = os.fdopen(request_descriptor, 'wb')
-        try:
-          CopyStreamPart(socket_infile,
-                         request_file,
-                         int(self.request.headers.get('content-length', 0)))
-        finally:
-          request_file.close()
+      #raise exception for OverQuotaError
+      if is_api_disabled():
+        logging.fatal('Appserver blocked the request. API is disabled.')
+        raise OverQuotaError('API is disabled. Quota overused.')
 
-        request_file = open(request_file_name, 'rb')
-        try:
-          app_server_request = AppServerRequest(self.request.uri,
-                                                None,
-                                                self._appserver_headers,
-                                                request_file)
-
-          #raise exception for OverQuotaError
-          if is_api_disabled():
-            logging.fatal('Appserver blocked the request. API is disabled.')
-            raise OverQuotaError('API is disabled. Quota overused.')
-
-          dispatcher.Dispatch(app_server_request,
-                              outfile,
-                              logfile,
-                              base_env_dict=env_dict)
-        finally:
-          request_file.close()
-      finally:
-        try:
-          os.remove(request_file_name)
-        except OSError, err:
-          if err.errno != errno.ENOENT:
-            raise
+      dispatcher.Dispatch(app_server_request,
+                          outfile,
+                          logfile,
+                          base_env_dict=env_dict)
 
     def _HandleRequest(self):
       """Handles any type of request and prints exceptions if they occur."""
@@ -3237,62 +3600,94 @@ def CreateRequestHandler(root_path,
         self.send_error(httplib.REQUEST_URI_TOO_LONG, msg=msg)
         return
 
-#      tbhandler = cgitb.Hook(file=self.wfile).handle
       try:
-        if self.module_manager.AreModuleFilesModified():
-          self.module_manager.ResetModules()
-
-        implicit_matcher = CreateImplicitMatcher(self.module_dict,
-                                                 root_path)
-        config, explicit_matcher = LoadAppConfig(root_path, self.module_dict,
-                                                 cache=self.config_cache,
-                                                 static_caching=static_caching)
-        if config.api_version != API_VERSION:
-          logging.error(
-              "API versions cannot be switched dynamically: %r != %r",
-              config.api_version, API_VERSION)
-          sys.exit(1)
-        env_dict['CURRENT_VERSION_ID'] = config.version
-        env_dict['APPLICATION_ID'] = config.application
-        dispatcher = MatcherDispatcher(login_url,
-                                       [implicit_matcher, explicit_matcher])
-
-#        if require_indexes:
-#          dev_appserver_index.SetupIndexes(config.application, root_path)
-
-        outfile = cStringIO.StringIO()
-        infile = cStringIO.StringIO()
-        infile.write(self.request.body)
-        infile.seek(0)
-        try:
-          self._Dispatch(dispatcher, infile, outfile, logfile, env_dict)
-        finally:
-          self.module_manager.UpdateModuleFileModificationTimes()
-
-        outfile.flush()
-        outfile.seek(0)
-
-        response = RewriteResponse(outfile, self.rewriter_chain, self._appserver_headers)
-
-        if not response.large_response:
-          position = response.body.tell()
-          response.body.seek(0, 2)
-          end = response.body.tell()
-          response.body.seek(position)
-          runtime_response_size = end - position
-
-          if runtime_response_size > MAX_RUNTIME_RESPONSE_SIZE:
-            response.status_code = 500
-            response.status_message = 'Forbidden'
-            if 'content-length' in response.headers:
-              del response.headers['content-length']
-            new_response = ('HTTP response was too large: %d.  '
-                            'The limit is: %d.'
-                            % (runtime_response_size,
-                               MAX_RUNTIME_RESPONSE_SIZE))
-            response.headers['content-length'] = str(len(new_response))
-            response.body = cStringIO.StringIO(new_response)
+        response, exc_info = self._Execute(env_dict), None
+      except:
+        response, exc_info = None, sys.exc_info()
+      self._Respond(response, exc_info)
+
+    def _Execute(self, env_dict):
+      """Dispatches the request.
 
+      Args:
+        env_dict: Environment dictionary.
+
+      Returns:
+        The AppServerResponse.
+      """
+      if self.module_manager.AreModuleFilesModified():
+        self.module_manager.ResetModules()
+
+      implicit_matcher = CreateImplicitMatcher(self.module_dict,
+                                               root_path)
+      config, explicit_matcher = LoadAppConfig(root_path, self.module_dict,
+                                               cache=self.config_cache,
+                                               static_caching=static_caching)
+      if config.api_version != API_VERSION:
+        logging.error(
+            "API versions cannot be switched dynamically: %r != %r",
+            config.api_version, API_VERSION)
+        sys.exit(1)
+      env_dict['CURRENT_VERSION_ID'] = config.version
+      env_dict['APPLICATION_ID'] = config.application
+      dispatcher = MatcherDispatcher(login_url,
+                                     [implicit_matcher, explicit_matcher])
+
+#      if require_indexes:
+#        dev_appserver_index.SetupIndexes(config.application, root_path)
+
+      outfile = cStringIO.StringIO()
+      infile = CreateRequestFile(self.request.body, request_spool_size)
+      try:
+        self._Dispatch(dispatcher, infile, outfile, logfile, env_dict)
+      finally:
+        infile.close()
+        self.module_manager.UpdateModuleFileModificationTimes()
+        if not get_yaml().disable_log:
+          logdata = logfile.read()
+          append_app_log(logdata)
+          logfile.flush()
+          logfile.seek(0)
+          logging.debug('application log: %r' %logdata)
+
+      outfile.flush()
+      outfile.seek(0)
+
+      response = RewriteResponse(outfile, self.rewriter_chain, self._appserver_headers)
+
+      if not response.large_response:
+        position = response.body.tell()
+        response.body.seek(0, 2)
+        end = response.body.tell()
+        response.body.seek(position)
+        runtime_response_size = end - position
+
+        if runtime_response_size > MAX_RUNTIME_RESPONSE_SIZE:
+          response.status_code = 500
+          response.status_message = 'Forbidden'
+          if 'content-length' in response.headers:
+            del response.headers['content-length']
+          new_response = ('HTTP response was too large: %d.  '
+                          'The limit is: %d.'
+                          % (runtime_response_size,
+                             MAX_RUNTIME_RESPONSE_SIZE))
+          response.headers['content-length'] = str(len(new_response))
+          response.body = cStringIO.StringIO(new_response)
+
+      return response
+
+    def _Respond(self, response, exc_info):
+      """Writes the response, or an error page, and finishes the request.
+
+      Args:
+        response: The AppServerResponse from _Execute.
+        exc_info: The sys.exc_info() of the exception _Execute raised instead,
+          or None.
+      """
+#      tbhandler = cgitb.Hook(file=self.wfile).handle
+      try:
+        if exc_info is not None:
+          raise exc_info[0], exc_info[1], exc_info[2]
       except yaml_errors.EventListenerError, e:
         title = 'Fatal error when loading application configuration'
         msg = '%s:\n%s' % (title, str(e))
@@ -3328,12 +3723,8 @@ def CreateRequestHandler(root_path,
           if index_yaml_updater is not None:
             index_yaml_updater.UpdateIndexYaml()
 
-      if not get_yaml().disable_log:
-        logdata = logfile.read()
-        append_app_log(logdata)
-        logfile.flush()
-        logfile.seek(0)
-        logging.debug('application log: %r' %logdata)
+      if not self._finished:
+        self.finish()
 
   return DevAppServerRequestHandler
 
@@ -3645,6 +4036,8 @@ def SetupStubs(app_id, **config):
         logging.warning('Removing file failed: %s', e)
 
   apiproxy_stub_map.apiproxy = apiproxy_stub_map.APIProxyStubMap()
+  apiproxy_rpc.SetThreadPoolSize(
+      int(config.get('api_rpc_threads', apiproxy_rpc.DEFAULT_THREAD_POOL_SIZE)))
 
   if provider == 'boost':
     from cyclozzo.apps.datastore import datastore_hypertable_ht
@@ -3655,9 +4048,23 @@ def SetupStubs(app_id, **config):
     from cyclozzo.apps.datastore import datastore_hypertable_thrift	
     thrift_address = config.get('thrift_address', '127.0.0.1')
     thrift_port = int(config.get('thrift_port', 38080))
+    thrift_pool_size = int(config.get('thrift_pool_size', 8))
+    flush_interval = int(config.get('mutator_flush_interval', 0))
+    max_cursors = int(config.get('max_query_cursors', 1000))
+    cursor_memory = int(config.get('query_cursor_memory', 64 << 20))
+    cursor_ttl = int(config.get('query_cursor_ttl', 600))
+    projection = config.get('query_projection', False)
     datastore = datastore_hypertable_thrift.HypertableStub(
         app_id, thrift_address=thrift_address,
-        thrift_port=thrift_port)
+        thrift_port=thrift_port,
+        pool_size=thrift_pool_size,
+        flush_interval=flush_interval,
+        app_root=root_path,
+        require_indexes=require_indexes,
+        max_cursors=max_cursors,
+        cursor_memory=cursor_memory,
+        cursor_ttl=cursor_ttl,
+        projection=projection)
   elif provider == 'riak':
     from cyclozzo.apps.datastore import datastore_riak_indexed
     riak_host = config.get('riak_address', '127.0.0.1')
@@ -3725,14 +4132,25 @@ def SetupStubs(app_id, **config):
     memcached_port = int(config.get('memcached_port', 11211))
     apiproxy_stub_map.apiproxy.RegisterStub(
         'memcache',
-        memcache_stub.MemcacheServiceStub(memcached_server,
-                                  memcached_port))
+        memcache_stub.MemcacheServiceStub(
+            memcached_server,
+            memcached_port,
+            compress_threshold=int(config.get('memcached_compress_threshold',
+                                              0))))
   elif memcached_driver == 'python-memcached':
     from cyclozzo.apps.api.memcache import memcache_distributed
     memcached_servers = config.get('memcached_servers', ['127.0.0.1'])
     apiproxy_stub_map.apiproxy.RegisterStub(
         'memcache',
-        memcache_distributed.MemcacheService(memcached_servers))
+        memcache_distributed.MemcacheService(
+            memcached_servers,
+            default_port=int(config.get('memcached_port', 11211)),
+            dead_retry=int(config.get('memcached_dead_retry', 30)),
+            replicas=int(config.get('memcached_replicas', 1)),
+            replicated_namespaces=config.get('memcached_replicated_namespaces'),
+            near_cache_bytes=int(config.get('memcached_near_cache_bytes', 0)),
+            near_cache_ttl=int(config.get('memcached_near_cache_ttl', 5)),
+            near_cache_namespaces=config.get('memcached_near_cache_namespaces')))
 
 #  apiproxy_stub_map.apiproxy.RegisterStub(
 #      'matcher',
@@ -3928,6 +4346,7 @@ def CreateServer(root_path,
                            [sdk_dir,
                             template_dir])
   FakeFile.SetAllowSkippedFiles(allow_skipped_files)
+  WarmSandbox.SetEnabled(bool(cyclozzo_config.warm_sandbox))
 
   handler_class = CreateRequestHandler(absolute_root_path,
                                        login_url,
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+
+import ctypes
+import cStringIO
+import os
+import shutil
+import sys
+import tempfile
+import types
+import unittest
+
+from cyclozzo.apps.tools import appserver
+
+
+_VARIABLE = 'WARM_SANDBOX_TEST'
+_MODULE = 'warm_sandbox_test_module'
+_SERVER_MODULE = 'warm_sandbox_test_server_module'
+
+_libc = ctypes.CDLL(None)
+_libc.getenv.restype = ctypes.c_char_p
+
+
+def CGetenv(name):
+  """Returns the value of name in the C library's environment."""
+  return _libc.getenv(name)
+
+
+class WarmSandboxTestCase(unittest.TestCase):
+
+  def setUp(self):
+    self.root_path = tempfile.mkdtemp()
+    self.cgi_path = os.path.join(self.root_path, 'main.py')
+    self.module_dict = appserver.SetupSharedModules(sys.modules)
+    self.seen = []
+
+  def tearDown(self):
+    appserver.WarmSandbox.SetEnabled(False)
+    sys.modules.pop(_SERVER_MODULE, None)
+    os.environ.pop(_VARIABLE, None)
+    shutil.rmtree(self.root_path)
+
+  def Execute(self, script, env=None):
+    """Runs script as a request and records what it saw."""
+
+    def exec_script(handler_path, cgi_path, hook):
+      self.seen.append({'environ': os.environ.get(_VARIABLE),
+                        'c_environ': CGetenv(_VARIABLE),
+                        'module': sys.modules.get(_MODULE),
+                        'server_module': _SERVER_MODULE in sys.modules,
+                        'module_names': set(sys.modules),
+                        })
+      script()
+      return False
+
+    appserver.ExecuteCGI(self.root_path, 'main.py', self.cgi_path,
+                         dict(env or {'REQUEST_METHOD': 'GET'}),
+                         cStringIO.StringIO(), cStringIO.StringIO(),
+                         cStringIO.StringIO(), self.module_dict,
+                         exec_script=exec_script)
+
+  def SetState(self):
+    """A request that changes the environment and sys.modules."""
+    os.environ[_VARIABLE] = 'request'
+    sys.modules[_MODULE] = types.ModuleType(_MODULE)
+
+  def DoNothing(self):
+    pass
+
+  def RunRequests(self):
+    """Runs two requests, loading a server module between them."""
+    os.environ[_VARIABLE] = 'server'
+    server_names = set(sys.modules)
+    self.Execute(self.SetState)
+    self.assertEqual(os.environ.get(_VARIABLE), 'server')
+    self.assertEqual(CGetenv(_VARIABLE), 'server')
+    self.assertFalse(_MODULE in sys.modules)
+    self.assertEqual(set(sys.modules), server_names)
+
+    sys.modules[_SERVER_MODULE] = types.ModuleType(_SERVER_MODULE)
+    self.Execute(self.DoNothing)
+    self.Execute(self.DoNothing, {_VARIABLE: 'next'})
+
+  def test_requests_are_isolated(self):
+    appserver.WarmSandbox.SetEnabled(True)
+    self.RunRequests()
+    first, second, third = self.seen
+    for seen in self.seen:
+      self.assertFalse(seen['server_module'])
+    self.assertEqual(first['environ'], None)
+    self.assertEqual(first['c_environ'], None)
+    self.assertEqual(second['environ'], None)
+    self.assertEqual(second['c_environ'], None)
+    self.assertEqual(third['environ'], 'next')
+    self.assertEqual(third['c_environ'], 'next')
+    # modules the application loads are kept in module_dict, as they are
+    # without the warm sandbox.
+    self.assertEqual(first['module'], None)
+    self.assertTrue(second['module'] is self.module_dict[_MODULE])
+
+  def test_same_state_as_cold_sandbox(self):
+    self.RunRequests()
+    cold = self.seen
+    os.environ.pop(_VARIABLE)
+    sys.modules.pop(_SERVER_MODULE)
+    self.module_dict = appserver.SetupSharedModules(sys.modules)
+    self.seen = []
+    appserver.WarmSandbox.SetEnabled(True)
+    self.RunRequests()
+    self.assertEqual(len(self.seen), len(cold))
+    for warm_seen, cold_seen in zip(self.seen, cold):
+      for key in ('environ', 'c_environ', 'server_module', 'module_names'):
+        self.assertEqual(warm_seen[key], cold_seen[key])
+
+
+if __name__ == '__main__':
+  test_cases = [WarmSandboxTestCase,
+               ]
+  for test_case in test_cases:
+    suite = unittest.TestLoader().loadTestsFromTestCase(test_case)
+    unittest.TextTestRunner(verbosity=2).run(suite)
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+#
+#   Copyright (C) 2010-2011 Stackless Recursion
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2, or (at your option)
+#   any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+"""Times the Hypertable datastore stub.
+
+%(script)s put [host] [port] [count]
+%(script)s query [count]
+
+  put     Stores count new entities (default %(put_count)d) through a
+          ThriftBroker at host:port (default %(address)s:%(port)s), one
+          entity per Put and then in batches, and prints entities/sec.
+  query   Filters and sorts count in-memory entities (default
+          %(query_count)d) as the Hypertable stubs evaluate queries, and
+          prints entities/sec.
+"""
+
+
+import os
+import sys
+import time
+
+from cyclozzo.apps.api import datastore
+from cyclozzo.apps.api import datastore_types
+from cyclozzo.apps.datastore import datastore_pb
+from cyclozzo.apps.datastore import datastore_query_eval
+
+
+DEFAULT_ADDRESS = '127.0.0.1'
+DEFAULT_PORT = '38080'
+DEFAULT_PUT_COUNT = 10000
+DEFAULT_QUERY_COUNT = 100000
+
+
+def BenchmarkPut(stub, app_id, count=DEFAULT_PUT_COUNT, batch_size=500,
+                 kind='PutBenchmark'):
+  """Times storing count new entities with one Put per entity and with Puts
+  of batch_size entities, each Put writing through one mutator per table.
+
+  Returns:
+    list of (method, seconds, entities per second)
+  """
+  timings = []
+  for name, batch in (('one per Put', 1),
+                      ('%d per Put' % batch_size, batch_size)):
+    requests = []
+    for i in xrange(0, count, batch):
+      request = datastore_pb.PutRequest()
+      for entity_index in xrange(i, min(i + batch, count)):
+        request.add_entity().CopyFrom(
+            datastore.Entity(kind, _app=app_id)._ToPb())
+      requests.append(request)
+    start = time.time()
+    for request in requests:
+      stub.MakeSyncCall('datastore_v3', 'Put', request,
+                        datastore_pb.PutResponse())
+    seconds = time.time() - start
+    timings.append((name, seconds, count / seconds))
+  return timings
+
+
+def BenchmarkQuery(count=DEFAULT_QUERY_COUNT, limit=20):
+  """Times filtering and sorting count in-memory entities with
+  datastore_query_eval.
+
+  Returns:
+    list of (name, seconds, entities per second)
+  """
+  entities = []
+  for i in xrange(count):
+    entity = datastore.Entity('Benchmark', id=i + 1, _app='benchmark')
+    entity['n'] = i % 1000
+    entity['tags'] = [str(i % 7), str(i % 13)]
+    entities.append(entity)
+
+  filt = datastore_pb.Query_Filter()
+  filt.set_op(datastore_pb.Query_Filter.GREATER_THAN_OR_EQUAL)
+  filt.add_property().CopyFrom(datastore_types.ToPropertyPb('n', 500))
+  tag_filt = datastore_pb.Query_Filter()
+  tag_filt.set_op(datastore_pb.Query_Filter.EQUAL)
+  tag_filt.add_property().CopyFrom(datastore_types.ToPropertyPb('tags', '3'))
+  order = datastore_pb.Query_Order()
+  order.set_property('n')
+  order.set_direction(datastore_pb.Query_Order.DESCENDING)
+
+  FilterEntities = datastore_query_eval.FilterEntities
+  SortEntities = datastore_query_eval.SortEntities
+  timings = []
+  for name, func in (
+      ('filter n >= 500',
+       lambda: FilterEntities(entities, [filt], [])),
+      ('filter n >= 500, tags = 3',
+       lambda: FilterEntities(entities, [filt, tag_filt], [])),
+      ('sort n desc',
+       lambda: SortEntities(entities, [order])),
+      ('sort n desc, first %d' % limit,
+       lambda: SortEntities(entities, [order], limit))):
+    start = time.time()
+    func()
+    seconds = time.time() - start
+    timings.append((name, seconds, count / seconds))
+  return timings
+
+
+def PrintUsage():
+  """Prints the usage of the script."""
+  print sys.modules['__main__'].__doc__ % {
+      'script': os.path.basename(sys.argv[0]),
+      'put_count': DEFAULT_PUT_COUNT,
+      'query_count': DEFAULT_QUERY_COUNT,
+      'address': DEFAULT_ADDRESS,
+      'port': DEFAULT_PORT,
+      }
+
+
+def main(argv):
+  """Runs the benchmark named by argv[1] with the arguments after it."""
+  if len(argv) < 2 or argv[1] not in ('put', 'query'):
+    PrintUsage()
+    return 1
+  args = argv[2:]
+
+  if argv[1] == 'query':
+    count = DEFAULT_QUERY_COUNT
+    if args:
+      count = int(args[0])
+    for name, seconds, rate in BenchmarkQuery(count):
+      print '%-28s %d entities in %7.3fs, %8.0f entities/sec' % (
+          name, count, seconds, rate)
+    return 0
+
+  from cyclozzo.apps.datastore import datastore_hypertable_thrift
+  thrift_address = DEFAULT_ADDRESS
+  thrift_port = DEFAULT_PORT
+  count = DEFAULT_PUT_COUNT
+  if len(args) > 0:
+    thrift_address = args[0]
+  if len(args) > 1:
+    thrift_port = args[1]
+  if len(args) > 2:
+    count = int(args[2])
+  os.environ.setdefault('APPLICATION_ID', 'benchmark')
+  stub = datastore_hypertable_thrift.HypertableStub('benchmark',
+                                                    thrift_address,
+                                                    thrift_port)
+  for name, seconds, rate in BenchmarkPut(stub, 'benchmark', count):
+    print '%-16s %d entities in %7.2fs, %8.0f entities/sec' % (
+        name, count, seconds, rate)
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv))